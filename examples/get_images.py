@@ -15,16 +15,12 @@ catalog_ids = ['1030010034AFCE00',
 
 print 'Order imagery from GBDX'
 gbdx = Interface()
-order_id = gbdx.ordering.order(catalog_ids) 
-
-# check order status
-while True:
-    states, locations = zip(*[(order['state'],order['location']) 
-                            for order in gbdx.ordering.status(order_id)])
-    if any(state != 'delivered' for state in states):
-        time.sleep(300)
-    else:
-        break    
+order_id = gbdx.ordering.order(catalog_ids)[0]
+
+# wait for the order to be delivered
+for event in gbdx.ordering.wait(order_id):
+    print 'Acquisition {} is {}'.format(event['acquisition_id'], event['state'])
+locations = [order['location'] for order in gbdx.ordering.status(order_id)]
 
 print 'Elapsed time: {} min'.format(round((time.time() - start_time)/60))
 
@@ -2,7 +2,8 @@
 GBDX Catalog Search Helper Functions.
 
 This set of functions is used for breaking up a large AOI into smaller AOIs to search, because the catalog API 
-can only handle 2 square degrees at a time.
+can only handle 2 square degrees at a time.  The tiling and intersection helpers are also used to split
+large vector service queries.
 
 """
 from builtins import zip
@@ -126,4 +127,126 @@ def search_materials_in_multiple_small_searches(search_request, gbdx_connection,
     # this next line works, but filters too much stuff.  It removes some items intersecting the polygon.
     #records = records_in_polygon(records, searchAreaPolygon)  # this takes quite a while to run, so leave it commented
 
-    return records
\ No newline at end of file
+    return records
+
+def tile_bounds(polygon, tile_size):
+    '''Split the bounds of a polygon into square tiles of tile_size degrees,
+    keeping only the tiles that intersect the polygon.
+
+    Args:
+        polygon: A pygeoif geometry.
+        tile_size (float): The size in degrees of the side of a tile.
+
+    Returns:
+        List of tile bounds (W, S, E, N).
+    '''
+    W, S, E, N = polygon.bounds
+
+    # Handle point searches:
+    if W == E and N == S:
+        return [(W, S, E, N)]
+
+    Ys = [i for i in xfrange(S, N, tile_size)] if S < N else [S, N]
+    Xs = [i for i in xfrange(W, E, tile_size)] if W < E else [W, E]
+
+    shape = polygon.__geo_interface__
+    tiles = []
+    for y, y1 in zip(Ys, Ys[1:]):
+        for x, x1 in zip(Xs, Xs[1:]):
+            bbox = (x, y, x1, y1)
+            if geometries_intersect(polygon_from_bounds(bbox).__geo_interface__, shape):
+                tiles.append(bbox)
+    return tiles
+
+def _components(geom):
+    # split a GeoJSON geometry into 2D points, line strings and polygons (lists of rings)
+    t = geom['type']
+    if t == 'GeometryCollection':
+        points, lines, polygons = [], [], []
+        for g in geom['geometries']:
+            p, l, a = _components(g)
+            points += p
+            lines += l
+            polygons += a
+        return points, lines, polygons
+
+    def xy(coords):
+        return [(c[0], c[1]) for c in coords]
+
+    c = geom['coordinates']
+    if t == 'Point':
+        return xy([c]), [], []
+    if t == 'MultiPoint':
+        return xy(c), [], []
+    if t == 'LineString':
+        return [], [xy(c)], []
+    if t == 'MultiLineString':
+        return [], [xy(l) for l in c], []
+    if t == 'Polygon':
+        return [], [], [[xy(r) for r in c]]
+    if t == 'MultiPolygon':
+        return [], [], [[xy(r) for r in p] for p in c]
+    raise ValueError('Unsupported geometry type: %s' % t)
+
+def _orientation(p, q, r):
+    v = (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+    return (v > 0) - (v < 0)
+
+def _on_segment(p, q, r):
+    # r is collinear with p-q: is it between them?
+    return min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+
+def segments_intersect(a, b, c, d):
+    # whether segment a-b touches or crosses segment c-d
+    o1, o2 = _orientation(a, b, c), _orientation(a, b, d)
+    o3, o4 = _orientation(c, d, a), _orientation(c, d, b)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and _on_segment(a, b, c)) or (o2 == 0 and _on_segment(a, b, d)) or
+            (o3 == 0 and _on_segment(c, d, a)) or (o4 == 0 and _on_segment(c, d, b)))
+
+def _point_in_polygon(x, y, rings):
+    return point_in_poly(x, y, rings[0]) and not any(point_in_poly(x, y, hole) for hole in rings[1:])
+
+def _bounds(lines):
+    xs = [c[0] for l in lines for c in l]
+    ys = [c[1] for l in lines for c in l]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def geometries_intersect(a, b):
+    '''Whether two GeoJSON geometries (dicts with "type" and "coordinates")
+    intersect, boundaries included.'''
+    points_a, lines_a, polygons_a = _components(a)
+    points_b, lines_b, polygons_b = _components(b)
+    if not (points_a or lines_a or polygons_a) or not (points_b or lines_b or polygons_b):
+        return False
+
+    # polygon boundaries are lines too; a point is a zero length line
+    lines_a = lines_a + [ring for p in polygons_a for ring in p] + [[p, p] for p in points_a]
+    lines_b = lines_b + [ring for p in polygons_b for ring in p] + [[p, p] for p in points_b]
+
+    W1, S1, E1, N1 = _bounds(lines_a)
+    W2, S2, E2, N2 = _bounds(lines_b)
+    if W1 > E2 or W2 > E1 or S1 > N2 or S2 > N1:
+        return False
+
+    for line_a in lines_a:
+        edges_a = list(zip(line_a, line_a[1:])) or [(line_a[0], line_a[0])]
+        for line_b in lines_b:
+            edges_b = list(zip(line_b, line_b[1:])) or [(line_b[0], line_b[0])]
+            for p, q in edges_a:
+                for r, s in edges_b:
+                    if segments_intersect(p, q, r, s):
+                        return True
+
+    # no boundaries touch: one shape intersects the other only if it lies inside it,
+    # so testing a single vertex of each line is enough
+    for line in lines_a:
+        x, y = line[0]
+        if any(_point_in_polygon(x, y, p) for p in polygons_b):
+            return True
+    for line in lines_b:
+        x, y = line[0]
+        if any(_point_in_polygon(x, y, p) for p in polygons_a):
+            return True
+    return False
@@ -0,0 +1,19 @@
+"""
+Progress files that let interrupted downloads, queries and exports resume.
+"""
+import json
+
+
+def read_state(path):
+    '''The state saved at path, or None if there is none or it cannot be read.'''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_state(path, state):
+    '''Save state (a JSON serializable dict) to path.'''
+    with open(path, 'w') as f:
+        json.dump(state, f)
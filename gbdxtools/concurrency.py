@@ -0,0 +1,327 @@
+"""
+Helpers for issuing GBDX API requests concurrently.
+"""
+from builtins import range
+from builtins import object
+
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.packages.urllib3.exceptions import NewConnectionError
+from concurrent.futures import ThreadPoolExecutor
+from future.moves import queue
+
+# default size of the thread pools used to talk to the GBDX APIs
+DEFAULT_MAX_WORKERS = 8
+
+
+def batches(items, batch_size):
+    '''Split a list into consecutive batches of at most batch_size items.
+
+    Args:
+        items (list): Items to split.
+        batch_size (int): Maximum number of items per batch.
+
+    Returns:
+        Generator of lists.
+    '''
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def is_retryable(error):
+    '''Whether a failed request is worth retrying: connection problems,
+    timeouts, throttling (429) and server side errors (5xx).'''
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+def is_retryable_post(error):
+    '''Whether a failed request that is not idempotent (a POST creating
+    something) is safe to retry: only if it never reached the server, because
+    the connection could not be made, or the server turned it away (429, 503).
+    After a read timeout or another server error it may have been processed.'''
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in (429, 503)
+    return False
+
+
+def with_retries(func, retries=3, backoff=1.0, logger=None, retryable=is_retryable):
+    '''Wrap func so that retryable request errors are retried with
+    exponential backoff and jitter.
+
+    Args:
+        func (callable): Function making the request.
+        retries (int): Number of retries after the first attempt.
+        backoff (float): Delay in seconds before the first retry; doubled on
+                         every retry.
+        logger: Optional logger for retry messages.
+        retryable (callable): Whether an error is worth retrying. Default is
+                              is_retryable; use is_retryable_post for requests
+                              that are not idempotent.
+
+    Returns:
+        A callable taking the same arguments as func.
+    '''
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= retries or not retryable(e):
+                    raise
+                delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if logger:
+                    logger.debug('Request failed (%s), retrying in %.1fs' % (e, delay))
+                time.sleep(delay)
+                attempt += 1
+
+    return wrapper
+
+
+class Backoff(object):
+
+    def __init__(self, initial=1.0, maximum=60.0, factor=2.0, jitter=0.1):
+        '''Exponentially growing polling intervals with jitter.
+
+        Args:
+            initial (float): First interval in seconds.
+            maximum (float): Largest interval in seconds.
+            factor (float): Growth of the interval after every call to delay().
+            jitter (float): Relative amount of random jitter, so that many
+                            pollers started together spread out over time.
+
+        Returns:
+            An instance of Backoff.
+        '''
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self._interval = initial
+
+    def delay(self):
+        '''The next interval to wait, in seconds. Grows the interval.'''
+        interval = self._interval
+        self._interval = min(self.maximum, self._interval * self.factor)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def reset(self):
+        '''Go back to the initial interval.'''
+        self._interval = self.initial
+
+
+class Poller(object):
+
+    def __init__(self, keys, fetch, min_interval=10, max_interval=300, max_workers=DEFAULT_MAX_WORKERS):
+        '''Poll many resources concurrently, each with its own exponential
+        backoff, until they are all done.
+
+        Iterate over poll(). After each (key, result) it yields, call done(key)
+        once the resource no longer needs polling, or reset(key) when it
+        changed, to poll it again soon.
+
+        Args:
+            keys (list): Ids of the resources.
+            fetch (callable): Returns the current result for an id.
+            min_interval (float): First interval between two polls of a resource.
+            max_interval (float): Longest interval between two polls of a resource.
+            max_workers (int): Maximum number of resources polled at the same time.
+
+        Returns:
+            An instance of Poller.
+        '''
+        self.fetch = fetch
+        self.max_workers = max_workers
+        self._backoffs = dict((key, Backoff(min_interval, max_interval)) for key in keys)
+        self._next_poll = dict((key, 0) for key in keys)
+
+    @property
+    def pending(self):
+        '''Ids of the resources not done yet.'''
+        return list(self._next_poll)
+
+    def done(self, key):
+        '''Stop polling a resource.'''
+        self._next_poll.pop(key, None)
+
+    def reset(self, key, min_interval=None):
+        '''Go back to the first interval for a resource, optionally changing it.'''
+        backoff = self._backoffs[key]
+        if min_interval is not None:
+            backoff.initial = min_interval
+        backoff.reset()
+
+    def poll(self, timeout=None, timeout_error=None):
+        '''Poll until every resource is done.
+
+        Args:
+            timeout (float): Maximum number of seconds to poll for.
+            timeout_error (callable): Returns the exception raised once timeout
+                                      is exceeded, from the ids not done yet.
+
+        Returns:
+            Generator of (id, result), one per poll.
+        '''
+        deadline = time.time() + timeout if timeout is not None else None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while self._next_poll:
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    raise timeout_error(self.pending)
+
+                due = [key for key, t in self._next_poll.items() if t <= now]
+                if not due:
+                    wake = min(self._next_poll.values())
+                    if deadline is not None:
+                        wake = min(wake, deadline)
+                    time.sleep(wake - now)
+                    continue
+
+                for key, result in zip(due, executor.map(self.fetch, due)):
+                    yield key, result
+                    if key in self._next_poll:
+                        self._next_poll[key] = time.time() + self._backoffs[key].delay()
+
+
+def read_ahead(iterable, depth=1, max_bytes=None, sizeof=None):
+    '''Consume an iterable in a background thread, keeping up to depth items
+    ready ahead of the consumer.
+
+    Args:
+        iterable: The iterable to consume, e.g. a generator of pages.
+        depth (int): Maximum number of items buffered ahead.
+        max_bytes (int): Optional cap on the total size of the buffered items.
+                         One item is always allowed, however large.
+        sizeof (callable): Returns the size in bytes of an item. Required for
+                           max_bytes.
+
+    Returns:
+        Generator yielding the items of iterable, in order. An exception raised
+        by iterable is re-raised once the items before it have been consumed.
+    '''
+    cond = threading.Condition()
+    buffered = deque()
+    state = {'bytes': 0, 'stop': False, 'done': False, 'error': None}
+
+    def _full(size):
+        if not buffered:
+            return False
+        if len(buffered) >= depth:
+            return True
+        return max_bytes is not None and state['bytes'] + size > max_bytes
+
+    def _produce():
+        try:
+            for item in iterable:
+                size = sizeof(item) if sizeof else 0
+                with cond:
+                    while not state['stop'] and _full(size):
+                        cond.wait()
+                    if state['stop']:
+                        return
+                    buffered.append((item, size))
+                    state['bytes'] += size
+                    cond.notify_all()
+        except Exception as e:
+            with cond:
+                state['error'] = e
+        finally:
+            with cond:
+                state['done'] = True
+                cond.notify_all()
+
+    producer = threading.Thread(target=_produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            with cond:
+                while not buffered and not state['done']:
+                    cond.wait()
+                if buffered:
+                    item, size = buffered.popleft()
+                    state['bytes'] -= size
+                    cond.notify_all()
+                elif state['error'] is not None:
+                    raise state['error']
+                else:
+                    return
+            yield item
+    finally:
+        # stop the producer if the consumer gives up early
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+
+
+def interleave(sources, max_workers=DEFAULT_MAX_WORKERS, buffer_size=None):
+    '''Consume several iterables concurrently, yielding their items as soon
+    as any of them produces one.
+
+    Args:
+        sources (list): Callables returning the iterables to consume, e.g.
+                        functions returning generators of pages.
+        max_workers (int): Maximum number of iterables consumed at the same time.
+        buffer_size (int): Maximum number of items waiting for the consumer.
+                           Defaults to twice max_workers.
+
+    Returns:
+        Generator of the items of all the iterables. Items of one iterable
+        keep their order; the iterables are interleaved. The first exception
+        raised by a source is re-raised.
+    '''
+    sources = list(sources)
+    items = queue.Queue(maxsize=buffer_size or 2 * max_workers)
+    stop = threading.Event()
+
+    def _put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _consume(source):
+        try:
+            for item in source():
+                if not _put(('item', item)):
+                    return
+        except Exception as e:
+            _put(('error', e))
+        finally:
+            _put(('done', None))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for source in sources:
+            executor.submit(_consume, source)
+
+        remaining = len(sources)
+        while remaining:
+            kind, value = items.get()
+            if kind == 'item':
+                yield value
+            elif kind == 'error':
+                raise value
+            else:
+                remaining -= 1
+    finally:
+        # stop the remaining sources if the consumer gives up early
+        stop.set()
+        executor.shutdown(wait=False)
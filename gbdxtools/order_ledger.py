@@ -0,0 +1,116 @@
+"""
+Local record of GBDX imagery orders.
+"""
+from builtins import object
+
+import os
+import sqlite3
+import threading
+import time
+
+from gbdxtools.concurrency import batches
+
+
+class OrderLedger(object):
+
+    def __init__(self, path='~/.gbdx-orders.db', max_age=30 * 86400):
+        '''A persistent ledger of catalog id -> order id -> last known state
+        and location, kept in a SQLite database.
+
+        Attach it to the Ordering interface to stop re-ordering imagery that
+        is already delivered or in flight:
+
+            gbdx.ordering.ledger = OrderLedger()
+
+        Args:
+            path (str): Path of the SQLite database. Created if needed.
+            max_age (int): Number of seconds a delivered location is trusted
+                           for before it is looked up again. Default is 30 days.
+
+        Returns:
+            An instance of OrderLedger.
+        '''
+        self.path = os.path.expanduser(path)
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS orders ('
+                             'catalog_id TEXT PRIMARY KEY, order_id TEXT, state TEXT, '
+                             'location TEXT, updated REAL)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, catalog_ids):
+        '''Look up catalog ids in the ledger.
+
+        Args:
+            catalog_ids (list): Catalog ids.
+
+        Returns:
+            Dictionary of catalog id to a dictionary with the keys 'catalog_id',
+            'order_id', 'state', 'location' and 'updated' (a timestamp), for
+            the catalog ids found in the ledger.
+        '''
+        entries = {}
+        with self._lock:
+            # stay under SQLite's limit on the number of query parameters
+            for ids in batches(list(catalog_ids), 500):
+                rows = self._db.execute(
+                    'SELECT catalog_id, order_id, state, location, updated FROM orders '
+                    'WHERE catalog_id IN (%s)' % ','.join('?' * len(ids)), ids)
+                for row in rows:
+                    entries[row[0]] = dict(zip(('catalog_id', 'order_id', 'state', 'location', 'updated'), row))
+        return entries
+
+    def fresh_locations(self, catalog_ids):
+        '''Delivered acquisitions whose location was confirmed less than max_age
+        seconds ago.
+
+        Args:
+            catalog_ids (list): Catalog ids.
+
+        Returns:
+            Dictionary of catalog id to an acquisition dictionary with the keys
+            'acquisition_id', 'state' and 'location'.
+        '''
+        oldest = time.time() - self.max_age
+        return dict(
+            (catalog_id, {'acquisition_id': catalog_id, 'state': e['state'], 'location': e['location']})
+            for catalog_id, e in self.get(catalog_ids).items()
+            if e['state'] == 'delivered' and e['updated'] >= oldest
+        )
+
+    def record_orders(self, order_ids):
+        '''Record newly placed orders.
+
+        Args:
+            order_ids (dict): Catalog id to order id.
+        '''
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO orders (catalog_id, order_id, state, location, updated) '
+                'VALUES (?, ?, ?, NULL, ?)',
+                [(catalog_id, order_id, 'submitted', now) for catalog_id, order_id in order_ids.items()])
+
+    def record_acquisitions(self, acquisitions, order_id=None):
+        '''Record the latest known state and location of acquisitions, as
+        returned by the ordering API.
+
+        Args:
+            acquisitions (list): Dictionaries with the keys 'acquisition_id',
+                                 'state' and 'location'.
+            order_id (str): The order the acquisitions belong to, if known.
+        '''
+        now = time.time()
+        rows = [(a['acquisition_id'], a.get('state'), a.get('location'), now) for a in acquisitions]
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR IGNORE INTO orders (catalog_id) VALUES (?)', [r[:1] for r in rows])
+            self._db.executemany(
+                'UPDATE orders SET order_id = COALESCE(?, order_id), state = ?, location = ?, updated = ? '
+                'WHERE catalog_id = ?',
+                [(order_id, state, location, updated, catalog_id) for catalog_id, state, location, updated in rows])
@@ -7,16 +7,68 @@ from builtins import zip
 from builtins import object
 import requests
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from gbdxtools.concurrency import DEFAULT_MAX_WORKERS, Poller, batches, is_retryable_post, with_retries
+
+# acquisition states after which an acquisition no longer changes
+TERMINAL_STATES = ('delivered', 'failed')
+
+# acquisition states of imagery that is being ordered
+IN_FLIGHT_STATES = ('submitted',)
+
+
+class OrderTimeout(Exception):
+    pass
+
+
+class OrderError(Exception):
+
+    def __init__(self, message, mapping, failed_ids, errors):
+        '''Raised when some batches of an order could not be placed.
+
+           Args:
+               message (str): Description of the failure.
+               mapping (dict): {catalog_id: order_id} of the catalog ids that
+                               were ordered, including the batches that were placed.
+               failed_ids (list): Catalog ids of the batches that failed.
+               errors (list): The exceptions raised by the failed batches.
+        '''
+        super(OrderError, self).__init__(message)
+        self.mapping = mapping
+        self.failed_ids = failed_ids
+        self.errors = errors
+
+
+def _sanitize_ids(image_catalog_ids):
+    # strip, drop empty and duplicate ids, keeping the order they were given in
+    if not isinstance(image_catalog_ids, list):
+        image_catalog_ids = [image_catalog_ids]
+
+    seen = set()
+    sanitized_ids = []
+    for _id in (_id.strip() for _id in image_catalog_ids):
+        if _id and _id not in seen:
+            seen.add(_id)
+            sanitized_ids.append(_id)
+    return sanitized_ids
 
 
 class Ordering(object):
 
-    def __init__(self, interface):
+    def __init__(self, interface, location_ttl=86400, ledger=None):
         '''Instantiate the GBDX Ordering Interface
 
            Args:
                interface (Interface): A reference to the GBDX interface.
+               location_ttl (int): Number of seconds the locations of delivered
+                                   images are cached for. 0 disables the cache.
+                                   Default is one day.
+               ledger (OrderLedger): Optional persistent record of orders. When
+                                     set, imagery that is delivered or in flight
+                                     is not ordered again.
 
            Returns:
                An instance of the Ordering interface.
@@ -24,11 +76,34 @@ class Ordering(object):
         self.base_url = '%s/orders/v2' % interface.root_url
         self.gbdx_connection = interface.gbdx_connection
         self.logger = interface.logger
-    
 
-    def order(self, image_catalog_ids, batch_size=100):
+        self.location_ttl = location_ttl
+        self._locations = {}
+        self._lock = threading.Lock()
+
+        self.ledger = ledger
+
+    def order(self, image_catalog_ids, batch_size=100, max_workers=DEFAULT_MAX_WORKERS, retries=3,
+              return_mapping=False):
         '''Orders images from GBDX.
 
+           Batches are submitted concurrently. Placing an order is not
+           idempotent, so a failing batch is only retried, with exponential
+           backoff, when it cannot have been placed: the connection could not
+           be made, or the API answered 429 or 503. After a read timeout or
+           another error the batch is left in OrderError.failed_ids.
+
+           With a ledger, catalog ids that were ordered before and did not fail
+           are not ordered again; their existing order ids are used. Catalog
+           ids the ledger only knows from location(), without an order id, are
+           not ordered either if their state is delivered or in flight
+           (IN_FLIGHT_STATES): they map to None in the mapping and add no
+           order id to the list. Any other state is ordered.
+
+           If some batches fail, the batches that were placed are still
+           returned in an OrderError (and recorded in the ledger), so they
+           are not ordered twice.
+
            Args:
                image_catalog_ids (str or list): A single catalog id or a list of 
                                                 catalog ids.
@@ -36,44 +111,90 @@ class Ordering(object):
                                  batches of batch_size. The ordering API max 
                                  batch size is 100, if batch_size is greater 
                                  than 100 it will be truncated.
+               max_workers (int): Maximum number of batches submitted at the
+                                  same time.
+               retries (int): Number of times a failing batch is retried.
+               return_mapping (bool): Also return a dictionary mapping each
+                                      catalog id to the id of its order.
 
            Returns:
-               order_ids (str or list): If one batch, returns a string. If more
-                                        than one batch, returns a list of order ids, 
-                                        one for each batch.
+               order_ids (str or list): If image_catalog_ids is a single catalog
+                                        id, its order id. If it is a list, a list
+                                        of order ids, one for each batch (or
+                                        existing order), in the order the catalog
+                                        ids were given.
+               If return_mapping is True, a tuple of order_ids and the
+               {catalog_id: order_id} dictionary.
+
+           Raises:
+               OrderError: Some batches could not be placed. Its mapping holds
+                           the catalog ids that were ordered, failed_ids the
+                           others.
         '''
-        def _order_single_batch(url_, ids, results_list):
-            r = self.gbdx_connection.post(url_, data=json.dumps(ids))
+        def _order_single_batch(ids):
+            r = self.gbdx_connection.post(url, data=json.dumps(ids))
             r.raise_for_status()
-            order_id = r.json().get("order_id")
-            if order_id:
-                results_list.append(order_id)
+            return r.json().get("order_id")
 
         self.logger.debug('Place order')
         url = '%s/order' % self.base_url
 
         batch_size = min(100, batch_size)
-        
-        if not isinstance(image_catalog_ids, list):
-            image_catalog_ids = [image_catalog_ids]
 
-        sanitized_ids = list(set((id for id in (_id.strip() for _id in image_catalog_ids) if id)))
+        single = not isinstance(image_catalog_ids, list)
+        sanitized_ids = _sanitize_ids(image_catalog_ids)
+
+        mapping = {}
+        if self.ledger:
+            for catalog_id, entry in self.ledger.get(sanitized_ids).items():
+                if entry['order_id']:
+                    ordered = entry['state'] != 'failed'
+                else:
+                    # recorded by location(), which does not know the order id
+                    ordered = entry['state'] == 'delivered' or entry['state'] in IN_FLIGHT_STATES
+                if ordered:
+                    mapping[catalog_id] = entry['order_id']
+            if mapping:
+                self.logger.debug('Already ordered: ' + ', '.join(mapping))
+
+        id_batches = list(batches([_id for _id in sanitized_ids if _id not in mapping], batch_size))
+
+        submit = with_retries(_order_single_batch, retries=retries, logger=self.logger,
+                              retryable=is_retryable_post)
+        placed = {}
+        failed_ids = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(ids_batch, executor.submit(submit, ids_batch)) for ids_batch in id_batches]
+            for ids_batch, future in futures:
+                try:
+                    order_id = future.result()
+                except Exception as e:
+                    failed_ids.extend(ids_batch)
+                    errors.append(e)
+                    continue
+                if order_id:
+                    placed.update((_id, order_id) for _id in ids_batch)
+
+        # record the placed batches even if others failed, so they are not ordered twice
+        if self.ledger and placed:
+            self.ledger.record_orders(placed)
+        mapping.update(placed)
+
+        if errors:
+            raise OrderError('Failed to order %s: %s' % (', '.join(failed_ids), errors[0]),
+                             mapping, failed_ids, errors)
 
         res = []
-        # Use itertool batch recipe
-        acq_ids_by_batch = zip(*([iter(sanitized_ids)] * batch_size))
-        for ids_batch in acq_ids_by_batch:
-            _order_single_batch(url, ids_batch, res)
-
-        # Order reminder
-        remain_count = len(sanitized_ids) % batch_size
-        if remain_count > 0:
-            _order_single_batch(url, sanitized_ids[-remain_count:], res)
-
-        if len(res) == 1:
-            return res[0]
-        elif len(res)>1:
-            return res
+        for _id in sanitized_ids:
+            if mapping.get(_id) is not None and mapping[_id] not in res:
+                res.append(mapping[_id])
+        if single:
+            res = res[0] if res else None
+
+        if return_mapping:
+            return res, mapping
+        return res
 
     def status(self, order_id):
         '''Checks imagery order status. There can be more than one image per
@@ -94,7 +215,35 @@ class Ordering(object):
         }
         r = self.gbdx_connection.get(url)
         r.raise_for_status()
-        return r.json().get("acquisitions", {})
+        acquisitions = r.json().get("acquisitions", {})
+        self._remember_locations(acquisitions)
+        if self.ledger:
+            self.ledger.record_acquisitions(acquisitions, order_id=order_id)
+        return acquisitions
+
+    def wait(self, order_ids, timeout=None, on_delivered=None, **kwargs):
+        '''Wait for orders to finish, yielding every acquisition state change.
+
+           Orders are polled concurrently, each with its own exponential
+           backoff, and an order is no longer polled once all its acquisitions
+           have reached a terminal state (delivered or failed).
+
+           Args:
+               order_ids (str or list): A single order id or a list of order ids.
+               timeout (float): Maximum number of seconds to wait. Raises
+                                OrderTimeout when exceeded. Default waits forever.
+               on_delivered (callable): Called with the list of acquisitions once
+                                        every acquisition is delivered.
+               kwargs: Polling options passed to OrderTracker (max_workers,
+                       min_interval, max_interval).
+
+           Returns:
+               Generator of events, one per acquisition state change, with the
+               keys 'order_id', 'acquisition_id', 'state', 'previous_state' and
+               'location'.
+        '''
+        tracker = OrderTracker(self, order_ids, on_delivered=on_delivered, **kwargs)
+        return tracker.events(timeout=timeout)
 
     def heartbeat(self):
         '''
@@ -114,31 +263,163 @@ class Ordering(object):
             return False
 
 
-    def location(self, image_catalog_ids, batch_size=100):
-        def _process_single_batch(url_, ids, results_dict):
+    def location(self, image_catalog_ids, batch_size=100, max_workers=DEFAULT_MAX_WORKERS, retries=3):
+        '''Get the S3 locations of ordered images.
+
+           Batches are fetched concurrently. The location of a delivered image
+           never changes, so it is cached for location_ttl seconds and served
+           without a request. With a ledger, delivered locations it confirmed
+           recently are used as well.
+
+           Args:
+               image_catalog_ids (str or list): A single catalog id or a list of
+                                                catalog ids.
+               batch_size (int): The image_catalog_ids will be split into
+                                 batches of batch_size, at most 100.
+               max_workers (int): Maximum number of batches fetched at the same time.
+               retries (int): Number of times a failing batch is retried.
+
+           Returns:
+               Dictionary with the key 'acquisitions', a list with one dictionary
+               per acquisition, with the keys 'acquisition_id', 'state' and
+               'location'.
+        '''
+        def _process_single_batch(ids):
             query_string = 'acquisitionIds=[' + ','.join(['"{}"'.format(id_) for id_ in ids]) + ']'
-            r = self.gbdx_connection.get(url_, params=query_string)
+            r = self.gbdx_connection.get(url, params=query_string)
             r.raise_for_status()
-            results_dict['acquisitions'].extend(r.json()['acquisitions'])
+            return r.json()['acquisitions']
 
         url = '%s/location' % self.base_url
 
         batch_size = min(100, batch_size)
 
-        if not isinstance(image_catalog_ids, list):
-            image_catalog_ids = [image_catalog_ids]
+        sanitized_ids = _sanitize_ids(image_catalog_ids)
+
+        found = self._cached_locations(sanitized_ids)
+        missing = [_id for _id in sanitized_ids if _id not in found]
+
+        if self.ledger and missing:
+            found.update(self.ledger.fresh_locations(missing))
+            missing = [_id for _id in missing if _id not in found]
+
+        if missing:
+            fetch = with_retries(_process_single_batch, retries=retries, logger=self.logger)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for acquisitions in executor.map(fetch, list(batches(missing, batch_size))):
+                    self._remember_locations(acquisitions)
+                    if self.ledger:
+                        self.ledger.record_acquisitions(acquisitions)
+                    for acquisition in acquisitions:
+                        found[acquisition['acquisition_id']] = acquisition
+
+        # merge by acquisition id, in the order the ids were given
+        res = [found.pop(_id) for _id in sanitized_ids if _id in found]
+        res.extend(found.values())
+        return {'acquisitions': res}
+
+    def _cached_locations(self, acquisition_ids):
+        now = time.time()
+        with self._lock:
+            cached = {}
+            for _id in acquisition_ids:
+                if _id in self._locations:
+                    expires, acquisition = self._locations[_id]
+                    if expires > now:
+                        cached[_id] = acquisition
+                    else:
+                        del self._locations[_id]
+            return cached
+
+    def _remember_locations(self, acquisitions):
+        if not self.location_ttl:
+            return
+
+        expires = time.time() + self.location_ttl
+        with self._lock:
+            for acquisition in acquisitions:
+                if acquisition.get('state') == 'delivered':
+                    self._locations[acquisition['acquisition_id']] = (expires, acquisition)
+
+    def clear_location_cache(self):
+        '''Forget all cached locations.'''
+        with self._lock:
+            self._locations = {}
+
+
+class OrderTracker(object):
+
+    def __init__(self, ordering, order_ids, on_delivered=None, max_workers=DEFAULT_MAX_WORKERS,
+                 min_interval=10, max_interval=300):
+        '''Track the acquisitions of many orders until they are all done.
 
-        sanitized_ids = list(set((stripped_id for stripped_id in (_id.strip() for _id in image_catalog_ids) if stripped_id)))
+           Args:
+               ordering (Ordering): The GBDX Ordering interface.
+               order_ids (str or list): A single order id or a list of order ids.
+               on_delivered (callable): Called with the list of acquisitions once
+                                        every acquisition is delivered.
+               max_workers (int): Maximum number of orders polled at the same time.
+               min_interval (float): Seconds between the first polls of an order,
+                                     and after any of its acquisitions changed state.
+               max_interval (float): Longest time between two polls of an order.
+
+           Returns:
+               An instance of OrderTracker.
+        '''
+        if not isinstance(order_ids, list):
+            order_ids = [order_ids]
 
-        res = {'acquisitions': []}
-        # Use itertool batch recipe
-        acq_ids_by_batch = zip(*([iter(sanitized_ids)] * batch_size))
-        for ids_batch in acq_ids_by_batch:
-            _process_single_batch(url, ids_batch, res)
+        self.ordering = ordering
+        self.order_ids = order_ids
+        self.on_delivered = on_delivered
+        self.max_workers = max_workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
 
-        # Process reminder
-        remain_count = len(sanitized_ids) % batch_size
-        if remain_count > 0:
-            _process_single_batch(url, sanitized_ids[-remain_count:], res)
+        # latest known state of every acquisition, keyed by acquisition id
+        self.acquisitions = {}
 
-        return res
+    @property
+    def delivered(self):
+        return bool(self.acquisitions) and all(
+            a['state'] == 'delivered' for a in self.acquisitions.values())
+
+    def events(self, timeout=None):
+        '''Poll until every acquisition reached a terminal state.
+
+           Args:
+               timeout (float): Maximum number of seconds to wait. Raises
+                                OrderTimeout when exceeded.
+
+           Returns:
+               Generator of acquisition state change events.
+        '''
+        status = with_retries(self.ordering.status, logger=self.ordering.logger)
+        poller = Poller(self.order_ids, status, self.min_interval, self.max_interval, self.max_workers)
+
+        def _timeout(pending):
+            return OrderTimeout('Orders not done after %s seconds: %s' % (timeout, ', '.join(pending)))
+
+        for order_id, acquisitions in poller.poll(timeout, _timeout):
+            changed = False
+            for acquisition in acquisitions:
+                acquisition_id = acquisition['acquisition_id']
+                previous = self.acquisitions.get(acquisition_id, {}).get('state')
+                self.acquisitions[acquisition_id] = acquisition
+                if acquisition['state'] != previous:
+                    changed = True
+                    yield {
+                        'order_id': order_id,
+                        'acquisition_id': acquisition_id,
+                        'state': acquisition['state'],
+                        'previous_state': previous,
+                        'location': acquisition.get('location')
+                    }
+
+            if acquisitions and all(a['state'] in TERMINAL_STATES for a in acquisitions):
+                poller.done(order_id)
+            elif changed:
+                poller.reset(order_id)
+
+        if self.on_delivered and self.delivered:
+            self.on_delivered(list(self.acquisitions.values()))
@@ -3,18 +3,134 @@ GBDX S3 Interface.
 
 Contact: kostas.stamatiou@digitalglobe.com
 """
+import hashlib
+import io
 import os
+import threading
+import time
 from builtins import object
 
 from boto import s3 as botos3
+from boto.s3.prefix import Prefix
+
+from gbdxtools.checkpoint import read_state, write_state
+from gbdxtools.throttle import Throttle
+
+# number of bytes fetched per ranged GET when streaming an object
+DEFAULT_READ_AHEAD = 8 * 1024 * 1024
+
+# number of bytes read from the socket at a time when downloading
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+
+# file in the download directory recording the version of every downloaded file
+DOWNLOAD_STATE = '.gbdx-downloads.state'
+
+
+def _md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(TRANSFER_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class S3Object(io.RawIOBase):
+    '''Read-only, seekable view of a single S3 object.
+
+    Every read is served by a ranged GET against the object, so nothing is
+    written to local disk. Use S3.open to get a buffered instance.
+    '''
+
+    def __init__(self, s3, key_name):
+        self._s3 = s3
+        self.name = key_name
+
+        key = s3.bucket.get_key(key_name)
+        if key is None:
+            raise IOError('No such S3 object: %s' % key_name)
+        self.size = key.size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('Invalid whence (%s)' % whence)
+
+        if pos < 0:
+            raise ValueError('Negative seek position %s' % pos)
+        self._pos = pos
+        return pos
+
+    def _get_range(self, start, end):
+        # ask the S3 instance for the bucket on every request, so refreshed
+        # credentials are picked up by long running readers
+        key = self._s3.bucket.new_key(self.name)
+        throttle = self._s3.throttle
+        with throttle.transfer():
+            data = key.get_contents_as_string(headers={'Range': 'bytes=%s-%s' % (start, end)})
+            throttle.consume(len(data))
+        return data
+
+    def readinto(self, b):
+        if self._pos >= self.size or len(b) == 0:
+            return 0
+
+        data = self._get_range(self._pos, min(self._pos + len(b), self.size) - 1)
+        n = len(data)
+        b[:n] = data
+        self._pos += n
+        return n
+
+    def readall(self):
+        # fetch the remainder of the object in one request rather than in
+        # io.DEFAULT_BUFFER_SIZE pieces
+        if self._pos >= self.size:
+            return b''
+
+        data = self._get_range(self._pos, self.size - 1)
+        self._pos += len(data)
+        return data
+
 
 class S3(object):
 
-    def __init__(self, interface):
+    def __init__(self, interface, duration=36000, refresh_margin=600, listing_ttl=0,
+                 max_bandwidth=None, max_concurrent_transfers=None):
         '''Instantiate the s3 interface
 
         Args:
             interface (Interface): A reference to the Interface that owns this instance.
+            duration (int): Lifetime in seconds of the temporary S3 credentials
+                            requested from GBDX. Default is 10 hours.
+            refresh_margin (int): Credentials are refreshed this many seconds
+                                  before they expire. Default is 10 minutes.
+            listing_ttl (int): Number of seconds the results of S3.list are
+                               cached for. Default is 0, no caching.
+            max_bandwidth (int): Limit in bytes per second shared by all
+                                 transfers of this instance. Default is unlimited.
+            max_concurrent_transfers (int): Limit on the number of objects
+                                            transferred at the same time.
+                                            Default is unlimited.
 
         Returns:
             An instance of gbdxtools.S3.
@@ -28,17 +144,45 @@ class S3(object):
         # store a ref to the logger
         self.logger = interface.logger
 
+        self.duration = duration
+        self.refresh_margin = refresh_margin
+
         self._info = None
+        self._info_expires = None
+        self._bucket = None
+
+        self.listing_ttl = listing_ttl
+        self._listings = {}
+
+        # shared by every transfer, see throttle.stats() for live counters
+        self.throttle = Throttle(max_bandwidth, max_concurrent_transfers)
+
+        # guards the credentials and the shared connection, so that parallel
+        # transfers can share a single S3 instance
+        self._lock = threading.RLock()
 
     @property
     def info(self):
-        if not self._info:
-            self._info = self._load_info()
-        return self._info
+        with self._lock:
+            if not self._info or self._credentials_expiring():
+                self.logger.debug('Getting S3 info')
+                self._info = self._load_info()
+                self._info_expires = time.time() + self.duration
+                self._bucket = None
+            return self._info
 
     @info.setter
     def info(self, value):
-        self._info = value
+        with self._lock:
+            # credentials set by hand are never refreshed
+            self._info = value
+            self._info_expires = None
+            self._bucket = None
+
+    def _credentials_expiring(self):
+        if self._info_expires is None:
+            return False
+        return time.time() >= self._info_expires - self.refresh_margin
 
     def _load_info(self):
         '''Get user info for GBDX S3, put into instance vars for convenience.
@@ -51,52 +195,201 @@ class S3(object):
             user bucket and user prefix (dict).
         '''
 
-        url = '%s/prefix?duration=36000' % self.base_url
+        url = '%s/prefix?duration=%s' % (self.base_url, self.duration)
         r = self.gbdx_connection.get(url)
         r.raise_for_status()
         return r.json()
 
-    def download(self, location, local_dir='.'):
+    @property
+    def bucket(self):
+        '''The boto bucket for the user's GBDX S3 location.
+
+        The connection is opened once and shared by all operations on this
+        instance. It is reopened transparently whenever the temporary
+        credentials are refreshed.
+
+        Returns:
+            boto.s3.bucket.Bucket
+        '''
+        with self._lock:
+            info = self.info
+            if self._bucket is None:
+                self._bucket = self._connect(info)
+            return self._bucket
+
+    def _connect(self, info):
+        session_token = info['S3_session_token']
+
+        self.logger.debug('Connecting to S3')
+        s3conn = botos3.connect_to_region('us-east-1', aws_access_key_id=info['S3_access_key'],
+                                          aws_secret_access_key=info['S3_secret_key'],
+                                          security_token=session_token)
+
+        return s3conn.get_bucket(info['bucket'], validate=False,
+                                 headers={'x-amz-security-token': session_token})
+
+    def _key_name(self, location):
+        return self.info['prefix'] + '/' + location.strip('/')
+
+    def open(self, location, read_ahead=DEFAULT_READ_AHEAD):
+        '''Open a file in bucket/prefix/location for reading without
+           downloading it first.
+
+           Args:
+               location (str): S3 location of a file within prefix
+                               (e.g., my_dir/my_detections.csv).
+               read_ahead (int): Number of bytes fetched per ranged request.
+
+           Returns:
+               A buffered, seekable, binary file-like object.
+        '''
+        raw = S3Object(self, self._key_name(location))
+        return io.BufferedReader(raw, buffer_size=read_ahead)
+
+    def iter_lines(self, location, encoding='utf-8', read_ahead=DEFAULT_READ_AHEAD):
+        '''Stream the lines of a file in bucket/prefix/location.
+
+           Args:
+               location (str): S3 location of a file within prefix.
+               encoding (str): Encoding used to decode the lines. If None,
+                               lines are returned as bytes.
+               read_ahead (int): Number of bytes fetched per ranged request.
+
+           Returns:
+               Generator of lines, without their line endings.
+        '''
+        f = self.open(location, read_ahead=read_ahead)
+
+        if encoding is None:
+            with f:
+                for line in f:
+                    yield line.rstrip(b'\r\n')
+        else:
+            with io.TextIOWrapper(f, encoding=encoding) as text:
+                for line in text:
+                    yield line.rstrip(u'\n')
+
+    def list(self, location='', recursive=True):
+        '''List the contents of bucket/prefix/location without downloading them.
+           S3 pages are requested lazily, as the generator is consumed.
+
+           Args:
+               location (str): S3 location within prefix. Can be a directory or
+                               a file. Default is the whole prefix.
+               recursive (bool): If False, only the files directly under the
+                                 location directory are listed, together with its
+                                 sub directories (keys ending with '/').
+
+           Returns:
+               Generator of dictionaries with the keys 'key' (the location of the
+               file within prefix), 'size', 'etag' and 'last_modified'.
+        '''
+        location = location.strip('/')
+
+        cached = self._cached_listing(location, recursive)
+        if cached is not None:
+            for entry in cached:
+                yield entry
+            return
+
+        entries = [] if self.listing_ttl else None
+        for entry in self._list_bucket(location, recursive):
+            if entries is not None:
+                entries.append(entry)
+            yield entry
+
+        if entries is not None:
+            with self._lock:
+                self._listings[(location, recursive)] = (time.time() + self.listing_ttl, entries)
+
+    def _list_bucket(self, location, recursive):
+        prefix = self.info['prefix'] + '/'
+        full_location = prefix + location
+
+        if recursive:
+            items = self.bucket.list(full_location)
+        else:
+            items = self.bucket.list(full_location + '/' if location else full_location, delimiter='/')
+
+        for item in items:
+            if isinstance(item, Prefix):
+                yield {'key': item.name[len(prefix):], 'size': None, 'etag': None, 'last_modified': None}
+                continue
+
+            # skip directory keys
+            if not item.name or item.name.endswith('/'):
+                continue
+
+            # a plain prefix match would also pick up siblings like my_dir2
+            if location and item.name != full_location and not item.name.startswith(full_location + '/'):
+                continue
+
+            yield {
+                'key': item.name[len(prefix):],
+                'size': item.size,
+                'etag': item.etag.strip('"') if item.etag else None,
+                'last_modified': item.last_modified
+            }
+
+    def _cached_listing(self, location, recursive):
+        if not self.listing_ttl:
+            return None
+
+        now = time.time()
+        with self._lock:
+            for (cached_location, cached_recursive), (expires, entries) in list(self._listings.items()):
+                if expires <= now:
+                    del self._listings[(cached_location, cached_recursive)]
+                    continue
+
+                if (cached_location, cached_recursive) == (location, recursive):
+                    return entries
+
+                # a recursive listing of a parent directory covers any location below it
+                if cached_recursive and recursive and (not cached_location or location.startswith(cached_location + '/')):
+                    return [e for e in entries if e['key'] == location or e['key'].startswith(location + '/')]
+
+        return None
+
+    def clear_listing_cache(self):
+        '''Forget all cached S3.list results.'''
+        with self._lock:
+            self._listings = {}
+
+    def download(self, location, local_dir='.', verify_etag=False):
         '''Download content from bucket/prefix/location.
            Location can be a directory or a file (e.g., my_dir or my_dir/my_image.tif)
            If location is a directory, all files in the directory are
            downloaded. If it is a file, then that file is downloaded.
 
+           Each file is first written to <file>.part, with its progress recorded
+           in a <file>.part.state sidecar, and only moved into place once its
+           size has been verified. The ETag and last modified time of the
+           downloaded files are recorded in local_dir/.gbdx-downloads.state.
+           Running an interrupted download again skips the files already
+           downloaded, unless the S3 object changed since, and resumes partial
+           ones.
+
            Args:
                location (str): S3 location within prefix.
                local_dir (str): Local directory where file(s) will be stored.
                                 Default is here.
+               verify_etag (bool): Also check the MD5 of each file against its
+                                   ETag (not available for multipart uploads).
+                                   Default is False.
         '''
 
-        self.logger.debug('Getting S3 info')
-        bucket = self.info['bucket']
-        prefix = self.info['prefix']
-        access_key = self.info['S3_access_key']
-        secret_key = self.info['S3_secret_key']
-        session_token = self.info['S3_session_token']
-
-        self.logger.debug('Connecting to S3')
-        s3conn = botos3.connect_to_region('us-east-1', aws_access_key_id=access_key,
-                                          aws_secret_access_key=secret_key,
-                                          security_token=session_token)
-
-        b = s3conn.get_bucket(bucket, validate=False,
-                              headers={'x-amz-security-token': session_token})
-
         # remove head and/or trail backslash from location
         location = location.strip('/')
 
-        whats_in_here = b.list(prefix + '/' + location)
+        state_path = os.path.join(local_dir, DOWNLOAD_STATE)
+        downloaded = read_state(state_path) or {}
 
         self.logger.debug('Downloading contents')
-        for key in whats_in_here:
-            # skip directory keys
-            if not key.name or key.name.endswith('/'):
-                continue
-
+        for entry in self._list_bucket(location, True):
             # get path to each file
-            filepath = key.name.replace(prefix + '/' + location, '', 1).lstrip('/')
-            filename = key.name.split('/')[-1]
+            filepath = entry['key'][len(location):].lstrip('/')
+            filename = entry['key'].split('/')[-1]
             self.logger.debug(filename)
             file_dir = filepath.split('/')[:-1]
             file_dir = '/'.join(file_dir)
@@ -107,10 +400,75 @@ class S3(object):
                 os.makedirs(full_dir)
 
             # download file
-            key.get_contents_to_filename(full_dir + '/' + filename)
+            local_path = os.path.join(file_dir, filename)
+            version = self._download_file(entry, os.path.join(full_dir, filename), verify_etag,
+                                          downloaded.get(local_path))
+            if downloaded.get(local_path) != version:
+                downloaded[local_path] = version
+                write_state(state_path, downloaded)
 
         self.logger.debug('Done!')
 
+    def _download_file(self, entry, path, verify_etag, downloaded=None):
+        # downloaded is the version of the object the local file was downloaded
+        # from, if known; returns the version of the object now in path
+        part_path = path + '.part'
+        state_path = part_path + '.state'
+        state = {'etag': entry['etag'], 'size': entry['size']}
+        version = dict(state, last_modified=entry.get('last_modified'))
+        check_etag = verify_etag and entry['etag'] and '-' not in entry['etag']
+
+        if (downloaded == version and not os.path.exists(part_path) and os.path.isfile(path) and
+                os.path.getsize(path) == entry['size']):
+            if not check_etag or _md5(path) == entry['etag']:
+                self.logger.debug('Already downloaded: ' + path)
+                return version
+
+        # resume only if the part belongs to the same version of the object
+        offset = 0
+        if os.path.isfile(part_path) and read_state(state_path) == state:
+            offset = os.path.getsize(part_path)
+            if offset > entry['size']:
+                offset = 0
+
+        write_state(state_path, state)
+
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            if offset:
+                self.logger.debug('Resuming %s at byte %s' % (path, offset))
+            if offset < entry['size']:
+                key = self.bucket.new_key(self._key_name(entry['key']))
+                self._transfer(key, f, headers={'Range': 'bytes=%s-' % offset} if offset else None)
+
+        size = os.path.getsize(part_path)
+        if size != entry['size']:
+            if size > entry['size']:
+                _remove(part_path, state_path)
+            raise IOError('Downloaded %s bytes of %s, expected %s' % (size, entry['key'], entry['size']))
+
+        if check_etag and _md5(part_path) != entry['etag']:
+            _remove(part_path, state_path)
+            raise IOError('Checksum of %s does not match its ETag %s' % (entry['key'], entry['etag']))
+
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(part_path, path)
+        os.remove(state_path)
+        return version
+
+    def _transfer(self, key, fp, headers=None):
+        with self.throttle.transfer():
+            key.open_read(headers=headers)
+            try:
+                while True:
+                    chunk = key.read(TRANSFER_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.throttle.consume(len(chunk))
+                    fp.write(chunk)
+            finally:
+                key.close()
+
     def delete(self, location):
         '''Delete content in bucket/prefix/location.
            Location can be a directory or a file (e.g., my_dir or my_dir/my_image.tif)
@@ -122,19 +480,8 @@ class S3(object):
                                a file (e.g., my_dir or my_dir/my_image.tif).
         '''
 
-        bucket = self.info['bucket']
+        b = self.bucket
         prefix = self.info['prefix']
-        access_key = self.info['S3_access_key']
-        secret_key = self.info['S3_secret_key']
-        session_token = self.info['S3_session_token']
-
-        self.logger.debug('Connecting to S3')
-        s3conn = botos3.connect_to_region('us-east-1', aws_access_key_id=access_key,
-                                      aws_secret_access_key=secret_key,
-                                      security_token=session_token)
-
-        b = s3conn.get_bucket(bucket, validate=False,
-                              headers={'x-amz-security-token': session_token})
 
         # remove head and/or trail backslash from location
         if location[0] == '/':
@@ -149,4 +496,6 @@ class S3(object):
         for key in whats_in_here:
             b.delete_key(key)
 
+        self.clear_listing_cache()
+
         self.logger.debug('Done!')
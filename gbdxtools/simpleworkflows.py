@@ -6,7 +6,12 @@ Contact: dmarino@digitalglobe.com
 from builtins import str
 from builtins import object
 
-import json, uuid
+import json, time, uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from gbdxtools.concurrency import DEFAULT_MAX_WORKERS, Backoff, interleave
+from gbdxtools.workflow import WorkflowTimeout
 
 class InvalidInputPort(AttributeError):
     pass
@@ -382,6 +387,10 @@ class Workflow(object):
         self.id = None
         self.callback = kwargs.get('callback', None )
 
+        # seconds a status is reused by the status properties before it is fetched again
+        self.status_ttl = kwargs.get('status_ttl', 5)
+        self._status_snapshot = None
+
         self.definition = None
 
         self.tasks = tasks
@@ -499,6 +508,7 @@ class Workflow(object):
         #     self.definition['tasks'].append( task.generate_task_workflow_json() )
 
         self.generate_workflow_description()
+        self._status_snapshot = None
 
         # hit batch workflow endpoint if batch values
         if self.batch_values:
@@ -510,6 +520,97 @@ class Workflow(object):
 
         return self.id
 
+    def wait(self, timeout=None, poll_policy=None):
+        '''
+        Wait for the workflow to complete, polling its status less and less often.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait. Raises WorkflowTimeout
+                             when exceeded. Default waits forever.
+            poll_policy (Backoff): Intervals between polls. Defaults to
+                                   Backoff(initial=5, maximum=60).
+
+        Returns:
+            The final status of the workflow
+        '''
+        if not self.id:
+            raise WorkflowError('Workflow is not running.  Cannot wait for it.')
+
+        policy = _poll_policy(poll_policy)
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            status = self.refresh()
+            if self._complete(status):
+                return status
+
+            delay = _next_delay(policy, deadline)
+            if delay is None:
+                raise WorkflowTimeout('Workflow %s not complete after %s seconds' % (self.id, timeout))
+            time.sleep(delay)
+
+    def wait_async(self, timeout=None, poll_policy=None, loop=None):
+        '''
+        Wait for the workflow to complete from asyncio code, like wait():
+
+            status = await workflow.wait_async(timeout=3600)
+
+        Requires asyncio (Python 3.4+). Status requests run in the default
+        executor of the event loop; no thread is held between polls. Use
+        asyncio.wait or asyncio.gather to wait for several workflows.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait. The future fails
+                             with WorkflowTimeout when exceeded.
+            poll_policy (Backoff): Intervals between polls. Defaults to
+                                   Backoff(initial=5, maximum=60).
+            loop: The asyncio event loop. Defaults to the current loop.
+
+        Returns:
+            An asyncio future resolving to the final status of the workflow
+        '''
+        import asyncio
+
+        if not self.id:
+            raise WorkflowError('Workflow is not running.  Cannot wait for it.')
+
+        loop = loop or asyncio.get_event_loop()
+        policy = _poll_policy(poll_policy)
+        deadline = time.time() + timeout if timeout is not None else None
+        result = asyncio.Future(loop=loop)
+
+        def _poll():
+            loop.run_in_executor(None, self.refresh).add_done_callback(_check)
+
+        def _check(request):
+            # the caller may have given up
+            if result.done():
+                return
+            if request.exception() is not None:
+                result.set_exception(request.exception())
+                return
+
+            status = request.result()
+            if self._complete(status):
+                result.set_result(status)
+                return
+
+            delay = _next_delay(policy, deadline)
+            if delay is None:
+                result.set_exception(WorkflowTimeout('Workflow %s not complete after %s seconds' % (self.id, timeout)))
+            else:
+                loop.call_later(delay, _poll)
+
+        _poll()
+        return result
+
+    def _complete(self, status):
+        # check if all sub workflows are either done, failed, or timedout
+        if self.batch_values:
+            return all(workflow.get("state") in ["succeeded", "failed", "timedout"] for workflow in
+                       status['workflows'])
+        else:
+            return status['state'] == 'complete'
+
     @property
     def task_ids(self):
         '''
@@ -519,22 +620,95 @@ class Workflow(object):
             None
 
         Returns:
-            List of task IDs
+            List of task IDs. For a batch workflow, a dictionary of child
+            workflow id to its list of task IDs.
         '''
         if not self.id:
             raise WorkflowError('Workflow is not running.  Cannot get task IDs.')
 
         if self.batch_values:
-            raise NotImplementedError("Query Each Workflow Id within the Batch Workflow for task IDs.")
-
-        wf = self.__interface.workflow.get(self.id)
+            return dict(self.child_results('task_ids'))
 
-        return [task['id'] for task in wf['tasks']]
+        return self._task_ids(self.id)
 
     @task_ids.setter
     def task_ids(self, value):
         raise NotImplementedError("Cannot set workflow task_ids, readonly.")
 
+    @property
+    def child_workflow_ids(self):
+        '''
+        Get the ids of the workflows of a batch workflow
+
+        Args:
+            None
+
+        Returns:
+            List of workflow ids
+        '''
+        if not self.id:
+            raise WorkflowError('Workflow is not running.  Cannot get child workflow IDs.')
+        if not self.batch_values:
+            raise WorkflowError('Workflow is not a batch workflow.')
+
+        return [workflow['workflow_id'] for workflow in self.status['workflows']]
+
+    def child_results(self, name, max_workers=DEFAULT_MAX_WORKERS):
+        '''
+        Get the task IDs, events, stdout or stderr of every workflow of a batch
+        workflow, as they arrive. The workflows are queried concurrently.
+
+        Args:
+            name (str): 'task_ids', 'events', 'stdout' or 'stderr'.
+            max_workers (int): Maximum number of workflows queried at the same time.
+
+        Returns:
+            Generator of (workflow id, result) tuples, in the order the results
+            arrive. The result is formatted like the property of the same name
+            of a single workflow.
+        '''
+        fetchers = {
+            'task_ids': self._task_ids,
+            'events': self.__interface.workflow.events,
+            'stdout': lambda workflow_id: self._task_outputs(workflow_id, 'stdout'),
+            'stderr': lambda workflow_id: self._task_outputs(workflow_id, 'stderr'),
+        }
+        if name not in fetchers:
+            raise ValueError('Unknown workflow result %s, expected one of %s' % (name, ', '.join(sorted(fetchers))))
+        fetch = fetchers[name]
+
+        if self.batch_values:
+            workflow_ids = self.child_workflow_ids
+        elif self.id:
+            workflow_ids = [self.id]
+        else:
+            raise WorkflowError('Workflow is not running.  Cannot get %s.' % name)
+
+        sources = [lambda workflow_id=workflow_id: [(workflow_id, fetch(workflow_id))]
+                   for workflow_id in workflow_ids]
+        return interleave(sources, max_workers=max_workers)
+
+    def _task_ids(self, workflow_id):
+        wf = self.__interface.workflow.get(workflow_id)
+        return [task['id'] for task in wf['tasks']]
+
+    def _task_outputs(self, workflow_id, stream):
+        wf = self.__interface.workflow.get(workflow_id)
+        get_output = getattr(self.__interface.workflow, 'get_' + stream)
+
+        output_list = []
+        for task in wf['tasks']:
+            output_list.append(
+                {
+                    'id': task['id'],
+                    'taskType': task['taskType'],
+                    'name': task['name'],
+                    stream: get_output(workflow_id, task['id'])
+                }
+            )
+
+        return output_list
+
 
     def cancel(self):
         '''
@@ -553,9 +727,20 @@ class Workflow(object):
             self.__interface.workflow.batch_workflow_cancel(self.id)
         else:
             self.__interface.workflow.cancel(self.id)
+        self._status_snapshot = None
 
-    @property
-    def status(self):
+    def refresh(self):
+        '''
+        Fetch the status of the workflow now. The status properties (status,
+        complete, succeeded, failed, ...) reuse the fetched status for
+        status_ttl seconds.
+
+        Args:
+            None
+
+        Returns:
+            The status of the workflow
+        '''
         if not self.id:
             raise WorkflowError('Workflow is not running.  Cannot check status.')
 
@@ -564,8 +749,21 @@ class Workflow(object):
         else:
             status = self.__interface.workflow.status(self.id)
 
+        self._status_snapshot = (self.id, time.time(), status)
         return status
 
+    @property
+    def status(self):
+        if not self.id:
+            raise WorkflowError('Workflow is not running.  Cannot check status.')
+
+        # the snapshot is dropped if the workflow id was changed since
+        snapshot = self._status_snapshot
+        if snapshot is not None and snapshot[0] == self.id and time.time() - snapshot[1] < self.status_ttl:
+            return snapshot[2]
+
+        return self.refresh()
+
     @status.setter
     def status(self, value):
         raise NotImplementedError("Cannot set workflow status, readonly.")
@@ -574,8 +772,9 @@ class Workflow(object):
     def events(self):
         if not self.id:
             raise WorkflowError('Workflow is not running.  Cannot check status.')
+        # a dictionary of child workflow id to events for batch workflows
         if self.batch_values:
-            raise NotImplementedError("Query Each Workflow Id within the Batch Workflow for Events")
+            return dict(self.child_results('events'))
         return self.__interface.workflow.events(self.id)
 
     @events.setter
@@ -587,12 +786,7 @@ class Workflow(object):
         if not self.id:
             return False
 
-        # check if all sub workflows are either done, failed, or timedout
-        if self.batch_values:
-            return all(workflow.get("state") in ["succeeded", "failed", "timedout"] for workflow in
-                       self.status['workflows'])
-        else:
-            return self.status['state'] == 'complete'
+        return self._complete(self.status)
 
     @complete.setter
     def complete(self, value):
@@ -602,8 +796,11 @@ class Workflow(object):
     def failed(self):
         if not self.id:
             return False
+
+        # check if any sub workflow failed
         if self.batch_values:
-            raise NotImplementedError("Query Each Workflow Id within the Batch Workflow for Current State")
+            return any(workflow.get("state") == "failed" for workflow in self.status['workflows'])
+
         status = self.status
         return status['state'] == 'complete' and status['event'] == 'failed'
 
@@ -677,7 +874,8 @@ class Workflow(object):
             None
 
         Returns:
-            List of tasks with their stdout, formatted like this:
+            List of tasks with their stdout, formatted like this (for a batch
+            workflow, a dictionary of child workflow id to such a list):
             [
                 {
                     "id": "4488895771403082552",
@@ -690,22 +888,9 @@ class Workflow(object):
         if not self.id:
             raise WorkflowError('Workflow is not running.  Cannot get stdout.')
         if self.batch_values:
-            raise NotImplementedError("Query Each Workflow Id within the Batch Workflow for stdout.")
-
-        wf = self.__interface.workflow.get(self.id)
-
-        stdout_list = []
-        for task in wf['tasks']:
-            stdout_list.append(
-                {
-                    'id': task['id'],
-                    'taskType': task['taskType'],
-                    'name': task['name'],
-                    'stdout': self.__interface.workflow.get_stdout(self.id, task['id'])
-                }
-            )
+            return dict(self.child_results('stdout'))
 
-        return stdout_list
+        return self._task_outputs(self.id, 'stdout')
 
     @stdout.setter
     def stdout(self, value):
@@ -720,7 +905,8 @@ class Workflow(object):
             None
 
         Returns:
-            List of tasks with their stderr, formatted like this:
+            List of tasks with their stderr, formatted like this (for a batch
+            workflow, a dictionary of child workflow id to such a list):
             [
                 {
                     "id": "4488895771403082552",
@@ -733,26 +919,91 @@ class Workflow(object):
         if not self.id:
             raise WorkflowError('Workflow is not running.  Cannot get stderr.')
         if self.batch_values:
-            raise NotImplementedError("Query Each Workflow Id within the Batch Workflow for stderr.")
+            return dict(self.child_results('stderr'))
 
-        wf = self.__interface.workflow.get(self.id)
-
-        stderr_list = []
-        for task in wf['tasks']:
-            stderr_list.append(
-                {
-                    'id': task['id'],
-                    'taskType': task['taskType'],
-                    'name': task['name'],
-                    'stderr': self.__interface.workflow.get_stderr(self.id, task['id'])
-                }
-            )
-
-        return stderr_list
+        return self._task_outputs(self.id, 'stderr')
 
     @stderr.setter
     def stderr(self, value):
         raise NotImplementedError("Cannot set workflow stderr, readonly.")
 
 
+def _poll_policy(poll_policy):
+    if poll_policy is None:
+        return Backoff(initial=5, maximum=60)
+    poll_policy.reset()
+    return poll_policy
+
 
+def _next_delay(policy, deadline):
+    # seconds until the next poll, or None once the deadline has passed
+    if deadline is None:
+        return policy.delay()
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        return None
+    return min(policy.delay(), remaining)
+
+
+def _wait_many(workflows, timeout, poll_policy, max_workers, first):
+    policy = _poll_policy(poll_policy)
+    deadline = time.time() + timeout if timeout is not None else None
+    statuses = {}
+    pending = list(range(len(workflows)))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            polling = list(pending)
+            for i, status in zip(polling, executor.map(lambda i: workflows[i].refresh(), polling)):
+                if workflows[i]._complete(status):
+                    statuses[i] = status
+                    pending.remove(i)
+
+            if first and statuses:
+                return workflows[min(statuses)]
+            if not pending:
+                return [statuses[i] for i in range(len(workflows))]
+
+            delay = _next_delay(policy, deadline)
+            if delay is None:
+                raise WorkflowTimeout('Workflows not complete after %s seconds: %s'
+                                      % (timeout, ', '.join(str(workflows[i].id) for i in pending)))
+            time.sleep(delay)
+
+
+def wait_all(workflows, timeout=None, poll_policy=None, max_workers=DEFAULT_MAX_WORKERS):
+    '''
+    Wait for several workflows to complete. The workflows still running are
+    polled concurrently.
+
+    Args:
+        workflows (list): Executed Workflow objects.
+        timeout (float): Maximum number of seconds to wait. Raises WorkflowTimeout
+                         when exceeded. Default waits forever.
+        poll_policy (Backoff): Intervals between polls. Defaults to
+                               Backoff(initial=5, maximum=60).
+        max_workers (int): Maximum number of workflows polled at the same time.
+
+    Returns:
+        The final statuses of the workflows, in the order given
+    '''
+    return _wait_many(workflows, timeout, poll_policy, max_workers, first=False)
+
+
+def wait_any(workflows, timeout=None, poll_policy=None, max_workers=DEFAULT_MAX_WORKERS):
+    '''
+    Wait for the first of several workflows to complete. The workflows are
+    polled concurrently.
+
+    Args:
+        workflows (list): Executed Workflow objects.
+        timeout (float): Maximum number of seconds to wait. Raises WorkflowTimeout
+                         when exceeded. Default waits forever.
+        poll_policy (Backoff): Intervals between polls. Defaults to
+                               Backoff(initial=5, maximum=60).
+        max_workers (int): Maximum number of workflows polled at the same time.
+
+    Returns:
+        The first workflow found complete
+    '''
+    return _wait_many(workflows, timeout, poll_policy, max_workers, first=True)
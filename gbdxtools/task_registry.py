@@ -4,11 +4,37 @@ GBDX Task Registry interface.
 Contact: dmitry.zviagintsev@digitalglobe.com
 """
 
+import copy
 import json
+import os
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from gbdxtools.concurrency import DEFAULT_MAX_WORKERS
 
 
 class TaskRegistry(object):
-    def __init__(self, interface):
+    def __init__(self, interface, definition_ttl=300, cache_path=None):
+        """Construct the TaskRegistry interface class.
+
+        Task definitions are cached: a definition younger than definition_ttl
+        is used as is, an older one is revalidated with its ETag.
+
+        Args:
+            interface: A reference to the GBDX Interface.
+            definition_ttl (int): Number of seconds a cached task definition is
+                                  used for without asking the API. Default 5 minutes.
+                                  None uses cached definitions forever.
+            cache_path (str): Optional JSON file the definitions are also cached
+                              in. Processes sharing it merge their definitions
+                              into it on every save.
+
+        Returns:
+            An instance of the TaskRegistry interface class.
+        """
         self._base_url = '%s/workflows/v1/tasks' % interface.root_url
 
         # store a reference to the GBDX Connection
@@ -20,6 +46,12 @@ class TaskRegistry(object):
         # the logger
         self.logger = interface.logger
 
+        self.definition_ttl = definition_ttl
+        self.cache_path = cache_path
+        self._definitions = {}
+        self._loaded_path = None
+        self._lock = threading.RLock()
+
     def list(self):
         """Lists available and visible GBDX tasks.
 
@@ -52,6 +84,8 @@ class TaskRegistry(object):
 
         r = self.gbdx_connection.post(self._base_url, json=task_json)
         r.raise_for_status()
+        if isinstance(task_json, dict):
+            self._invalidate(task_json.get('name', ''))
 
         return r.text
 
@@ -64,10 +98,124 @@ class TaskRegistry(object):
         Returns:
             Dictionary representing the task definition.
         """
-        r = self.gbdx_connection.get(self._base_url + '/' + task_name)
-        r.raise_for_status()
+        return copy.deepcopy(self._definition(task_name)['definition'])
 
-        return r.json()
+    def prefetch(self, task_names, max_workers=DEFAULT_MAX_WORKERS):
+        """Loads many task definitions into the cache, several at a time.
+
+        Args:
+            task_names (list): Task names.
+            max_workers (int): Maximum number of definitions fetched at the same time.
+
+        Returns:
+            Dictionary of task name to task definition.
+        """
+        task_names = list(task_names)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            entries = list(executor.map(lambda name: self._definition(name, save=False), task_names))
+
+        with self._lock:
+            self._save()
+        return dict((name, copy.deepcopy(entry['definition'])) for name, entry in zip(task_names, entries))
+
+    def snapshot(self, path=None, max_workers=DEFAULT_MAX_WORKERS):
+        """Caches the definitions of all the tasks returned by list() and saves
+        them, so that workers can build workflows without calling the API:
+
+            gbdx.task_registry.snapshot('tasks.json')
+
+            # on the workers
+            gbdx.task_registry.cache_path = 'tasks.json'
+            gbdx.task_registry.definition_ttl = None
+
+        Args:
+            path (str): File the definitions are saved to. Becomes the cache_path.
+                        Defaults to the current cache_path.
+            max_workers (int): Maximum number of definitions fetched at the same time.
+
+        Returns:
+            Dictionary of task name to task definition.
+        """
+        if path:
+            self.cache_path = path
+        return self.prefetch(self.list(), max_workers=max_workers)
+
+    def _definition(self, task_name, save=True):
+        # the cache entry of a task, fetched or revalidated if needed
+        with self._lock:
+            self._load()
+            entry = self._definitions.get(task_name)
+        if entry and (self.definition_ttl is None or time.time() - entry['fetched'] < self.definition_ttl):
+            return entry
+
+        headers = {'If-None-Match': entry['etag']} if entry and entry.get('etag') else None
+        r = self.gbdx_connection.get(self._base_url + '/' + task_name, headers=headers)
+        if entry and r.status_code == 304:
+            entry = dict(entry, fetched=time.time())
+        else:
+            r.raise_for_status()
+            entry = {'definition': r.json(), 'etag': r.headers.get('ETag'), 'fetched': time.time()}
+
+        with self._lock:
+            self._definitions[task_name] = entry
+            if save:
+                self._save()
+        return entry
+
+    def clear_cache(self):
+        """Forget all the cached task definitions."""
+        with self._lock:
+            self._definitions = {}
+            self._save(merge=False)
+
+    def _invalidate(self, task_name):
+        # drop the task, whether cached by name or by name:version
+        name = task_name.split(':')[0]
+        with self._lock:
+            self._load()
+            for cached_name in list(self._definitions):
+                if cached_name.split(':')[0] == name:
+                    del self._definitions[cached_name]
+            self._save(dropped=name)
+
+    def _load(self):
+        if not self.cache_path or self._loaded_path == self.cache_path:
+            return
+        self._loaded_path = self.cache_path
+        self._definitions.update(self._read())
+
+    def _read(self):
+        try:
+            with open(os.path.expanduser(self.cache_path)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, merge=True, dropped=None):
+        # the cache file is only an optimization: failing to write it is not an error
+        if not self.cache_path:
+            return
+        path = os.path.expanduser(self.cache_path)
+        try:
+            if merge:
+                # keep the definitions other processes saved since, unless older than ours
+                for name, entry in self._read().items():
+                    if dropped and name.split(':')[0] == dropped:
+                        continue
+                    current = self._definitions.get(name)
+                    if current is None or entry.get('fetched', 0) > current['fetched']:
+                        self._definitions[name] = entry
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self._definitions, f)
+                _replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            self.logger.debug('Could not save the task definition cache %s: %s' % (path, e))
 
     def delete(self, task_name):
         """Deletes a GBDX task.
@@ -80,6 +228,7 @@ class TaskRegistry(object):
         """
         r = self.gbdx_connection.delete(self._base_url + '/' + task_name)
         r.raise_for_status()
+        self._invalidate(task_name)
 
         return r.text
 
@@ -95,5 +244,17 @@ class TaskRegistry(object):
         """
         r = self.gbdx_connection.put(self._base_url + '/' + task_name, json=task_json)
         r.raise_for_status()
+        self._invalidate(task_name)
 
         return r.json()
+
+
+def _replace(src, dst):
+    # renaming over an existing file is atomic on POSIX, but fails on Windows
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
@@ -0,0 +1,136 @@
+"""
+Rate and concurrency limits shared between threads.
+"""
+from builtins import object
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity=None):
+        '''A token bucket that can be shared between threads.
+
+        Args:
+            rate (float): Number of tokens added to the bucket per second.
+            capacity (float): Maximum number of tokens the bucket holds, i.e. the
+                              largest burst allowed. Defaults to one second worth
+                              of tokens.
+
+        Returns:
+            An instance of TokenBucket.
+        '''
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        '''Take tokens out of the bucket, blocking until they are available.
+
+        Requests larger than the capacity are allowed; the bucket goes into
+        debt and the caller waits until it is paid back. Callers are served
+        in the order they asked.
+
+        Args:
+            tokens (float): Number of tokens to take.
+
+        Returns:
+            Number of seconds the caller was blocked for (float).
+        '''
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Throttle(object):
+
+    def __init__(self, max_bandwidth=None, max_concurrent_transfers=None):
+        '''Bandwidth and concurrency limits for transfers, with live counters.
+
+        Args:
+            max_bandwidth (int): Maximum number of bytes per second, summed over
+                                 all transfers. None means unlimited.
+            max_concurrent_transfers (int): Maximum number of transfers running at
+                                            the same time. None means unlimited.
+
+        Returns:
+            An instance of Throttle.
+        '''
+        self.max_bandwidth = max_bandwidth
+        self.max_concurrent_transfers = max_concurrent_transfers
+
+        self._bucket = TokenBucket(max_bandwidth) if max_bandwidth else None
+        self._slots = threading.BoundedSemaphore(max_concurrent_transfers) if max_concurrent_transfers else None
+
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._completed = 0
+        self._active = 0
+        self._busy_seconds = 0.0
+        self._busy_since = None
+
+    @contextmanager
+    def transfer(self):
+        '''Context manager wrapping a single transfer. Blocks until a transfer
+        slot is free.'''
+        if self._slots:
+            self._slots.acquire()
+
+        with self._lock:
+            if self._active == 0:
+                self._busy_since = time.time()
+            self._active += 1
+
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._completed += 1
+                if self._active == 0:
+                    self._busy_seconds += time.time() - self._busy_since
+                    self._busy_since = None
+
+            if self._slots:
+                self._slots.release()
+
+    def consume(self, nbytes):
+        '''Account for nbytes transferred, blocking as needed to stay under
+        max_bandwidth.'''
+        with self._lock:
+            self._bytes += nbytes
+
+        if self._bucket:
+            self._bucket.consume(nbytes)
+
+    def stats(self):
+        '''Live transfer counters.
+
+        Returns:
+            Dictionary with the keys 'bytes_transferred', 'transfers_completed',
+            'active_transfers', 'busy_seconds' (time during which at least one
+            transfer was running) and 'throughput' (bytes per busy second).
+        '''
+        with self._lock:
+            busy = self._busy_seconds
+            if self._busy_since is not None:
+                busy += time.time() - self._busy_since
+
+            return {
+                'bytes_transferred': self._bytes,
+                'transfers_completed': self._completed,
+                'active_transfers': self._active,
+                'busy_seconds': busy,
+                'throughput': self._bytes / busy if busy > 0 else 0.0
+            }
@@ -0,0 +1,146 @@
+"""
+Local cache of vector service query results.
+"""
+from builtins import object
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from gbdxtools.vector_io import geometry_bounds
+
+
+class VectorCache(object):
+
+    def __init__(self, path='~/.gbdx-vectors.db', ttl=3600):
+        '''An on-disk cache of queried vectors, spatially indexed with a SQLite
+        R-tree.
+
+        Attach it to the Vectors interface to answer repeated queries locally:
+
+            gbdx.vectors.cache = VectorCache()
+
+        Once a query string has been run over an area, later runs of the same
+        query over an area inside it are answered from the cache, until the
+        results are older than ttl.
+
+        Args:
+            path (str): Path of the SQLite database. Created if needed.
+            ttl (int): Number of seconds cached results are used for.
+                       Default is one hour.
+
+        Returns:
+            An instance of VectorCache.
+        '''
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS extents ('
+                             'query TEXT, west REAL, south REAL, east REAL, north REAL, started REAL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS vectors ('
+                             'id INTEGER PRIMARY KEY, query TEXT, vector_id TEXT, feature TEXT, fetched REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS vectors_query ON vectors (query, vector_id)')
+            self._db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS vector_bounds USING rtree('
+                             'id, west, east, south, north)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def lookup(self, query, bounds):
+        '''Answer a query from the cache.
+
+        Args:
+            query (str): The query string.
+            bounds (tuple): The area searched (W, S, E, N).
+
+        Returns:
+            List of the cached vectors intersecting bounds, or None if the area
+            is not inside an area fetched less than ttl seconds ago.
+        '''
+        left, lower, right, upper = bounds
+        with self._lock:
+            extent = self._db.execute(
+                'SELECT MAX(started) FROM extents WHERE query = ? AND west <= ? AND south <= ? '
+                'AND east >= ? AND north >= ? AND started >= ?',
+                (query, left, lower, right, upper, time.time() - self.ttl)).fetchone()[0]
+            if extent is None:
+                return None
+
+            # vectors not refreshed by the fetch of the extent no longer exist
+            rows = self._db.execute(
+                'SELECT feature FROM vectors JOIN vector_bounds ON vectors.id = vector_bounds.id '
+                'WHERE query = ? AND fetched >= ? AND vector_bounds.west <= ? AND vector_bounds.east >= ? '
+                'AND vector_bounds.south <= ? AND vector_bounds.north >= ? ORDER BY vectors.id',
+                (query, extent, right, left, upper, lower)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def add(self, query, vectors):
+        '''Store vectors returned by a query.
+
+        Args:
+            query (str): The query string.
+            vectors (list): The vectors.
+        '''
+        now = time.time()
+        with self._lock, self._db:
+            for vector in vectors:
+                bounds = geometry_bounds(vector.get('geometry'))
+                if bounds is None:
+                    continue
+                left, lower, right, upper = bounds
+                vector_id = (vector.get('properties') or {}).get('id', vector.get('id'))
+
+                row = None
+                if vector_id is not None:
+                    row = self._db.execute('SELECT id FROM vectors WHERE query = ? AND vector_id = ?',
+                                           (query, vector_id)).fetchone()
+                if row is None:
+                    rowid = self._db.execute('INSERT INTO vectors (query, vector_id, feature, fetched) '
+                                             'VALUES (?, ?, ?, ?)',
+                                             (query, vector_id, json.dumps(vector), now)).lastrowid
+                    self._db.execute('INSERT INTO vector_bounds VALUES (?, ?, ?, ?, ?)',
+                                     (rowid, left, right, lower, upper))
+                else:
+                    self._db.execute('UPDATE vectors SET feature = ?, fetched = ? WHERE id = ?',
+                                     (json.dumps(vector), now, row[0]))
+                    self._db.execute('UPDATE vector_bounds SET west = ?, east = ?, south = ?, north = ? '
+                                     'WHERE id = ?', (left, right, lower, upper, row[0]))
+
+    def add_extent(self, query, bounds, started):
+        '''Record that all the results of a query over an area were stored.
+
+        Args:
+            query (str): The query string.
+            bounds (tuple): The area searched (W, S, E, N).
+            started (float): When the query started, as a timestamp.
+        '''
+        left, lower, right, upper = bounds
+        with self._lock, self._db:
+            # vectors inside the area that the query did not return again were deleted
+            stale = ('SELECT vectors.id FROM vectors JOIN vector_bounds ON vectors.id = vector_bounds.id '
+                     'WHERE query = ? AND fetched < ? AND vector_bounds.west >= ? AND vector_bounds.east <= ? '
+                     'AND vector_bounds.south >= ? AND vector_bounds.north <= ?')
+            ids = [row[0] for row in self._db.execute(stale, (query, started, left, right, lower, upper))]
+            self._db.executemany('DELETE FROM vector_bounds WHERE id = ?', [(i,) for i in ids])
+            self._db.executemany('DELETE FROM vectors WHERE id = ?', [(i,) for i in ids])
+
+            self._db.execute('INSERT INTO extents VALUES (?, ?, ?, ?, ?, ?)',
+                             (query, left, lower, right, upper, started))
+            self._purge(time.time() - self.ttl)
+
+    def clear(self):
+        '''Empty the cache.'''
+        with self._lock, self._db:
+            self._purge(float('inf'))
+
+    def _purge(self, oldest):
+        self._db.execute('DELETE FROM extents WHERE started < ?', (oldest,))
+        self._db.execute('DELETE FROM vector_bounds WHERE id IN (SELECT id FROM vectors WHERE fetched < ?)',
+                         (oldest,))
+        self._db.execute('DELETE FROM vectors WHERE fetched < ?', (oldest,))
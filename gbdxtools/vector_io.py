@@ -0,0 +1,300 @@
+"""
+Streaming readers and writers for vector files.
+"""
+from builtins import object
+
+import io
+import json
+import os
+
+from geomet import wkb, wkt
+
+# number of characters read from disk at a time
+READ_SIZE = 1024 * 1024
+
+
+def iter_geojson_features(path, read_size=READ_SIZE):
+    '''Read the features of a GeoJSON file one at a time, without loading the
+    whole file in memory.
+
+    Both GeoJSON FeatureCollections and newline delimited GeoJSON (one feature
+    per line, optionally RFC 8142 record separated) are supported.
+
+    Args:
+        path (str): Path of the GeoJSON file.
+        read_size (int): Number of characters read from disk at a time.
+
+    Returns:
+        Generator of features (dict).
+    '''
+    with io.open(path, encoding='utf-8') as f:
+        buf, pos, collection = _scan_first_value(f, read_size)
+        if collection:
+            values = _iter_values(f, buf, pos, read_size, u' \t\r\n,', u']')
+        else:
+            values = _iter_values(f, buf, pos, read_size, u' \t\r\n\x1e', None)
+        for feature in values:
+            yield feature
+
+
+def _scan_first_value(f, read_size):
+    # Tell a FeatureCollection from newline delimited GeoJSON by scanning the
+    # first top level value: either its "features" array opens, or the value
+    # ends and must be a Feature. Returns the buffer, the position to decode
+    # values from, and whether they are the features of a collection.
+    buf = f.read(read_size)
+    pos = 0
+    depth = 0
+    in_string = escape = False
+    start = string_start = last_string = key = None
+    while True:
+        if pos >= len(buf):
+            more = f.read(read_size)
+            if not more:
+                raise ValueError('No "features" array found in GeoJSON')
+            buf += more
+
+        c = buf[pos]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == u'\\':
+                escape = True
+            elif c == u'"':
+                in_string = False
+                if depth == 1:
+                    last_string = buf[string_start:pos]
+        elif start is None:
+            # leading whitespace and record separators
+            if c == u'{':
+                start = pos
+                depth = 1
+            elif c not in u' \t\r\n\x1e':
+                raise ValueError('No "features" array found in GeoJSON')
+        elif c == u'"':
+            in_string = True
+            string_start = pos + 1
+        elif c == u'[' and depth == 1 and key == u'features':
+            return buf[pos + 1:], 0, True
+        elif c in u'{[':
+            depth += 1
+        elif c in u'}]':
+            depth -= 1
+            if depth == 0:
+                first = json.loads(buf[start:pos + 1])
+                if first.get('type') != 'Feature':
+                    raise ValueError('No "features" array found in GeoJSON')
+                return buf[start:], 0, False
+        elif c == u':' and depth == 1:
+            key = last_string
+        elif c == u',':
+            key = None
+        pos += 1
+
+
+def _iter_values(f, buf, pos, read_size, separators, end):
+    # decode JSON values one by one, reading more of the file as needed, until
+    # the end character (or the end of the file if end is None)
+    decoder = json.JSONDecoder()
+    while True:
+        while True:
+            while pos < len(buf) and buf[pos] in separators:
+                pos += 1
+            if pos < len(buf):
+                break
+            buf = f.read(read_size)
+            pos = 0
+            if not buf:
+                if end is None:
+                    return
+                raise ValueError('Unterminated "features" array in GeoJSON')
+
+        if buf[pos] == end:
+            return
+
+        while True:
+            try:
+                value, stop = decoder.raw_decode(buf, pos)
+                break
+            except ValueError:
+                # the value continues past the end of the buffer
+                more = f.read(read_size)
+                if not more:
+                    raise
+                buf = buf[pos:] + more
+                pos = 0
+
+        yield value
+        pos = stop
+        if pos > read_size:
+            buf = buf[pos:]
+            pos = 0
+
+
+# columns written by the tabular (CSV and Parquet) writers, besides the geometry
+COLUMNS = ('id', 'item_type', 'ingest_source', 'item_date', 'name', 'text', 'attributes')
+
+FORMATS = {
+    '.geojson': 'geojson',
+    '.ndjson': 'geojson',
+    '.json': 'geojson',
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+}
+
+
+def format_from_path(path):
+    '''The export format matching the extension of path: "geojson", "csv" or "parquet".'''
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError('Cannot tell the export format of %s, expected one of %s' % (path, ', '.join(sorted(FORMATS))))
+    return FORMATS[ext]
+
+
+def open_writer(path, format, offset=0):
+    '''Open a vector file writer.
+
+    Args:
+        path (str): Path of the file.
+        format (str): "geojson" (newline delimited GeoJSON), "csv" (geometry
+                      as WKT) or "parquet" (geometry as WKB).
+        offset (int): Byte offset to resume writing at. The file is truncated
+                      there; previous content is kept. Not supported by Parquet.
+
+    Returns:
+        A writer with write(vectors), flush() (returning the byte offset of
+        the data written so far) and close() methods.
+    '''
+    writers = {'geojson': GeoJSONWriter, 'csv': CSVWriter, 'parquet': ParquetWriter}
+    if format not in writers:
+        raise ValueError('Unknown vector format %s, expected one of %s' % (format, ', '.join(sorted(writers))))
+    return writers[format](path, offset)
+
+
+def _positions(coordinates):
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+    else:
+        for c in coordinates:
+            for position in _positions(c):
+                yield position
+
+
+def geometry_bounds(geometry):
+    '''The bounds (W, S, E, N) of a GeoJSON geometry, or None if it is empty.'''
+    if not geometry:
+        return None
+    if geometry.get('type') == 'GeometryCollection':
+        positions = [p for g in geometry['geometries'] for p in _positions(g.get('coordinates') or [])]
+    else:
+        positions = list(_positions(geometry.get('coordinates') or []))
+    if not positions:
+        return None
+    xs = [p[0] for p in positions]
+    ys = [p[1] for p in positions]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _property_values(vector):
+    properties = vector.get('properties') or {}
+    values = []
+    for column in COLUMNS:
+        value = properties.get(column)
+        if column == 'id' and value is None:
+            value = vector.get('id')
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        values.append(value)
+    return values
+
+
+def _text(value):
+    if value is None or isinstance(value, type(u'')):
+        return value
+    return value.decode('utf-8') if isinstance(value, bytes) else u'%s' % value
+
+
+def _csv_field(value):
+    if value is None:
+        return u''
+    value = _text(value)
+    if any(c in value for c in u',"\r\n'):
+        value = u'"%s"' % value.replace(u'"', u'""')
+    return value
+
+
+class _FileWriter(object):
+
+    def __init__(self, path, offset=0):
+        if offset and os.path.exists(path):
+            self._file = io.open(path, 'r+b')
+            self._file.truncate(offset)
+            self._file.seek(offset)
+        else:
+            self._file = io.open(path, 'wb')
+            self._start()
+
+    def _start(self):
+        pass
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+class GeoJSONWriter(_FileWriter):
+    '''Writes vectors as newline delimited GeoJSON, one feature per line.'''
+
+    def write(self, vectors):
+        self._file.write(b''.join((json.dumps(v) + '\n').encode('utf-8') for v in vectors))
+
+
+class CSVWriter(_FileWriter):
+    '''Writes vectors as CSV rows, with the geometry as WKT. Nested values
+    (item_type lists, attributes) are JSON encoded.'''
+
+    def _start(self):
+        self._file.write((u','.join(COLUMNS + ('wkt',)) + u'\n').encode('utf-8'))
+
+    def write(self, vectors):
+        lines = []
+        for vector in vectors:
+            geometry = wkt.dumps(vector['geometry']) if vector.get('geometry') else None
+            lines.append(u','.join(_csv_field(v) for v in _property_values(vector) + [geometry]) + u'\n')
+        self._file.write(u''.join(lines).encode('utf-8'))
+
+
+class ParquetWriter(object):
+    '''Writes vectors to a Parquet file, one row group per write, with the
+    geometry as WKB. Requires pyarrow.'''
+
+    def __init__(self, path, offset=0):
+        if offset:
+            raise ValueError('Parquet files cannot be resumed')
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Writing Parquet files requires pyarrow')
+
+        self._pa = pyarrow
+        fields = [pyarrow.field(column, pyarrow.string()) for column in COLUMNS]
+        self._schema = pyarrow.schema(fields + [pyarrow.field('wkb', pyarrow.binary())])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+
+    def write(self, vectors):
+        rows = [_property_values(v) for v in vectors]
+        columns = [[_text(row[i]) for row in rows] for i in range(len(COLUMNS))]
+        columns.append([wkb.dumps(v['geometry']) if v.get('geometry') else None for v in vectors])
+        arrays = [self._pa.array(values, type=field.type) for values, field in zip(columns, self._schema)]
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self._schema))
+
+    def flush(self):
+        return None
+
+    def close(self):
+        self._writer.close()
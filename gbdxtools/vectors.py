@@ -6,10 +6,254 @@ Contact: nate.ricklin@digitalglobe.com
 #from __future__ import absolute_import
 from builtins import object
 
+import os
+import re
+import time
 import requests
 from pygeoif import geometry
 from geomet import wkt as wkt2geojson
 import json
+from collections import deque
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from gbdxtools.catalog_search_aoi import geometries_intersect, tile_bounds
+from gbdxtools.checkpoint import read_state, write_state
+from gbdxtools.concurrency import DEFAULT_MAX_WORKERS, interleave, is_retryable_post, read_ahead, with_retries
+from gbdxtools.vector_io import format_from_path, geometry_bounds, iter_geojson_features, open_writer
+
+
+def _validate(vector):
+    # validate it has item_type and ingest_source in properties
+    if 'properties' not in vector:
+        raise Exception('Vector does not contain "properties" field.')
+
+    if 'item_type' not in vector['properties']:
+        raise Exception('Vector does not contain "item_type".')
+
+    if 'ingest_source' not in vector['properties']:
+        raise Exception('Vector does not contain "ingest_source".')
+
+
+def _chunk_payloads(vectors, chunk_size, max_bytes):
+    # serialize each vector once and group them into json array request bodies
+    chunk, size = [], 2
+    for vector in vectors:
+        _validate(vector)
+        serialized = json.dumps(vector)
+        if chunk and (len(chunk) >= chunk_size or size + len(serialized) + 1 > max_bytes):
+            yield '[' + ','.join(chunk) + ']'
+            chunk, size = [], 2
+        chunk.append(serialized)
+        size += len(serialized) + 1
+
+    if chunk:
+        yield '[' + ','.join(chunk) + ']'
+
+
+_WKT_TYPES = {
+    'POINT': 'Point',
+    'LINESTRING': 'LineString',
+    'POLYGON': 'Polygon',
+    'MULTIPOINT': 'MultiPoint',
+    'MULTILINESTRING': 'MultiLineString',
+    'MULTIPOLYGON': 'MultiPolygon',
+}
+_WKT_POSITION = re.compile(r'([^\s,\[\]]+)\s+([^\s,\[\]]+)')
+
+
+def _wkt_to_geojson(wkt):
+    # turn the coordinates of 2D WKT into JSON and let the json module parse
+    # them; anything else (Z/M coordinates, EMPTY, collections) goes to geomet
+    text = wkt.strip()
+    paren = text.find('(')
+    geometry_type = _WKT_TYPES.get(text[:paren].strip().upper()) if paren > 0 else None
+    if geometry_type is None:
+        return wkt2geojson.loads(wkt)
+
+    try:
+        coordinates = json.loads(_WKT_POSITION.sub(r'[\1,\2]', text[paren:].replace('(', '[').replace(')', ']')))
+    except ValueError:
+        return wkt2geojson.loads(wkt)
+
+    if geometry_type == 'Point':
+        coordinates = coordinates[0]
+    elif geometry_type == 'MultiPoint' and coordinates and isinstance(coordinates[0][0], list):
+        coordinates = [c[0] for c in coordinates]
+    return {'type': geometry_type, 'coordinates': coordinates}
+
+
+def _paging_expired(error):
+    # the paging service answers 404 for unknown or expired paging ids
+    response = error.response
+    return response is not None and response.status_code == 404
+
+
+def _skip_delivered(pages, skip):
+    # (vectors, page) for the pages of _pages, without the first skip vectors:
+    # a query run again after an interruption skips what it delivered before
+    for page, _ in pages:
+        vectors = page['data']
+        if skip:
+            vectors, skip = vectors[skip:], max(0, skip - len(vectors))
+        yield vectors, page
+
+
+def _inside(bounds, partition):
+    # whether bounds cannot touch any other tile than partition
+    return (partition[0] < bounds[0] and bounds[2] < partition[2] and
+            partition[1] < bounds[1] and bounds[3] < partition[3])
+
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def _geohash(lat, lon, precision):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+
+class AggregationDef(object):
+
+    # whether the count limit applies to the buckets of this aggregation
+    limited = True
+
+    def __init__(self, agg_type=None, value=None, children=None):
+        '''A vector service aggregation, e.g. "terms:item_type".
+
+        Args:
+            agg_type (str): The aggregation type.
+            value (str): The parameter of the aggregation, e.g. the field to group on.
+            children (list): Aggregations nested under each bucket of this one.
+        '''
+        self.agg_type = agg_type
+        self.value = value
+        self.children = children or []
+
+    def __str__(self):
+        agg = self.agg_type if self.value is None else '%s:%s' % (self.agg_type, self.value)
+        if len(self.children) == 1:
+            agg += ';%s' % self.children[0]
+        elif self.children:
+            agg += ';(%s)' % ','.join(str(child) for child in self.children)
+        return agg
+
+    def keys(self, vector):
+        '''The buckets a vector falls into, for aggregating locally.'''
+        raise NotImplementedError('%s aggregations can only be computed by the vector service' % self.agg_type)
+
+    def sort_key(self, bucket):
+        # largest buckets first, like the vector service
+        term, count = bucket
+        return -count, term
+
+
+class TermsAggDef(AggregationDef):
+
+    def __init__(self, field, children=None):
+        '''Count vectors per value of a field, e.g. "item_type" or "attributes.mascot".'''
+        super(TermsAggDef, self).__init__('terms', field, children)
+
+    def keys(self, vector):
+        value = vector.get('properties', {})
+        for name in self.value.split('.'):
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+
+class GeohashAggDef(AggregationDef):
+
+    def __init__(self, hash_length=3, children=None):
+        '''Count vectors per geohash grid cell of hash_length characters.'''
+        super(GeohashAggDef, self).__init__('geohash', hash_length, children)
+
+    def keys(self, vector):
+        # the cell of the center of the vector's bounding box
+        bounds = geometry_bounds(vector.get('geometry'))
+        if bounds is None:
+            return []
+        W, S, E, N = bounds
+        return [_geohash((S + N) / 2.0, (W + E) / 2.0, int(self.value))]
+
+
+class DateHistogramAggDef(AggregationDef):
+
+    periods = ('y', 'M', 'w', 'd', 'h', 'm')
+    limited = False
+
+    def __init__(self, bucket_period='M', children=None):
+        '''Count vectors per period of their item_date: y(ear), M(onth), w(eek),
+        d(ay), h(our) or m(inute).'''
+        if bucket_period not in self.periods:
+            raise ValueError('bucket_period must be one of %s' % ', '.join(self.periods))
+        super(DateHistogramAggDef, self).__init__('date_hist', bucket_period, children)
+
+    def keys(self, vector):
+        item_date = vector.get('properties', {}).get('item_date')
+        if not item_date:
+            return []
+        date = datetime.strptime(item_date[:19], '%Y-%m-%dT%H:%M:%S')
+        period = self.value
+        if period == 'y':
+            date = date.replace(month=1, day=1, hour=0, minute=0, second=0)
+        elif period == 'M':
+            date = date.replace(day=1, hour=0, minute=0, second=0)
+        elif period == 'w':
+            date = date.replace(hour=0, minute=0, second=0) - timedelta(days=date.weekday())
+        elif period == 'd':
+            date = date.replace(hour=0, minute=0, second=0)
+        elif period == 'h':
+            date = date.replace(minute=0, second=0)
+        else:
+            date = date.replace(second=0)
+        return [date.strftime('%Y-%m-%dT%H:%M:%SZ')]
+
+    def sort_key(self, bucket):
+        return bucket[0]
+
+
+def _aggregate(agg_def, buckets, vector):
+    # buckets: term -> [count, one dict of buckets per child aggregation]
+    for key in set(agg_def.keys(vector)):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [0, [{} for _ in agg_def.children]]
+        bucket[0] += 1
+        for child, child_buckets in zip(agg_def.children, bucket[1]):
+            _aggregate(child, child_buckets, vector)
+
+
+def _aggregation_result(agg_def, buckets, count):
+    terms = sorted(((term, b[0]) for term, b in buckets.items()), key=agg_def.sort_key)
+    if agg_def.limited:
+        terms = terms[:count]
+
+    result = []
+    for term, term_count in terms:
+        entry = {'term': term, 'count': term_count}
+        if agg_def.children:
+            entry['aggregations'] = [_aggregation_result(child, child_buckets, count)
+                                     for child, child_buckets in zip(agg_def.children, buckets[term][1])]
+        result.append(entry)
+    return {'name': str(agg_def), 'terms': result}
+
 
 class Vectors(object):
 
@@ -28,13 +272,28 @@ class Vectors(object):
         self.page_url = 'https://vector.geobigdata.io/insight-vector/api/vectors/paging'
         self.get_url = 'https://vector.geobigdata.io/insight-vector/api/vector/%s/'
         self.create_url = 'https://vector.geobigdata.io/insight-vector/api/vectors'
+        self.aggregations_url = 'https://vector.geobigdata.io/insight-vector/api/aggregation'
 
-    def create(self,vectors):
+        # optional VectorCache answering repeated queries locally
+        self.cache = None
+
+    def create(self, vectors, chunk_size=1000, max_bytes=5 * 1024 * 1024,
+               max_workers=DEFAULT_MAX_WORKERS, retries=3):
         """
         Create a vectors in the vector service.
 
+        Vectors are posted in chunks of at most chunk_size vectors and
+        max_bytes bytes, several chunks at a time. Any iterable works, so
+        vectors can be streamed from a generator without holding them all in
+        memory.
+
+        A chunk is only retried when it cannot have been ingested: the
+        connection could not be made, or the service answered 429 or 503.
+        After a read timeout or another server error the vectors of the chunk
+        may exist already, so the error is raised instead of creating them twice.
+
         Args:
-            vectors: A single geojson vector or a list of geojson vectors.  Each looks like:
+            vectors: A single geojson vector, or a list (or any iterable) of geojson vectors.  Each looks like:
               {
                 "type": "Feature",
                 "geometry": {
@@ -55,27 +314,43 @@ class Vectors(object):
               }
 
             item_type and ingest_source are required.
+            chunk_size: Maximum number of vectors per request
+            max_bytes: Maximum size of a request body in bytes
+            max_workers: Maximum number of chunks posted at the same time
+            retries: Number of times a chunk is retried when it was not ingested
 
         Returns:
-            a list of IDs of the vectors created
+            a list of IDs of the vectors created, in the order the vectors were given
         """
-        if type(vectors) is dict:
+        if isinstance(vectors, dict):
             vectors = [vectors]
 
-        # validate they all have item_type and ingest_source in properties
-        for vector in vectors:
-            if not 'properties' in list(vector.keys()):
-                raise Exception('Vector does not contain "properties" field.')
+        # lists are checked up front so nothing is created if one is invalid;
+        # other iterables are checked as they are consumed
+        if isinstance(vectors, list):
+            for vector in vectors:
+                _validate(vector)
 
-            if not 'item_type' in list(vector['properties'].keys()):
-                raise Exception('Vector does not contain "item_type".')
+        def _post_chunk(payload):
+            r = self.gbdx_connection.post(self.create_url, data=payload)
+            r.raise_for_status()
+            return r.json()
 
-            if not 'ingest_source' in list(vector['properties'].keys()):
-                raise Exception('Vector does not contain "ingest_source".')
+        post = with_retries(_post_chunk, retries=retries, logger=self.logger, retryable=is_retryable_post)
 
-        r = self.gbdx_connection.post(self.create_url, data=json.dumps(vectors))
-        r.raise_for_status()
-        return r.json()
+        ids = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for payload in _chunk_payloads(vectors, chunk_size, max_bytes):
+                # bound the number of chunks held in memory
+                if len(pending) >= 2 * max_workers:
+                    ids.extend(pending.popleft().result())
+                pending.append(executor.submit(post, payload))
+
+            while pending:
+                ids.extend(pending.popleft().result())
+
+        return ids
 
     def create_from_wkt(self, wkt, item_type, ingest_source, **attributes):
         '''
@@ -92,7 +367,7 @@ class Vectors(object):
         '''
         # verify the "depth" of the attributes is single layer
 
-        geojson = wkt2geojson.loads(wkt)
+        geojson = _wkt_to_geojson(wkt)
         vector = {
             'type': "Feature",
             'geometry': geojson,
@@ -106,6 +381,65 @@ class Vectors(object):
         return self.create(vector)[0]
 
 
+    def create_from_wkt_rows(self, rows, **kwargs):
+        '''
+        Create many vectors from WKT, e.g. from the rows of a CSV file. Rows are
+        converted and uploaded as they are consumed, in chunks, several chunks
+        at a time.
+
+        Args:
+            rows: an iterable of (wkt, item_type, ingest_source, attributes) tuples,
+                  where attributes is a dict of key-value pairs or None
+            kwargs: chunking and concurrency options passed to create()
+
+        Returns:
+            a list of IDs of the vectors created, in the order of the rows
+        '''
+        def _vectors():
+            for wkt, item_type, ingest_source, attributes in rows:
+                yield {
+                    'type': "Feature",
+                    'geometry': _wkt_to_geojson(wkt),
+                    'properties': {
+                        'item_type': item_type,
+                        'ingest_source': ingest_source,
+                        'attributes': attributes or {}
+                    }
+                }
+
+        return self.create(_vectors(), **kwargs)
+
+    def create_from_file(self, path, item_type=None, ingest_source=None, **kwargs):
+        '''
+        Create vectors from a GeoJSON FeatureCollection or a newline delimited
+        GeoJSON file. Features are read and uploaded incrementally, so memory
+        use does not depend on the size of the file.
+
+        Args:
+            path (str): path of the GeoJSON file
+            item_type (str): item_type for features that do not have one
+            ingest_source (str): ingest_source for features that do not have one.
+                                 Defaults to the name of the file.
+            kwargs: chunking and concurrency options passed to create()
+
+        Returns:
+            a list of IDs of the vectors created, in file order
+        '''
+        if ingest_source is None:
+            ingest_source = os.path.basename(path)
+
+        def _features():
+            for feature in iter_geojson_features(path):
+                if not feature.get('properties'):
+                    feature['properties'] = {}
+                properties = feature['properties']
+                if item_type is not None:
+                    properties.setdefault('item_type', item_type)
+                properties.setdefault('ingest_source', ingest_source)
+                yield feature
+
+        return self.create(_features(), **kwargs)
+
     def get(self, ID, index='vector-web-s'):
         '''Retrieves a vector.  Not usually necessary because searching is the best way to find & get stuff.
 
@@ -123,6 +457,43 @@ class Vectors(object):
         return r.json()
 
 
+    def get_many(self, IDs, index='vector-web-s', max_workers=DEFAULT_MAX_WORKERS, retries=3):
+        '''Retrieves many vectors by ID, several at a time over the shared connection.
+
+        Args:
+            IDs (list): IDs of the vector objects. Duplicates are fetched once.
+            index (str): Optional.  Index the objects live in.  defaults to 'vector-web-s'
+            max_workers (int): Maximum number of vectors fetched at the same time
+            retries (int): Number of times a request is retried on connection or server errors
+
+        Returns:
+            records (dict): ID to record, for the vectors found
+            missing (list): IDs of the vectors that do not exist, in the order given
+        '''
+        url = self.get_url % index
+
+        def _get(ID):
+            r = self.gbdx_connection.get(url + ID)
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+            return r.json()
+
+        get = with_retries(_get, retries=retries, logger=self.logger)
+
+        seen = set()
+        unique_ids = [ID for ID in IDs if not (ID in seen or seen.add(ID))]
+
+        records, missing = {}, []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for ID, record in zip(unique_ids, executor.map(get, unique_ids)):
+                if record is None:
+                    missing.append(ID)
+                else:
+                    records[ID] = record
+
+        return records, missing
+
     def query(self, searchAreaWkt, query, count=100, ttl='5m'):
         '''
         Perform a vector services query using the QUERY API
@@ -142,7 +513,7 @@ class Vectors(object):
         return list(self.query_iteratively(searchAreaWkt, query, count, ttl))
 
 
-    def query_iteratively(self, searchAreaWkt, query, count=100, ttl='5m'):
+    def query_iteratively(self, searchAreaWkt, query, count=100, ttl='5m', prefetch=0, prefetch_bytes=None):
         '''
         Perform a vector services query using the QUERY API
         (https://gbdxdocs.digitalglobe.com/docs/vs-query-list-vector-items-returns-default-fields)
@@ -152,6 +523,12 @@ class Vectors(object):
             query: Elastic Search query
             count: Maximum number of results to return
             ttl: Amount of time for each temporary vector page to exist
+            prefetch: Number of pages fetched ahead in a background thread while
+                      the current page is consumed. Default is 0, no read-ahead.
+            prefetch_bytes: Optional cap on the size of the pages fetched ahead
+
+        When a VectorCache is attached (gbdx.vectors.cache), queries inside an
+        area already queried are answered from the cache.
 
         Returns:
             generator of vector results
@@ -159,9 +536,337 @@ class Vectors(object):
         '''
 
         search_area_polygon = geometry.from_wkt(searchAreaWkt)
-        left, lower, right, upper = search_area_polygon.bounds
+        bounds = search_area_polygon.bounds
+
+        params = self._query_params(query, bounds, count, ttl)
+
+        cache = self.cache
+        if cache is not None:
+            cached = cache.lookup(query, bounds)
+            if cached is not None:
+                for vector in cached:
+                    yield vector
+                return
+            started = time.time()
+
+        pages = self._pages(params)
+        if prefetch:
+            pages = read_ahead(pages, depth=prefetch, max_bytes=prefetch_bytes, sizeof=lambda page: page[1])
+
+        for page, _ in pages:
+            if cache is not None:
+                cache.add(query, page['data'])
+            for vector in page['data']:
+                yield vector
+
+        # only a query that ran to completion covers its area
+        if cache is not None:
+            cache.add_extent(query, bounds, started)
+
+    def query_partitioned(self, searchAreaWkt, query, tile_size=1.0, count=100, ttl='5m',
+                          max_workers=DEFAULT_MAX_WORKERS, clip=False):
+        '''
+        Perform a vector services query over a large area by splitting it into
+        square tiles and running one paging query per tile, several at a time.
+        Only the tiles that intersect the search polygon are queried.
+
+        Args:
+            searchAreaWkt: WKT Polygon of area to search
+            query: Elastic Search query
+            tile_size: The size in degrees of the side of a tile
+            count: Maximum number of results to return per tile
+            ttl: Amount of time for each temporary vector page to exist
+            max_workers: Maximum number of tiles queried at the same time
+            clip: Only return vectors whose geometry intersects the search
+                  polygon, instead of its bounding box
+
+        Returns:
+            generator of vector results, each vector returned once. Results
+            arrive as the tiles are paged through, in no particular order.
+        '''
+        search_area_polygon = geometry.from_wkt(searchAreaWkt)
+        search_area = search_area_polygon.__geo_interface__
+
+        def _tile_query(bounds):
+            params = self._query_params(query, bounds, count, ttl)
+            return lambda: (page for page, _ in self._pages(params))
+
+        tiles = tile_bounds(search_area_polygon, tile_size)
+        pages = interleave([_tile_query(bounds) for bounds in tiles], max_workers=max_workers)
+
+        # vectors on tile edges are returned by every tile they touch
+        seen = set()
+        for page in pages:
+            for vector in page['data']:
+                vector_id = vector.get('properties', {}).get('id', vector.get('id'))
+                if vector_id is not None:
+                    if vector_id in seen:
+                        continue
+                    seen.add(vector_id)
+                if clip and not geometries_intersect(vector['geometry'], search_area):
+                    continue
+                yield vector
+
+    def query_pages(self, searchAreaWkt, query, count=100, ttl='5m', resume_token=None):
+        '''
+        Perform a vector services query page by page, with a checkpoint after
+        every page, so that the query can be continued later.
+
+        Args:
+            searchAreaWkt: WKT Polygon of area to search
+            query: Elastic Search query
+            count: Maximum number of results per page
+            ttl: Amount of time for each temporary vector page to exist
+            resume_token: A checkpoint returned by an earlier run of the same
+                          query, to continue after the page it was returned with
+
+        Returns:
+            generator of (list of vectors of a page, checkpoint). A checkpoint is
+            a dict with the 'paging_id' of the next page and the number of vectors
+            'delivered' so far. The paging id is only valid for ttl.
+        '''
+        params = self._query_params(query, geometry.from_wkt(searchAreaWkt).bounds, count, ttl)
+
+        paging_id, delivered = None, 0
+        if resume_token:
+            paging_id, delivered = resume_token['paging_id'], resume_token['delivered']
+
+        for page, _ in self._pages(params, paging_id):
+            delivered += len(page['data'])
+            yield page['data'], {'paging_id': page['next_paging_id'], 'delivered': delivered}
+
+    def _continue_pages(self, params, paging_id, delivered):
+        # (vectors, page) of a query continued at paging_id, after the first
+        # delivered vectors. If the paging id has expired, the query runs again
+        # and skips the delivered vectors; it gives up when a restart expires
+        # again before getting past them.
+        skip = delivered if paging_id is None else 0
+        restarted_at = None
+        while True:
+            try:
+                for vectors, page in _skip_delivered(self._pages(params, paging_id), skip):
+                    delivered += len(vectors)
+                    yield vectors, page
+                return
+            except requests.exceptions.HTTPError as e:
+                if not _paging_expired(e) or restarted_at == delivered:
+                    raise
+                self.logger.debug('Paging id expired, restarting after %s vectors' % delivered)
+                restarted_at = delivered
+                paging_id, skip = None, delivered
+
+    def query_resumable(self, searchAreaWkt, query, checkpoint_path, count=100, ttl='5m', tile_size=None):
+        '''
+        Perform a vector services query that can be picked up where it stopped
+        after a crash.
+
+        Progress is saved to checkpoint_path after every page. Running the same
+        query with the same checkpoint_path again continues after the last page
+        that was fully consumed. If the saved paging id has expired, the query
+        is restarted and the vectors already delivered are skipped, which
+        assumes the query returns results in the same order.
+
+        With tile_size, the area is split into tiles that are queried one after
+        the other (see query_partitioned) and an expired paging id only
+        restarts the current tile. The checkpoint keeps the IDs of the vectors
+        that reach past their tile, so a resumed query does not deliver them
+        again from a neighbouring tile.
+
+        Args:
+            searchAreaWkt: WKT Polygon of area to search
+            query: Elastic Search query
+            checkpoint_path: Path of the file progress is saved to. Removed once
+                             the query completes.
+            count: Maximum number of results per page
+            ttl: Amount of time for each temporary vector page to exist
+            tile_size: Optional size in degrees of the tiles the area is split into
+
+        Returns:
+            generator of vector results
+        '''
+        state = {'searchAreaWkt': searchAreaWkt, 'query': query, 'tile_size': tile_size}
+        saved = read_state(checkpoint_path)
+        if saved and all(saved.get(k) == v for k, v in state.items()):
+            progress = saved
+            self.logger.debug('Resuming query from tile %s after %s vectors'
+                              % (progress['partition'], progress['delivered']))
+        else:
+            progress = dict(state, partition=0, paging_id=None, delivered=0, edge_ids=[])
+
+        search_area_polygon = geometry.from_wkt(searchAreaWkt)
+        if tile_size:
+            partitions = tile_bounds(search_area_polygon, tile_size)
+        else:
+            partitions = [search_area_polygon.bounds]
+
+        # vectors on tile edges are returned by every tile they touch
+        seen = set(progress.get('edge_ids', []))
+        while progress['partition'] < len(partitions):
+            partition = partitions[progress['partition']]
+            params = self._query_params(query, partition, count, ttl)
+            for vectors, page in self._continue_pages(params, progress['paging_id'], progress['delivered']):
+                for vector in vectors:
+                    if tile_size:
+                        vector_id = vector.get('properties', {}).get('id', vector.get('id'))
+                        if vector_id is not None:
+                            if vector_id in seen:
+                                continue
+                            bounds = geometry_bounds(vector.get('geometry'))
+                            if bounds is None or not _inside(bounds, partition):
+                                seen.add(vector_id)
+                                progress['edge_ids'].append(vector_id)
+                    yield vector
+
+                progress['delivered'] += len(vectors)
+                progress['paging_id'] = page['next_paging_id']
+                write_state(checkpoint_path, progress)
+
+            progress.update(partition=progress['partition'] + 1, paging_id=None, delivered=0)
+            write_state(checkpoint_path, progress)
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    def export(self, searchAreaWkt, query, path, format=None, count=100, ttl='5m', batch_size=1000, resume=False):
+        '''
+        Stream the results of a vector services query to a file, without
+        holding them in memory.
+
+        Vectors are written in batches of about batch_size vectors, at page
+        boundaries. After every write the progress is saved next to the file
+        (path + '.state'), so an interrupted export can be resumed with
+        resume=True: the file is truncated to the last completed write and
+        the query continues from the next page. If its paging id has expired,
+        the query runs again and the vectors already written are skipped,
+        which assumes the query returns results in the same order.
+
+        Args:
+            searchAreaWkt: WKT Polygon of area to search
+            query: Elastic Search query
+            path: Path of the file to write
+            format: "geojson" (newline delimited GeoJSON), "csv" (geometry as WKT)
+                    or "parquet" (geometry as WKB, requires pyarrow, cannot be
+                    resumed). Defaults to the format matching the file extension.
+            count: Maximum number of results per page
+            ttl: Amount of time for each temporary vector page to exist
+            batch_size: Number of vectors written at a time
+            resume: Continue an interrupted export of the same query to path
 
+        Returns:
+            The number of vectors in the file
+        '''
+        format = format or format_from_path(path)
+        state_path = path + '.state'
+        state = {'searchAreaWkt': searchAreaWkt, 'query': query, 'format': format}
+
+        written, offset, paging_id = 0, 0, None
+        if resume:
+            saved = read_state(state_path)
+            if saved and all(saved.get(k) == v for k, v in state.items()):
+                written, offset, paging_id = saved['count'], saved['offset'], saved.get('paging_id')
+                self.logger.debug('Resuming export to %s after %s vectors' % (path, written))
+
+        params = self._query_params(query, geometry.from_wkt(searchAreaWkt).bounds, count, ttl)
+
+        writer = open_writer(path, format, offset)
+        try:
+            batch = []
+            for vectors, page in self._continue_pages(params, paging_id, written):
+                batch.extend(vectors)
+
+                if len(batch) >= batch_size:
+                    writer.write(batch)
+                    written += len(batch)
+                    batch = []
+                    offset = writer.flush()
+                    if offset is not None:
+                        state.update(count=written, offset=offset, paging_id=page['next_paging_id'])
+                        write_state(state_path, state)
+
+            if batch:
+                writer.write(batch)
+                written += len(batch)
+        finally:
+            writer.close()
+
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return written
+
+    def aggregate_query(self, searchAreaWkt, agg_def, query=None, start_date=None, end_date=None, count=10):
+        '''
+        Aggregate the vectors in an area with the vector service aggregation API,
+        without downloading them.
+
+        Args:
+            searchAreaWkt: WKT Polygon of area to search
+            agg_def: The aggregation, an AggregationDef (e.g. TermsAggDef('item_type'),
+                     GeohashAggDef(4) or DateHistogramAggDef('d')) or an aggregation string
+            query: Optional Elastic Search query to filter the vectors
+            start_date: Optional earliest item_date, e.g. "2016-01-01T00:00:00Z"
+            end_date: Optional latest item_date
+            count: Maximum number of buckets per aggregation
+
+        Returns:
+            List of aggregation results. Each is a dict with the aggregation 'name'
+            and its 'terms': dicts with the bucket 'term', its 'count' and, for
+            nested aggregations, its own 'aggregations'.
+        '''
         params = {
+            "count": count,
+            "aggs": str(agg_def)
+        }
+        if query:
+            params['query'] = query
+        if start_date:
+            params['start_date'] = start_date
+        if end_date:
+            params['end_date'] = end_date
+
+        search_area = geometry.from_wkt(searchAreaWkt).__geo_interface__
+        headers = {'Content-Type': 'application/json'}
+        r = self.gbdx_connection.post(self.aggregations_url, params=params, headers=headers,
+                                      data=json.dumps(search_area))
+        r.raise_for_status()
+        return r.json()['aggregations']
+
+    def aggregate_locally(self, searchAreaWkt, agg_def, query=None, start_date=None, end_date=None,
+                          count=10, page_size=100, **kwargs):
+        '''
+        Compute the same aggregations as aggregate_query() on the client, while
+        streaming the vectors with query_iteratively(). Memory use depends on
+        the number of buckets, not the number of vectors. Useful for indexes or
+        aggregations the service cannot aggregate.
+
+        Args:
+            searchAreaWkt: WKT Polygon of area to search
+            agg_def: The aggregation, an AggregationDef. Terms, geohash and date
+                     histogram aggregations are supported. Geohash cells are
+                     computed from the center of each vector's bounding box.
+            query: Optional Elastic Search query to filter the vectors
+            start_date: Optional earliest item_date, e.g. "2016-01-01T00:00:00Z"
+            end_date: Optional latest item_date
+            count: Maximum number of buckets per terms or geohash aggregation
+            page_size: Number of vectors per page of the underlying query
+            kwargs: Other query_iteratively() options, e.g. prefetch
+
+        Returns:
+            List of aggregation results, in the format of aggregate_query().
+        '''
+        buckets = {}
+        for vector in self.query_iteratively(searchAreaWkt, query or '*', count=page_size, **kwargs):
+            item_date = vector.get('properties', {}).get('item_date') or ''
+            if start_date and item_date < start_date:
+                continue
+            if end_date and item_date[:len(end_date)] > end_date:
+                continue
+            _aggregate(agg_def, buckets, vector)
+
+        return [_aggregation_result(agg_def, buckets, count)]
+
+    def _query_params(self, query, bounds, count, ttl):
+        left, lower, right, upper = bounds
+        return {
             "q": query,
             "count": count,
             "ttl": ttl,
@@ -171,12 +876,22 @@ class Vectors(object):
             "upper": upper
         }
 
-        # initialize paging request
-        r = self.gbdx_connection.get(self.query_url, params=params)
-        r.raise_for_status()
-        page = r.json()
-        paging_id = page['pagingId']
-        item_count = int(page['itemCount'])
+    def _pages(self, params, paging_id=None):
+        '''
+        Run a paging query, or continue it from paging_id.
+
+        Returns:
+            generator of (page, size of the page in bytes)
+        '''
+        if paging_id is None:
+            # initialize paging request
+            r = self.gbdx_connection.get(self.query_url, params=params)
+            r.raise_for_status()
+            page = r.json()
+            paging_id = page['pagingId']
+            item_count = int(page['itemCount'])
+        else:
+            item_count = 1
 
         # get vectors from each page
         while paging_id and item_count > 0:
@@ -184,7 +899,7 @@ class Vectors(object):
           headers = {'Content-Type':'application/x-www-form-urlencoded'}
           data = {
               "pagingId": paging_id,
-              "ttl": ttl
+              "ttl": params['ttl']
           }
 
           r = self.gbdx_connection.post(self.page_url, headers=headers, data=data)
@@ -192,13 +907,5 @@ class Vectors(object):
           page = r.json()
           paging_id = page['next_paging_id']
           item_count = int(page['item_count'])
-          data = page['data']
-
-          for vector in data:
-            yield vector
-
-
-
-
-
 
+          yield page, len(r.content)
@@ -10,6 +10,13 @@ from builtins import object
 
 import json
 
+from gbdxtools.concurrency import DEFAULT_MAX_WORKERS, Poller, with_retries
+from gbdxtools.throttle import TokenBucket
+
+
+class WorkflowTimeout(Exception):
+    pass
+
 
 class Workflow(object):
     def __init__(self, interface):
@@ -71,9 +78,30 @@ class Workflow(object):
             'wf_url': self.workflows_url, 'wf_id': workflow_id
         }
         r = self.gbdx_connection.get(url)
+        r.raise_for_status()
 
         return r.json()['state']
 
+    def monitor(self, workflow_ids, timeout=None, **kwargs):
+        """Poll many workflows until they complete, yielding every state change.
+
+        Workflows are polled concurrently, each with its own adaptive polling
+        interval, and a workflow is no longer polled once it is complete.
+
+         Args:
+             workflow_ids (list): Workflow ids.
+             timeout (float): Maximum number of seconds to wait. Raises
+                              WorkflowTimeout when exceeded. Default waits forever.
+             kwargs: Polling options passed to WorkflowMonitor (max_workers,
+                     max_requests_per_second, min_interval, max_interval,
+                     state_intervals).
+
+         Returns:
+             Generator of events, one per workflow state change, with the keys
+             'workflow_id', 'state', 'event', 'previous_state' and 'previous_event'.
+        """
+        return WorkflowMonitor(self, workflow_ids, **kwargs).events(timeout=timeout)
+
     def get(self, workflow_id):
         """Get existing workflow state and task information.
 
@@ -215,3 +243,85 @@ class Workflow(object):
         r = self.gbdx_connection.post(url)
 
         return r.json()
+
+
+class WorkflowMonitor(object):
+
+    def __init__(self, workflow, workflow_ids, max_workers=DEFAULT_MAX_WORKERS, max_requests_per_second=None,
+                 min_interval=10, max_interval=300, state_intervals=None):
+        """Track the state of many workflows until they all complete.
+
+        A workflow is polled every min_interval seconds after it changed state
+        and less and less often, up to every max_interval seconds, the longer
+        its state stays the same.
+
+        Args:
+            workflow (Workflow): The GBDX Workflow interface.
+            workflow_ids (list): Workflow ids.
+            max_workers (int): Maximum number of workflows polled at the same time.
+            max_requests_per_second (float): Optional limit on the rate of status
+                                             requests, over all workflows.
+            min_interval (float): Seconds between polls of a workflow that just
+                                  changed state.
+            max_interval (float): Longest time between two polls of a workflow.
+            state_intervals (dict): Optional min_interval per state, e.g.
+                                    {'pending': 60} for workflows waiting for resources.
+
+        Returns:
+            An instance of WorkflowMonitor.
+        """
+        if not isinstance(workflow_ids, list):
+            workflow_ids = [workflow_ids]
+
+        self.workflow = workflow
+        self.workflow_ids = workflow_ids
+        self.max_workers = max_workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.state_intervals = state_intervals or {}
+        self._bucket = TokenBucket(max_requests_per_second) if max_requests_per_second else None
+
+        # latest known status of every workflow, keyed by workflow id
+        self.statuses = {}
+
+    @property
+    def complete(self):
+        return all(self.statuses.get(workflow_id, {}).get('state') == 'complete'
+                   for workflow_id in self.workflow_ids)
+
+    def events(self, timeout=None):
+        """Poll until every workflow is complete.
+
+        Args:
+            timeout (float): Maximum number of seconds to wait. Raises
+                             WorkflowTimeout when exceeded.
+
+        Returns:
+            Generator of workflow state change events.
+        """
+        def _status(workflow_id):
+            if self._bucket:
+                self._bucket.consume()
+            return self.workflow.status(workflow_id)
+
+        status = with_retries(_status, logger=self.workflow.logger)
+        poller = Poller(self.workflow_ids, status, self.min_interval, self.max_interval, self.max_workers)
+
+        def _timeout(pending):
+            return WorkflowTimeout('Workflows not complete after %s seconds: %s' % (timeout, ', '.join(sorted(pending))))
+
+        for workflow_id, current in poller.poll(timeout, _timeout):
+            previous = self.statuses.get(workflow_id, {})
+            self.statuses[workflow_id] = current
+            if (current.get('state'), current.get('event')) != (previous.get('state'), previous.get('event')):
+                poller.reset(workflow_id, self.state_intervals.get(current.get('state'), self.min_interval))
+                yield {
+                    'workflow_id': workflow_id,
+                    'state': current.get('state'),
+                    'event': current.get('event'),
+                    'previous_state': previous.get('state'),
+                    'previous_event': previous.get('event')
+                }
+
+            if current.get('state') == 'complete':
+                poller.done(workflow_id)
@@ -0,0 +1,19 @@
+"""
+A fake clock for unit tests of code that polls and sleeps.
+"""
+from contextlib import contextmanager
+from mock import Mock, patch
+
+
+@contextmanager
+def fake_clock(target, now=1000.0):
+    """Patch the time module at target (e.g. 'gbdxtools.concurrency.time') with a clock that only
+    moves when sleep() is called. Yields a dict with the current time 'now' and the list of 'sleeps'."""
+    clock = {'now': now, 'sleeps': []}
+
+    def sleep(seconds):
+        clock['sleeps'].append(seconds)
+        clock['now'] += seconds
+
+    with patch(target, Mock(time=lambda: clock['now'], sleep=sleep)):
+        yield clock
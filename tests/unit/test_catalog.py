@@ -7,6 +7,7 @@ Unit tests for the gbdxtools.Catalog class
 
 from gbdxtools import Interface
 from gbdxtools.catalog import Catalog
+from gbdxtools.catalog_search_aoi import geometries_intersect
 from auth_mock import get_mock_gbdx_session
 import vcr
 import unittest
@@ -205,3 +206,15 @@ class TestCatalog(unittest.TestCase):
         c = Catalog(self.gbdx)
         s3path = c.get_data_location(catalog_id='1010010011AD6E00')
         assert s3path == None
+
+    def test_geometries_intersect(self):
+        square = {'type': 'Polygon', 'coordinates': [[[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]],
+                                                      [[1, 1], [3, 1], [3, 3], [1, 3], [1, 1]]]}
+        assert geometries_intersect({'type': 'Point', 'coordinates': [0.5, 0.5]}, square)
+        assert not geometries_intersect({'type': 'Point', 'coordinates': [2, 2]}, square)
+        assert geometries_intersect({'type': 'Point', 'coordinates': [4, 2, 10]}, square)
+        assert geometries_intersect({'type': 'LineString', 'coordinates': [[-1, -1], [5, 5]]}, square)
+        assert not geometries_intersect({'type': 'LineString', 'coordinates': [[5, 0], [5, 5]]}, square)
+        assert geometries_intersect(square, {'type': 'MultiPolygon', 'coordinates': [
+            [[[10, 10], [11, 10], [11, 11], [10, 10]]],
+            [[[-1, -1], [5, -1], [5, 5], [-1, 5], [-1, -1]]]]})
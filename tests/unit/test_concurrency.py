@@ -0,0 +1,131 @@
+"""
+Unit tests for gbdxtools.concurrency
+"""
+
+from gbdxtools.concurrency import (batches, is_retryable, is_retryable_post, with_retries, read_ahead, interleave,
+                                   Poller)
+from clock_mock import fake_clock
+import requests
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+import threading
+import time
+import unittest
+from mock import Mock, patch
+
+
+class ConcurrencyTests(unittest.TestCase):
+
+    def test_batches(self):
+        assert list(batches([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+        assert list(batches([], 2)) == []
+
+    def test_is_retryable(self):
+        def http_error(status_code):
+            return requests.exceptions.HTTPError(response=Mock(status_code=status_code))
+
+        assert is_retryable(requests.exceptions.ConnectionError())
+        assert is_retryable(requests.exceptions.Timeout())
+        assert is_retryable(http_error(429))
+        assert is_retryable(http_error(502))
+        assert not is_retryable(http_error(404))
+        assert not is_retryable(ValueError())
+
+    def test_is_retryable_post(self):
+        def http_error(status_code):
+            return requests.exceptions.HTTPError(response=Mock(status_code=status_code))
+
+        refused = MaxRetryError(None, '/order', NewConnectionError(None, 'Connection refused'))
+        assert is_retryable_post(requests.exceptions.ConnectionError(refused))
+        assert is_retryable_post(requests.exceptions.ConnectTimeout())
+        assert is_retryable_post(http_error(429))
+        assert is_retryable_post(http_error(503))
+        # the request may have been processed
+        assert not is_retryable_post(requests.exceptions.ReadTimeout())
+        assert not is_retryable_post(requests.exceptions.ConnectionError(ProtocolError('Connection aborted.')))
+        assert not is_retryable_post(http_error(502))
+        assert not is_retryable_post(http_error(504))
+
+    def test_with_retries_gives_up(self):
+        func = Mock(side_effect=requests.exceptions.ConnectionError())
+        with patch('gbdxtools.concurrency.time.sleep') as sleep:
+            self.assertRaises(requests.exceptions.ConnectionError, with_retries(func, retries=2))
+        assert func.call_count == 3
+        assert sleep.call_count == 2
+
+    def test_poller(self):
+        results = {'a': ['pending', 'done'], 'b': ['pending', 'pending', 'done']}
+        poller = Poller(['a', 'b'], lambda key: results[key].pop(0), min_interval=10, max_interval=40)
+
+        polls = []
+        with fake_clock('gbdxtools.concurrency.time') as clock, \
+                patch('gbdxtools.concurrency.random.uniform', return_value=1.0):
+            for key, result in poller.poll():
+                polls.append((clock['now'] - 1000.0, key, result))
+                if result == 'done':
+                    poller.done(key)
+
+        assert sorted(polls) == [(0, 'a', 'pending'), (0, 'b', 'pending'), (10, 'a', 'done'),
+                                 (10, 'b', 'pending'), (30, 'b', 'done')]
+        assert poller.pending == []
+
+    def test_poller_timeout(self):
+        poller = Poller(['a'], lambda key: 'pending', min_interval=10, max_interval=40)
+
+        with fake_clock('gbdxtools.concurrency.time'), patch('gbdxtools.concurrency.random.uniform', return_value=1.0):
+            with self.assertRaises(ValueError) as cm:
+                list(poller.poll(timeout=25, timeout_error=lambda pending: ValueError(pending)))
+
+        assert cm.exception.args == (['a'],)
+
+    def test_read_ahead(self):
+        assert list(read_ahead(iter(range(10)), depth=2)) == list(range(10))
+
+    def test_read_ahead_depth_and_bytes(self):
+        produced = []
+        lock = threading.Lock()
+
+        def items():
+            for i in range(10):
+                with lock:
+                    produced.append(i)
+                yield 'x' * 10
+
+        g = read_ahead(items(), depth=5, max_bytes=25, sizeof=len)
+        next(g)
+        time.sleep(0.05)
+        # 2 items fit in 25 bytes, plus one consumed and one waiting in the producer
+        with lock:
+            assert len(produced) == 4
+        assert len(list(g)) == 9
+
+    def test_read_ahead_error(self):
+        def items():
+            yield 1
+            yield 2
+            raise ValueError('page expired')
+
+        g = read_ahead(items(), depth=1)
+        assert next(g) == 1
+        assert next(g) == 2
+        self.assertRaises(ValueError, next, g)
+
+    def test_interleave(self):
+        def source(name, n, delay):
+            def produce():
+                for i in range(n):
+                    time.sleep(delay)
+                    yield (name, i)
+            return produce
+
+        items = list(interleave([source('a', 5, 0.01), source('b', 3, 0), source('c', 0, 0)], max_workers=3))
+        assert sorted(items) == [('a', i) for i in range(5)] + [('b', i) for i in range(3)]
+        # items of one source keep their order, the fast source is not held up by the slow one
+        assert [i for name, i in items if name == 'a'] == list(range(5))
+        assert items.index(('b', 2)) < items.index(('a', 4))
+
+    def test_interleave_error(self):
+        def failing():
+            yield 1
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, list, interleave([failing, lambda: iter([2, 3])]))
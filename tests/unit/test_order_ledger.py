@@ -0,0 +1,56 @@
+"""
+Unit tests for the gbdxtools.OrderLedger class
+"""
+
+from gbdxtools.order_ledger import OrderLedger
+import os
+import tempfile
+import unittest
+from mock import patch
+
+
+class OrderLedgerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'orders.db')
+        self.ledger = OrderLedger(self.path)
+
+    def tearDown(self):
+        self.ledger.close()
+
+    def test_record_orders(self):
+        self.ledger.record_orders({'a': 'order-1', 'b': 'order-1'})
+        entries = self.ledger.get(['a', 'b', 'c'])
+
+        assert sorted(entries) == ['a', 'b']
+        assert entries['a']['order_id'] == 'order-1'
+        assert entries['a']['state'] == 'submitted'
+        assert entries['a']['location'] is None
+
+    def test_record_acquisitions_keeps_order_id(self):
+        self.ledger.record_orders({'a': 'order-1'})
+        self.ledger.record_acquisitions([{'acquisition_id': 'a', 'state': 'delivered', 'location': 's3://bucket/a'},
+                                         {'acquisition_id': 'b', 'state': 'submitted', 'location': 'not_delivered'}])
+        entries = self.ledger.get(['a', 'b'])
+
+        assert entries['a']['order_id'] == 'order-1'
+        assert entries['a']['state'] == 'delivered'
+        assert entries['a']['location'] == 's3://bucket/a'
+        assert entries['b']['order_id'] is None
+
+    def test_persistent(self):
+        self.ledger.record_orders({'a': 'order-1'})
+        self.ledger.close()
+
+        self.ledger = OrderLedger(self.path)
+        assert self.ledger.get(['a'])['a']['order_id'] == 'order-1'
+
+    def test_fresh_locations(self):
+        with patch('gbdxtools.order_ledger.time.time', return_value=1000.0) as now:
+            self.ledger.record_acquisitions([{'acquisition_id': 'a', 'state': 'delivered', 'location': 's3://bucket/a'},
+                                             {'acquisition_id': 'b', 'state': 'submitted', 'location': 'not_delivered'}])
+            assert self.ledger.fresh_locations(['a', 'b']) == {
+                'a': {'acquisition_id': 'a', 'state': 'delivered', 'location': 's3://bucket/a'}}
+
+            now.return_value = 1000.0 + self.ledger.max_age + 1
+            assert self.ledger.fresh_locations(['a', 'b']) == {}
@@ -5,9 +5,15 @@ Unit tests for the gbdxtools.Ordering class
 """
 
 from gbdxtools import Interface
-from gbdxtools.ordering import Ordering
+from gbdxtools.ordering import Ordering, OrderTracker, OrderTimeout, OrderError
+from gbdxtools.order_ledger import OrderLedger
 from auth_mock import get_mock_gbdx_session
+from clock_mock import fake_clock
 import vcr
+import json
+import os
+import requests
+import tempfile
 import unittest
 from mock import Mock, patch
 
@@ -44,9 +50,10 @@ class OrderingTests(unittest.TestCase):
     @vcr.use_cassette('tests/unit/cassettes/test_order_multi_catids.yaml', filter_headers=['authorization'])
     def test_order_multi_catids(self):
         o = Ordering(self.gbdx)
-        order_id = o.order(['10400100120FEA00', '101001000DB2FB00'])
-        # assert order_id == '2b3ba38e-4d7e-4ef6-ac9d-2e2e0a8ca1e7'
-        assert len(order_id) == 36
+        order_ids = o.order(['10400100120FEA00', '101001000DB2FB00'])
+        # assert order_ids == ['2b3ba38e-4d7e-4ef6-ac9d-2e2e0a8ca1e7']
+        assert len(order_ids) == 1
+        assert len(order_ids[0]) == 36
 
     @vcr.use_cassette('tests/unit/cassettes/test_order_batching.yaml', filter_headers=['authorization'])
     def test_order_batching(self):
@@ -86,4 +93,215 @@ class OrderingTests(unittest.TestCase):
             o = Ordering(self.gbdx)
             assert o.heartbeat() == False
 
+    def test_order_concurrent_batches(self):
+        posted = []
+
+        def post(url, data):
+            ids = json.loads(data)
+            posted.append(ids)
+            r = Mock()
+            r.json.return_value = {'order_id': 'order-' + ids[0]}
+            return r
+
+        o = Ordering(self.gbdx)
+        with patch.object(o, 'gbdx_connection') as conn:
+            conn.post.side_effect = post
+            order_ids, mapping = o.order(['a', 'b ', 'c', 'a', '', 'd', 'e'], batch_size=2, max_workers=3,
+                                         return_mapping=True)
+
+        assert sorted(posted) == [['a', 'b'], ['c', 'd'], ['e']]
+        assert order_ids == ['order-a', 'order-c', 'order-e']
+        assert mapping == {'a': 'order-a', 'b': 'order-a', 'c': 'order-c', 'd': 'order-c', 'e': 'order-e'}
+
+    def test_order_retries_failed_batch(self):
+        ok = Mock()
+        ok.json.return_value = {'order_id': 'order-1'}
+        error_response = Mock(status_code=503)
+        failed = Mock()
+        failed.raise_for_status.side_effect = requests.exceptions.HTTPError(response=error_response)
+
+        o = Ordering(self.gbdx)
+        with patch.object(o, 'gbdx_connection') as conn, patch('gbdxtools.concurrency.time.sleep'):
+            conn.post.side_effect = [failed, ok]
+            assert o.order('10400100120FEA00') == 'order-1'
+            assert conn.post.call_count == 2
+
+    def test_order_does_not_retry_client_errors(self):
+        failed = Mock()
+        failed.raise_for_status.side_effect = requests.exceptions.HTTPError(response=Mock(status_code=400))
+
+        o = Ordering(self.gbdx)
+        with patch.object(o, 'gbdx_connection') as conn:
+            conn.post.return_value = failed
+            with self.assertRaises(OrderError) as cm:
+                o.order(['10400100120FEA00'])
+            assert conn.post.call_count == 1
+
+        assert isinstance(cm.exception.errors[0], requests.exceptions.HTTPError)
+        assert cm.exception.failed_ids == ['10400100120FEA00']
+        assert cm.exception.mapping == {}
+
+    def test_order_does_not_retry_batches_that_may_be_placed(self):
+        timed_out = requests.exceptions.ReadTimeout()
+        bad_gateway = Mock()
+        bad_gateway.raise_for_status.side_effect = requests.exceptions.HTTPError(response=Mock(status_code=502))
+
+        o = Ordering(self.gbdx)
+        with patch.object(o, 'gbdx_connection') as conn, patch('gbdxtools.concurrency.time.sleep'):
+            conn.post.side_effect = [timed_out, bad_gateway]
+            with self.assertRaises(OrderError) as cm:
+                o.order(['a', 'b'], batch_size=1, max_workers=1)
+            assert conn.post.call_count == 2
+
+        assert cm.exception.failed_ids == ['a', 'b']
+
+    def test_order_keeps_placed_batches_when_one_fails(self):
+        ledger = OrderLedger(os.path.join(tempfile.mkdtemp(), 'orders.db'))
+
+        def post(url, data):
+            ids = json.loads(data)
+            r = Mock()
+            if ids == ['c']:
+                r.raise_for_status.side_effect = requests.exceptions.HTTPError(response=Mock(status_code=400))
+            r.json.return_value = {'order_id': 'order-' + ids[0]}
+            return r
+
+        o = Ordering(self.gbdx, ledger=ledger)
+        with patch.object(o, 'gbdx_connection') as conn:
+            conn.post.side_effect = post
+            with self.assertRaises(OrderError) as cm:
+                o.order(['a', 'b', 'c', 'd'], batch_size=1)
+
+            assert cm.exception.mapping == {'a': 'order-a', 'b': 'order-b', 'd': 'order-d'}
+            assert cm.exception.failed_ids == ['c']
+            assert sorted(ledger.get(['a', 'b', 'c', 'd'])) == ['a', 'b', 'd']
+
+            # a second run only orders the failed id
+            conn.post.reset_mock()
+            conn.post.side_effect = None
+            conn.post.return_value.json.return_value = {'order_id': 'order-2'}
+            assert o.order(['a', 'b', 'c', 'd']) == ['order-a', 'order-b', 'order-2', 'order-d']
+            assert json.loads(conn.post.call_args[1]['data']) == ['c']
+
+    def test_order_skips_ids_located_through_the_ledger(self):
+        ledger = OrderLedger(os.path.join(tempfile.mkdtemp(), 'orders.db'))
+        o = Ordering(self.gbdx, ledger=ledger)
+
+        with patch.object(o, 'gbdx_connection') as conn:
+            conn.get.return_value.json.return_value = {'acquisitions': [
+                {'acquisition_id': 'delivered', 'state': 'delivered', 'location': 's3://b/d'},
+                {'acquisition_id': 'submitted', 'state': 'submitted', 'location': 'not_delivered'},
+                {'acquisition_id': 'failed', 'state': 'failed', 'location': 'not_delivered'},
+                {'acquisition_id': 'unknown', 'state': 'not_ordered', 'location': 'not_delivered'}]}
+            o.location(['delivered', 'submitted', 'failed', 'unknown'])
+
+            conn.post.return_value.json.return_value = {'order_id': 'order-1'}
+            order_ids, mapping = o.order(['delivered', 'submitted', 'failed', 'unknown', 'new'], return_mapping=True)
+
+        # delivered and in flight ids have no order id and are not ordered again; other states are
+        assert json.loads(conn.post.call_args[1]['data']) == ['failed', 'unknown', 'new']
+        assert order_ids == ['order-1']
+        assert mapping == {'delivered': None, 'submitted': None, 'failed': 'order-1', 'unknown': 'order-1',
+                           'new': 'order-1'}
+
+    def test_wait_yields_state_changes(self):
+        responses = {
+            'order-1': [
+                [{'acquisition_id': 'a', 'state': 'submitted', 'location': 'not_delivered'}],
+                [{'acquisition_id': 'a', 'state': 'submitted', 'location': 'not_delivered'}],
+                [{'acquisition_id': 'a', 'state': 'delivered', 'location': 's3://bucket/a'}],
+            ],
+            'order-2': [
+                [{'acquisition_id': 'b', 'state': 'delivered', 'location': 's3://bucket/b'}],
+            ]
+        }
+        polled = []
+
+        def status(order_id):
+            polled.append(order_id)
+            return responses[order_id].pop(0)
+
+        delivered = Mock()
+        o = Ordering(self.gbdx)
+        with patch.object(o, 'status', side_effect=status), fake_clock('gbdxtools.concurrency.time'):
+            events = list(o.wait(['order-1', 'order-2'], on_delivered=delivered, min_interval=1))
+
+        assert [(e['acquisition_id'], e['previous_state'], e['state']) for e in events] == [
+            ('a', None, 'submitted'), ('b', None, 'delivered'), ('a', 'submitted', 'delivered')]
+        assert events[-1]['location'] == 's3://bucket/a'
+        # order-2 is not polled again once delivered
+        assert polled.count('order-2') == 1
+        assert polled.count('order-1') == 3
+        assert delivered.call_count == 1
+        assert len(delivered.call_args[0][0]) == 2
+
+    def test_wait_backs_off(self):
+        o = Ordering(self.gbdx)
+        tracker = OrderTracker(o, 'order-1', min_interval=10, max_interval=40)
+        pending = [{'acquisition_id': 'a', 'state': 'submitted', 'location': 'not_delivered'}]
+
+        with patch.object(o, 'status', return_value=pending) as status, fake_clock('gbdxtools.concurrency.time'), \
+                patch('gbdxtools.concurrency.random.uniform', return_value=1.0):
+            self.assertRaises(OrderTimeout, list, tracker.events(timeout=100))
+
+        # polls at 0, 10, 30, 70 seconds
+        assert status.call_count == 4
+        assert not tracker.delivered
+
+    def test_location_concurrent_and_cached(self):
+        def get(url, params):
+            ids = json.loads(params.replace('acquisitionIds=', ''))
+            r = Mock()
+            r.json.return_value = {'acquisitions': [
+                {'acquisition_id': _id,
+                 'state': 'delivered' if _id != 'c' else 'submitted',
+                 'location': 's3://bucket/' + _id if _id != 'c' else 'not_delivered'} for _id in ids]}
+            return r
+
+        o = Ordering(self.gbdx)
+        with patch.object(o, 'gbdx_connection') as conn:
+            conn.get.side_effect = get
+            res = o.location(['a', 'b', 'c', 'd', 'b'], batch_size=2)
+            assert [a['acquisition_id'] for a in res['acquisitions']] == ['a', 'b', 'c', 'd']
+            assert conn.get.call_count == 2
+
+            # delivered locations come from the cache, the pending one is fetched again
+            conn.get.reset_mock()
+            res = o.location(['d', 'c', 'a'])
+            assert [a['acquisition_id'] for a in res['acquisitions']] == ['d', 'c', 'a']
+            assert conn.get.call_count == 1
+            assert conn.get.call_args[1]['params'] == 'acquisitionIds=["c"]'
+
+            o.clear_location_cache()
+            conn.get.reset_mock()
+            o.location('a')
+            assert conn.get.call_count == 1
+
+    def test_order_with_ledger(self):
+        ledger = OrderLedger(os.path.join(tempfile.mkdtemp(), 'orders.db'))
+        ledger.record_orders({'pending': 'order-0', 'delivered': 'order-0', 'failed': 'order-0'})
+        ledger.record_acquisitions([{'acquisition_id': 'delivered', 'state': 'delivered', 'location': 's3://b/d'},
+                                    {'acquisition_id': 'failed', 'state': 'failed', 'location': 'not_delivered'}])
+
+        o = Ordering(self.gbdx, ledger=ledger)
+        with patch.object(o, 'gbdx_connection') as conn:
+            conn.post.return_value.json.return_value = {'order_id': 'order-1'}
+            order_ids, mapping = o.order(['pending', 'new', 'delivered', 'failed'], return_mapping=True)
+
+            # only the new and the failed ids are ordered
+            assert json.loads(conn.post.call_args[1]['data']) == ['new', 'failed']
+            assert order_ids == ['order-0', 'order-1']
+            assert mapping == {'pending': 'order-0', 'new': 'order-1', 'delivered': 'order-0', 'failed': 'order-1'}
+            assert ledger.get(['new'])['new']['order_id'] == 'order-1'
+
+            # nothing left to order
+            conn.post.reset_mock()
+            assert o.order('new') == 'order-1'
+            conn.post.assert_not_called()
 
+            # the delivered location comes from the ledger
+            conn.get.return_value.json.return_value = {'acquisitions': [
+                {'acquisition_id': 'new', 'state': 'submitted', 'location': 'not_delivered'}]}
+            res = o.location(['delivered', 'new'])
+            assert conn.get.call_args[1]['params'] == 'acquisitionIds=["new"]'
+            assert [a['location'] for a in res['acquisitions']] == ['s3://b/d', 'not_delivered']
@@ -2,9 +2,11 @@ from gbdxtools import Interface
 from gbdxtools.s3 import S3
 from auth_mock import get_mock_gbdx_session
 import vcr
+import io
 import os
 import tempfile
 import unittest
+from mock import Mock, PropertyMock, patch
 
 """
 How to use the mock_gbdx_session and vcr to create unit tests:
@@ -18,6 +20,56 @@ How to use the mock_gbdx_session and vcr to create unit tests:
 6. Edit the cassette to remove any possibly sensitive information (s3 creds for example)
 """
 
+def _mock_bucket(contents):
+    """A stand-in for a boto bucket that serves ranged GETs out of a dict of key name -> bytes"""
+    def key(name):
+        k = Mock()
+        k.size = len(contents[name])
+
+        def get_range(headers):
+            start, end = headers['Range'].replace('bytes=', '').split('-')
+            return contents[name][int(start):int(end) + 1]
+
+        k.get_contents_as_string.side_effect = get_range
+        return k
+
+    bucket = Mock()
+    bucket.get_key.side_effect = lambda name: key(name) if name in contents else None
+    bucket.new_key.side_effect = key
+    return bucket
+
+
+def _mock_key(name, size=10):
+    k = Mock()
+    k.name = name
+    k.size = size
+    k.etag = '"etag-%s"' % name
+    k.last_modified = '2017-01-01T00:00:00.000Z'
+    return k
+
+
+def _mock_stream_key(data, fail_after=None):
+    """A stand-in for a boto key that streams data, optionally failing part way through"""
+    k = Mock()
+    state = {}
+
+    def open_read(headers=None):
+        start = int(headers['Range'].replace('bytes=', '').rstrip('-')) if headers else 0
+        state['stream'] = io.BytesIO(data[start:])
+        state['sent'] = 0
+
+    def read(size):
+        if fail_after is not None and state['sent'] >= fail_after:
+            raise IOError('Connection reset')
+        chunk = state['stream'].read(min(size, 4))
+        state['sent'] += len(chunk)
+        return chunk
+
+    k.open_read.side_effect = open_read
+    k.read.side_effect = read
+    return k
+
+
 cassette_name = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cassettes', 'test_s3_download.yaml')
 
 class S3Tests(unittest.TestCase):
@@ -54,3 +106,189 @@ class S3Tests(unittest.TestCase):
 
         assert os.path.isfile(os.path.join(self._temp_path, 'test_dir', 'model.json'))
         assert os.path.isfile(os.path.join(self._temp_path, 'model.json'))
+        assert s.throttle.stats()['transfers_completed'] == 2
+        assert s.throttle.stats()['bytes_transferred'] > 0
+
+    def test_connection_is_reused(self):
+        s = S3(self.gbdx)
+        s.info = {'bucket': 'bucket', 'prefix': 'prefix', 'S3_access_key': 'a',
+                  'S3_secret_key': 'b', 'S3_session_token': 'c'}
+
+        with patch('gbdxtools.s3.botos3.connect_to_region') as connect:
+            assert s.bucket is s.bucket
+            assert connect.call_count == 1
+
+    def test_credentials_refresh_before_expiry(self):
+        s = S3(self.gbdx, duration=3600, refresh_margin=600)
+        creds = {'bucket': 'bucket', 'prefix': 'prefix', 'S3_access_key': 'a',
+                 'S3_secret_key': 'b', 'S3_session_token': 'c'}
+
+        with patch.object(S3, '_load_info', return_value=creds) as load_info, \
+                patch('gbdxtools.s3.botos3.connect_to_region') as connect, \
+                patch('gbdxtools.s3.time.time', return_value=1000.0) as now:
+            s.bucket
+            now.return_value = 1000.0 + 2999
+            s.bucket
+            assert load_info.call_count == 1
+            assert connect.call_count == 1
+
+            # inside the refresh margin, credentials and connection are renewed
+            now.return_value = 1000.0 + 3000
+            s.bucket
+            assert load_info.call_count == 2
+            assert connect.call_count == 2
+
+    def test_open_reads_ranges(self):
+        s = S3(self.gbdx)
+        s.info = {'prefix': 'prefix'}
+        bucket = _mock_bucket({'prefix/dir/file.bin': b'0123456789' * 10})
+
+        with patch.object(S3, 'bucket', new_callable=PropertyMock, return_value=bucket):
+            with s.open('/dir/file.bin', read_ahead=16) as f:
+                assert f.read(4) == b'0123'
+                f.seek(95)
+                assert f.read() == b'56789'
+                f.seek(-12, os.SEEK_END)
+                assert f.read(3) == b'890'
+
+    def test_open_missing_object(self):
+        s = S3(self.gbdx)
+        s.info = {'prefix': 'prefix'}
+        bucket = _mock_bucket({})
+
+        with patch.object(S3, 'bucket', new_callable=PropertyMock, return_value=bucket):
+            self.assertRaises(IOError, s.open, 'nothing/here.csv')
+
+    def test_iter_lines(self):
+        s = S3(self.gbdx)
+        s.info = {'prefix': 'prefix'}
+        bucket = _mock_bucket({'prefix/out.csv': b'id,wkt\r\n1,POINT (1 1)\n2,POINT (2 2)'})
+
+        with patch.object(S3, 'bucket', new_callable=PropertyMock, return_value=bucket):
+            assert list(s.iter_lines('out.csv', read_ahead=8)) == ['id,wkt', '1,POINT (1 1)', '2,POINT (2 2)']
+            assert list(s.iter_lines('out.csv', encoding=None))[0] == b'id,wkt'
+
+    def test_list(self):
+        s = S3(self.gbdx)
+        s.info = {'prefix': 'prefix'}
+        bucket = Mock()
+        bucket.list.return_value = [_mock_key('prefix/out/'), _mock_key('prefix/out/a.tif'),
+                                    _mock_key('prefix/out/sub/b.tif'), _mock_key('prefix/out2/c.tif')]
+
+        with patch.object(S3, 'bucket', new_callable=PropertyMock, return_value=bucket):
+            entries = list(s.list('/out/'))
+
+        bucket.list.assert_called_once_with('prefix/out')
+        assert [e['key'] for e in entries] == ['out/a.tif', 'out/sub/b.tif']
+        assert entries[0]['size'] == 10
+        assert entries[0]['etag'] == 'etag-prefix/out/a.tif'
+        assert entries[0]['last_modified'] == '2017-01-01T00:00:00.000Z'
+
+    def test_list_not_recursive(self):
+        from boto.s3.prefix import Prefix
+        s = S3(self.gbdx)
+        s.info = {'prefix': 'prefix'}
+        bucket = Mock()
+        bucket.list.return_value = [_mock_key('prefix/out/a.tif'), Prefix(name='prefix/out/sub/')]
+
+        with patch.object(S3, 'bucket', new_callable=PropertyMock, return_value=bucket):
+            entries = list(s.list('out', recursive=False))
+
+        bucket.list.assert_called_once_with('prefix/out/', delimiter='/')
+        assert [e['key'] for e in entries] == ['out/a.tif', 'out/sub/']
+        assert entries[1]['size'] is None
+
+    def test_list_cache(self):
+        s = S3(self.gbdx, listing_ttl=60)
+        s.info = {'prefix': 'prefix'}
+        bucket = Mock()
+        bucket.list.return_value = [_mock_key('prefix/out/a/1.tif'), _mock_key('prefix/out/b/2.tif')]
+
+        with patch.object(S3, 'bucket', new_callable=PropertyMock, return_value=bucket), \
+                patch('gbdxtools.s3.time.time', return_value=1000.0) as now:
+            assert len(list(s.list('out'))) == 2
+            assert len(list(s.list('out'))) == 2
+            # sub locations are answered from the cached parent listing
+            assert [e['key'] for e in s.list('out/b')] == ['out/b/2.tif']
+            assert bucket.list.call_count == 1
+
+            now.return_value = 1061.0
+            list(s.list('out'))
+            assert bucket.list.call_count == 2
+
+            s.clear_listing_cache()
+            list(s.list('out'))
+            assert bucket.list.call_count == 3
+
+    def test_download_resumes(self):
+        import hashlib
+        data = b'0123456789abcdef'
+        local_dir = tempfile.mkdtemp()
+        path = os.path.join(local_dir, 'image.tif')
+
+        s = S3(self.gbdx)
+        s.info = {'prefix': 'prefix'}
+        bucket = Mock()
+        bucket.list.return_value = [_mock_key('prefix/out/image.tif', size=len(data))]
+        bucket.list.return_value[0].etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+        with patch.object(S3, 'bucket', new_callable=PropertyMock, return_value=bucket):
+            # the connection drops after 8 bytes
+            bucket.new_key.return_value = _mock_stream_key(data, fail_after=8)
+            self.assertRaises(IOError, s.download, 'out', local_dir=local_dir)
+            assert not os.path.exists(path)
+            assert os.path.getsize(path + '.part') == 8
+            assert os.path.exists(path + '.part.state')
+
+            key = _mock_stream_key(data)
+            bucket.new_key.return_value = key
+            s.download('out', local_dir=local_dir, verify_etag=True)
+            key.open_read.assert_called_once_with(headers={'Range': 'bytes=8-'})
+
+            with open(path, 'rb') as f:
+                assert f.read() == data
+            assert not os.path.exists(path + '.part')
+            assert not os.path.exists(path + '.part.state')
+
+            # completed files are not downloaded again
+            bucket.new_key.reset_mock()
+            s.download('out', local_dir=local_dir)
+            bucket.new_key.assert_not_called()
+
+            # unless the object was replaced, even with content of the same size
+            bucket.list.return_value[0].etag = '"%s"' % hashlib.md5(data[::-1]).hexdigest()
+            bucket.new_key.return_value = _mock_stream_key(data[::-1])
+            s.download('out', local_dir=local_dir)
+            with open(path, 'rb') as f:
+                assert f.read() == data[::-1]
+
+    def test_download_untracked_file(self):
+        local_dir = tempfile.mkdtemp()
+        with open(os.path.join(local_dir, 'image.tif'), 'wb') as f:
+            f.write(b'old content')
+
+        s = S3(self.gbdx)
+        s.info = {'prefix': 'prefix'}
+        bucket = Mock()
+        bucket.list.return_value = [_mock_key('prefix/image.tif', size=11)]
+        bucket.new_key.return_value = _mock_stream_key(b'new content')
+
+        # a file of the right size that was not recorded as downloaded is replaced
+        with patch.object(S3, 'bucket', new_callable=PropertyMock, return_value=bucket):
+            s.download('image.tif', local_dir=local_dir)
+
+        with open(os.path.join(local_dir, 'image.tif'), 'rb') as f:
+            assert f.read() == b'new content'
+
+    def test_download_size_mismatch(self):
+        local_dir = tempfile.mkdtemp()
+        s = S3(self.gbdx)
+        s.info = {'prefix': 'prefix'}
+        bucket = Mock()
+        bucket.list.return_value = [_mock_key('prefix/image.tif', size=20)]
+        bucket.new_key.return_value = _mock_stream_key(b'too short')
+
+        with patch.object(S3, 'bucket', new_callable=PropertyMock, return_value=bucket):
+            self.assertRaises(IOError, s.download, 'image.tif', local_dir=local_dir)
+
+        assert not os.path.exists(os.path.join(local_dir, 'image.tif'))
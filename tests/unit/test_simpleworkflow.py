@@ -2,13 +2,21 @@
 Unit tests for the Task class
 """
 
-from gbdxtools.simpleworkflows import Task, Workflow, InvalidInputPort, WorkflowError
-from gbdxtools.workflow import Workflow as WorkflowAPI
+from gbdxtools.simpleworkflows import Task, Workflow, InvalidInputPort, WorkflowError, wait_all, wait_any
+from gbdxtools.workflow import Workflow as WorkflowAPI, WorkflowTimeout
+from gbdxtools.concurrency import Backoff
 from auth_mock import get_mock_gbdx_session
+from clock_mock import fake_clock
 from gbdxtools import Interface
 import vcr
 import unittest
 import json
+from mock import patch
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 
 """
 How to use the mock_gbdx_session and vcr to create unit tests:
@@ -540,4 +548,195 @@ class SimpleWorkflowTests(unittest.TestCase):
         with self.assertRaises(WorkflowError):
             task_ids = workflow.task_ids
 
+    def _statuses(self, *states):
+        return [{'state': state, 'event': 'succeeded' if state == 'complete' else 'started'} for state in states]
+
+    def test_workflow_wait(self):
+        workflow = self.gbdx.Workflow([])
+        workflow.id = 'wf-1'
+
+        with patch.object(self.gbdx.workflow, 'status', side_effect=self._statuses('pending', 'running', 'complete')), \
+                fake_clock('gbdxtools.simpleworkflows.time') as clock, patch('gbdxtools.concurrency.random.uniform', return_value=1.0):
+            status = workflow.wait(poll_policy=Backoff(initial=2, maximum=10))
+
+        self.assertEqual(status['event'], 'succeeded')
+        self.assertEqual(clock['sleeps'], [2, 4])
+
+    def test_workflow_wait_timeout(self):
+        workflow = self.gbdx.Workflow([])
+        workflow.id = 'wf-1'
+
+        with patch.object(self.gbdx.workflow, 'status', return_value={'state': 'running', 'event': 'started'}), \
+                fake_clock('gbdxtools.simpleworkflows.time') as clock, patch('gbdxtools.concurrency.random.uniform', return_value=1.0):
+            self.assertRaises(WorkflowTimeout, workflow.wait, timeout=30, poll_policy=Backoff(initial=10, maximum=60))
+
+        # the last wait is cut short by the timeout
+        self.assertEqual(clock['sleeps'], [10, 20])
+
+    def test_workflow_wait_batch(self):
+        workflow = self.gbdx.Workflow([])
+        workflow.id = 'batch-1'
+        workflow.batch_values = ['a', 'b']
+        statuses = [{'workflows': [{'id': '1', 'state': 'succeeded'}, {'id': '2', 'state': 'running'}]},
+                    {'workflows': [{'id': '1', 'state': 'succeeded'}, {'id': '2', 'state': 'failed'}]}]
+
+        with patch.object(self.gbdx.workflow, 'batch_workflow_status', side_effect=statuses), fake_clock('gbdxtools.simpleworkflows.time') as clock:
+            status = workflow.wait()
+
+        self.assertEqual(status, statuses[1])
+
+    def test_workflow_wait_unstarted_workflow(self):
+        workflow = self.gbdx.Workflow([])
+
+        with self.assertRaises(WorkflowError):
+            workflow.wait()
+
+    def test_wait_all_and_wait_any(self):
+        responses = {'wf-1': self._statuses('running', 'running', 'complete'),
+                     'wf-2': self._statuses('complete'),
+                     'wf-3': self._statuses('running', 'complete')}
+        polled = []
+
+        def status(workflow_id):
+            polled.append(workflow_id)
+            return responses[workflow_id].pop(0)
+
+        workflows = []
+        for workflow_id in ['wf-1', 'wf-2', 'wf-3']:
+            workflow = self.gbdx.Workflow([])
+            workflow.id = workflow_id
+            workflows.append(workflow)
+
+        with patch.object(self.gbdx.workflow, 'status', side_effect=status), fake_clock('gbdxtools.simpleworkflows.time') as clock:
+            self.assertTrue(wait_any(workflows) is workflows[1])
+
+        responses['wf-2'] = self._statuses('complete')
+        del polled[:]
+        with patch.object(self.gbdx.workflow, 'status', side_effect=status), fake_clock('gbdxtools.simpleworkflows.time') as clock:
+            statuses = wait_all(workflows)
+
+        self.assertEqual([s['state'] for s in statuses], ['complete'] * 3)
+        # completed workflows are not polled again
+        self.assertEqual(sorted(polled), ['wf-1', 'wf-1', 'wf-2', 'wf-3'])
+
+    def test_wait_all_timeout(self):
+        workflows = []
+        for workflow_id in ['wf-1', 'wf-2']:
+            workflow = self.gbdx.Workflow([])
+            workflow.id = workflow_id
+            workflows.append(workflow)
+
+        with patch.object(self.gbdx.workflow, 'status', return_value={'state': 'running', 'event': 'started'}), \
+                fake_clock('gbdxtools.simpleworkflows.time') as clock:
+            self.assertRaises(WorkflowTimeout, wait_all, workflows, timeout=60)
+
+    @unittest.skipIf(asyncio is None, 'asyncio is not available')
+    def test_workflow_wait_async(self):
+        workflow = self.gbdx.Workflow([])
+        workflow.id = 'wf-1'
+        loop = asyncio.new_event_loop()
+
+        try:
+            with patch.object(self.gbdx.workflow, 'status', side_effect=self._statuses('running', 'complete')):
+                status = loop.run_until_complete(
+                    workflow.wait_async(poll_policy=Backoff(initial=0.01, maximum=0.01), loop=loop))
+        finally:
+            loop.close()
+
+        self.assertEqual(status['event'], 'succeeded')
+
+    def test_workflow_status_snapshot(self):
+        workflow = self.gbdx.Workflow([], status_ttl=10)
+        workflow.id = 'wf-1'
+
+        with patch.object(self.gbdx.workflow, 'status',
+                          side_effect=self._statuses('running', 'complete', 'complete')) as status, fake_clock('gbdxtools.simpleworkflows.time') as clock:
+            # one request answers all the state properties
+            self.assertTrue(workflow.running)
+            self.assertFalse(workflow.complete)
+            self.assertFalse(workflow.succeeded)
+            self.assertFalse(workflow.failed)
+            self.assertEqual(status.call_count, 1)
+
+            # refresh() fetches the status now
+            self.assertEqual(workflow.refresh()['state'], 'complete')
+            self.assertTrue(workflow.succeeded)
+            self.assertEqual(status.call_count, 2)
+
+            # the snapshot expires after status_ttl seconds
+            clock['now'] += 10
+            self.assertTrue(workflow.complete)
+            self.assertEqual(status.call_count, 3)
+
+    def test_workflow_status_snapshot_disabled(self):
+        workflow = self.gbdx.Workflow([], status_ttl=0)
+        workflow.id = 'wf-1'
+
+        with patch.object(self.gbdx.workflow, 'status', return_value={'state': 'running', 'event': 'started'}) as status:
+            workflow.running
+            workflow.complete
+            self.assertEqual(status.call_count, 2)
+
+    def test_workflow_status_snapshot_follows_id(self):
+        workflow = self.gbdx.Workflow([])
+        workflow.id = 'wf-1'
+
+        with patch.object(self.gbdx.workflow, 'status', side_effect=self._statuses('running', 'complete')) as status:
+            self.assertFalse(workflow.complete)
+            workflow.id = 'wf-2'
+            self.assertTrue(workflow.complete)
+            self.assertEqual([c[0][0] for c in status.call_args_list], ['wf-1', 'wf-2'])
+
+    def _batch_workflow(self):
+        workflow = self.gbdx.Workflow([])
+        workflow.id = 'batch-1'
+        workflow.batch_values = ['a', 'b']
+        batch_status = {'workflows': [{'workflow_id': 'wf-1', 'state': 'succeeded'},
+                                      {'workflow_id': 'wf-2', 'state': 'failed'}]}
+        child_workflows = {'wf-1': {'tasks': [{'id': 't-1', 'taskType': 'test-success', 'name': 'task1'}]},
+                           'wf-2': {'tasks': [{'id': 't-2', 'taskType': 'test-fail', 'name': 'task2'},
+                                              {'id': 't-3', 'taskType': 'test-fail', 'name': 'task3'}]}}
+        patches = [
+            patch.object(self.gbdx.workflow, 'batch_workflow_status', return_value=batch_status),
+            patch.object(self.gbdx.workflow, 'get', side_effect=lambda workflow_id: child_workflows[workflow_id]),
+            patch.object(self.gbdx.workflow, 'events', side_effect=lambda workflow_id: [{'workflow': workflow_id}]),
+            patch.object(self.gbdx.workflow, 'get_stdout', side_effect=lambda w, t: 'out %s %s' % (w, t)),
+            patch.object(self.gbdx.workflow, 'get_stderr', side_effect=lambda w, t: 'err %s %s' % (w, t)),
+        ]
+        return workflow, patches
+
+    def test_batch_workflow_task_ids_and_events(self):
+        workflow, patches = self._batch_workflow()
+        with patches[0], patches[1], patches[2]:
+            self.assertEqual(workflow.child_workflow_ids, ['wf-1', 'wf-2'])
+            self.assertEqual(workflow.task_ids, {'wf-1': ['t-1'], 'wf-2': ['t-2', 't-3']})
+            self.assertEqual(workflow.events, {'wf-1': [{'workflow': 'wf-1'}], 'wf-2': [{'workflow': 'wf-2'}]})
+            self.assertTrue(workflow.failed)
+
+    def test_batch_workflow_stdout_and_stderr(self):
+        workflow, patches = self._batch_workflow()
+        with patches[0], patches[1], patches[3], patches[4]:
+            stdout = workflow.stdout
+            stderr = workflow.stderr
+
+        self.assertEqual(sorted(stdout), ['wf-1', 'wf-2'])
+        self.assertEqual([t['stdout'] for t in stdout['wf-2']], ['out wf-2 t-2', 'out wf-2 t-3'])
+        self.assertEqual(stdout['wf-1'][0]['taskType'], 'test-success')
+        self.assertEqual([t['stderr'] for t in stderr['wf-1']], ['err wf-1 t-1'])
+
+    def test_batch_workflow_child_results_stream(self):
+        workflow, patches = self._batch_workflow()
+        with patches[0], patches[1]:
+            results = list(workflow.child_results('task_ids', max_workers=2))
+            self.assertRaises(ValueError, workflow.child_results, 'outputs')
+
+        self.assertEqual(sorted(results), [('wf-1', ['t-1']), ('wf-2', ['t-2', 't-3'])])
+
+    def test_batch_workflow_child_results_error(self):
+        workflow, patches = self._batch_workflow()
+
+        def get(workflow_id):
+            raise Exception('failed to get %s' % workflow_id)
 
+        with patches[0], patch.object(self.gbdx.workflow, 'get', side_effect=get):
+            self.assertRaises(Exception, lambda: workflow.task_ids)
@@ -4,10 +4,13 @@ Contact: dmitry.zviagintsev@digitalglobe.com
 Unit test the task registry class
 '''
 import os
+import tempfile
+import threading
 
 from gbdxtools import Interface
 from gbdxtools.task_registry import TaskRegistry
 import vcr
+from mock import Mock, patch
 from auth_mock import get_mock_gbdx_session
 
 # How to use the mock_gbdx_session and vcr to create unit tests:
@@ -150,3 +153,131 @@ def test_delete_task():
         test_list_tasks()
     rv = tr.delete('gbdxtools-test-task')
     assert 'successfully deleted' in rv.lower()
+
+
+def _definition_response(status_code=200, definition=None, etag='"v1"'):
+    r = Mock(status_code=status_code, headers={'ETag': etag})
+    r.json.return_value = definition
+    return r
+
+
+def test_definition_cache():
+    tr = TaskRegistry(gbdx, definition_ttl=60)
+    definition = _task_json()
+
+    with patch.object(tr, 'gbdx_connection') as conn:
+        conn.get.return_value = _definition_response(definition=definition)
+        assert tr.get_definition('gbdxtools-test-task') == definition
+        # callers get their own copy
+        tr.get_definition('gbdxtools-test-task')['name'] = 'changed'
+        assert tr.get_definition('gbdxtools-test-task') == definition
+        assert conn.get.call_count == 1
+
+        tr.update('gbdxtools-test-task:0.0.1', definition)
+        tr.get_definition('gbdxtools-test-task')
+        assert conn.get.call_count == 2
+
+
+def test_definition_cache_revalidates_with_etag():
+    tr = TaskRegistry(gbdx, definition_ttl=60)
+    definition = _task_json()
+
+    with patch.object(tr, 'gbdx_connection') as conn, patch('gbdxtools.task_registry.time') as clock:
+        clock.time.return_value = 1000
+        conn.get.return_value = _definition_response(definition=definition)
+        tr.get_definition('gbdxtools-test-task')
+
+        clock.time.return_value = 1061
+        conn.get.return_value = _definition_response(status_code=304)
+        assert tr.get_definition('gbdxtools-test-task') == definition
+        assert conn.get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+
+        # the 304 restarted the ttl
+        clock.time.return_value = 1100
+        tr.get_definition('gbdxtools-test-task')
+        assert conn.get.call_count == 2
+
+
+def test_definition_cache_on_disk():
+    path = os.path.join(tempfile.mkdtemp(), 'tasks.json')
+    definition = _task_json()
+
+    tr = TaskRegistry(gbdx, cache_path=path)
+    with patch.object(tr, 'gbdx_connection') as conn:
+        conn.get.return_value = _definition_response(definition=definition)
+        tr.get_definition('gbdxtools-test-task')
+
+    tr = TaskRegistry(gbdx, cache_path=path)
+    with patch.object(tr, 'gbdx_connection') as conn:
+        assert tr.get_definition('gbdxtools-test-task') == definition
+        conn.get.assert_not_called()
+
+        tr.delete('gbdxtools-test-task')
+    assert TaskRegistry(gbdx, cache_path=path)._definitions == {}
+
+
+def test_prefetch_and_snapshot():
+    path = os.path.join(tempfile.mkdtemp(), 'tasks.json')
+    tr = TaskRegistry(gbdx)
+
+    def get(url, headers=None):
+        if url.endswith('/tasks'):
+            r = Mock(status_code=200)
+            r.json.return_value = {'tasks': ['task-a', 'task-b', 'task-c']}
+            return r
+        return _definition_response(definition={'name': url.rsplit('/', 1)[1]})
+
+    with patch.object(tr, 'gbdx_connection') as conn:
+        conn.get.side_effect = get
+        assert tr.prefetch(['task-a', 'task-b']) == {'task-a': {'name': 'task-a'}, 'task-b': {'name': 'task-b'}}
+        definitions = tr.snapshot(path, max_workers=2)
+        assert sorted(definitions) == ['task-a', 'task-b', 'task-c']
+        # list() plus the one definition that was not cached yet
+        assert conn.get.call_count == 2 + 1 + 1
+
+    # a worker using the snapshot does not call the API, however old it is
+    worker = TaskRegistry(gbdx, definition_ttl=None, cache_path=path)
+    with patch.object(worker, 'gbdx_connection') as conn, patch('gbdxtools.task_registry.time') as clock:
+        clock.time.return_value = 10 ** 10
+        assert worker.get_definition('task-c') == {'name': 'task-c'}
+        conn.get.assert_not_called()
+
+
+def test_definition_cache_shared_file():
+    path = os.path.join(tempfile.mkdtemp(), 'tasks.json')
+    registries = [TaskRegistry(gbdx, definition_ttl=0, cache_path=path) for _ in range(4)]
+    errors = []
+
+    def get(url, headers=None):
+        return _definition_response(definition={'name': url.rsplit('/', 1)[1]})
+
+    def run(tr, i):
+        try:
+            for j in range(10):
+                tr.get_definition('task-%s-%s' % (i, j % 3))
+        except Exception as e:
+            errors.append(e)
+
+    for tr in registries:
+        tr.gbdx_connection = Mock()
+        tr.gbdx_connection.get.side_effect = get
+    threads = [threading.Thread(target=run, args=(tr, i)) for i, tr in enumerate(registries)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    # every registry merged the others' definitions into the file
+    assert sorted(TaskRegistry(gbdx, cache_path=path)._read()) == sorted(
+        'task-%s-%s' % (i, j) for i in range(4) for j in range(3))
+    assert [name for name in os.listdir(os.path.dirname(path))] == ['tasks.json']
+
+
+def test_definition_cache_write_errors_are_ignored():
+    path = os.path.join(tempfile.mkdtemp(), 'missing', 'tasks.json')
+    tr = TaskRegistry(gbdx, cache_path=path)
+
+    with patch.object(tr, 'gbdx_connection') as conn:
+        conn.get.return_value = _definition_response(definition={'name': 'task-a'})
+        assert tr.get_definition('task-a') == {'name': 'task-a'}
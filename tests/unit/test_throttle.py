@@ -0,0 +1,71 @@
+"""
+Unit tests for gbdxtools.throttle
+"""
+
+from gbdxtools.throttle import TokenBucket, Throttle
+import threading
+import time
+import unittest
+from mock import patch
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        with patch('gbdxtools.throttle.time') as mock_time:
+            mock_time.time.return_value = 100.0
+            bucket = TokenBucket(rate=10)
+
+            # a full bucket serves one second worth of tokens without blocking
+            assert bucket.consume(10) == 0
+            mock_time.sleep.assert_not_called()
+
+            # the next 5 tokens take half a second to come in
+            assert bucket.consume(5) == 0.5
+            mock_time.sleep.assert_called_once_with(0.5)
+
+    def test_refill(self):
+        with patch('gbdxtools.throttle.time') as mock_time:
+            mock_time.time.return_value = 100.0
+            bucket = TokenBucket(rate=10)
+            bucket.consume(10)
+
+            mock_time.time.return_value = 101.0
+            assert bucket.consume(10) == 0
+
+
+class ThrottleTests(unittest.TestCase):
+
+    def test_max_concurrent_transfers(self):
+        throttle = Throttle(max_concurrent_transfers=2)
+        lock = threading.Lock()
+        peak = [0]
+
+        def transfer():
+            with throttle.transfer():
+                with lock:
+                    peak[0] = max(peak[0], throttle.stats()['active_transfers'])
+                time.sleep(0.02)
+
+        threads = [threading.Thread(target=transfer) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert peak[0] == 2
+        assert throttle.stats()['transfers_completed'] == 6
+        assert throttle.stats()['active_transfers'] == 0
+
+    def test_stats(self):
+        throttle = Throttle()
+        with patch('gbdxtools.throttle.time.time', return_value=10.0) as now:
+            with throttle.transfer():
+                throttle.consume(500)
+                throttle.consume(500)
+                now.return_value = 12.0
+
+            stats = throttle.stats()
+            assert stats['bytes_transferred'] == 1000
+            assert stats['busy_seconds'] == 2.0
+            assert stats['throughput'] == 500.0
@@ -0,0 +1,64 @@
+"""
+Unit tests for the gbdxtools.VectorCache class
+"""
+
+from gbdxtools.vector_cache import VectorCache
+import os
+import tempfile
+import time
+import unittest
+from mock import Mock, patch
+
+
+def _point(id, x, y):
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [x, y]}, "properties": {"id": id}}
+
+
+class VectorCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'vectors.db')
+        self.cache = VectorCache(self.path, ttl=100)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_lookup_inside_extent(self):
+        assert self.cache.lookup('item_type:car', (0, 0, 10, 10)) is None
+
+        started = time.time()
+        self.cache.add('item_type:car', [_point('a', 1, 1), _point('b', 5, 5)])
+        self.cache.add_extent('item_type:car', (0, 0, 10, 10), started)
+
+        assert [v['properties']['id'] for v in self.cache.lookup('item_type:car', (0, 0, 2, 2))] == ['a']
+        assert len(self.cache.lookup('item_type:car', (0, 0, 10, 10))) == 2
+        assert self.cache.lookup('item_type:car', (5, 5, 11, 11)) is None
+        assert self.cache.lookup('item_type:boat', (0, 0, 2, 2)) is None
+
+    def test_refetch_drops_deleted_vectors(self):
+        clock = Mock(time=Mock(return_value=1000))
+        with patch('gbdxtools.vector_cache.time', clock):
+            self.cache.add('q', [_point('a', 1, 1), _point('b', 2, 2)])
+            self.cache.add_extent('q', (0, 0, 10, 10), 1000)
+
+            clock.time.return_value = 1050
+            self.cache.add('q', [_point('a', 1.5, 1.5)])
+            self.cache.add_extent('q', (0, 0, 10, 10), 1050)
+
+            vectors = self.cache.lookup('q', (0, 0, 10, 10))
+            assert vectors == [_point('a', 1.5, 1.5)]
+
+    def test_ttl(self):
+        clock = Mock(time=Mock(return_value=1000))
+        with patch('gbdxtools.vector_cache.time', clock):
+            self.cache.add('q', [_point('a', 1, 1)])
+            self.cache.add_extent('q', (0, 0, 10, 10), 1000)
+            clock.time.return_value = 1101
+            assert self.cache.lookup('q', (0, 0, 2, 2)) is None
+
+    def test_clear(self):
+        started = time.time()
+        self.cache.add('q', [_point('a', 1, 1)])
+        self.cache.add_extent('q', (0, 0, 10, 10), started)
+        self.cache.clear()
+        assert self.cache.lookup('q', (0, 0, 2, 2)) is None
@@ -0,0 +1,107 @@
+"""
+Unit tests for gbdxtools.vector_io
+"""
+
+from gbdxtools.vector_io import iter_geojson_features, format_from_path, open_writer
+import io
+import json
+import os
+import tempfile
+import unittest
+from mock import patch
+
+
+def _feature(i):
+    return {"type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [i, i]},
+            "properties": {"name": "feature \"%s\" [with] {brackets}" % i}}
+
+
+class VectorIOTests(unittest.TestCase):
+
+    def _write(self, text):
+        fd, path = tempfile.mkstemp(suffix='.geojson')
+        os.close(fd)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def test_feature_collection(self):
+        collection = {"type": "FeatureCollection",
+                      "crs": {"type": "name", "properties": {"name": "features"}},
+                      "features": [_feature(i) for i in range(50)]}
+        path = self._write(u'' + json.dumps(collection, indent=2))
+
+        # a tiny read size forces features to span reads
+        features = list(iter_geojson_features(path, read_size=16))
+        assert features == collection['features']
+
+    def test_single_line_feature_collection(self):
+        collection = {"type": "FeatureCollection", "features": [_feature(i) for i in range(3)]}
+        path = self._write(u'' + json.dumps(collection))
+        assert list(iter_geojson_features(path)) == collection['features']
+
+    def test_empty_feature_collection(self):
+        path = self._write(u'{"type": "FeatureCollection", "features": [ ]}')
+        assert list(iter_geojson_features(path)) == []
+
+    def test_newline_delimited(self):
+        path = self._write(u'\n' + u'\n'.join(json.dumps(_feature(i)) for i in range(5)) + u'\n\n')
+        assert list(iter_geojson_features(path)) == [_feature(i) for i in range(5)]
+
+    def test_record_separated(self):
+        path = self._write(u''.join(u'\x1e' + json.dumps(_feature(i)) + u'\n' for i in range(3)))
+        assert list(iter_geojson_features(path)) == [_feature(i) for i in range(3)]
+
+    def test_newline_delimited_lines_longer_than_read_size(self):
+        features = [_feature(i) for i in range(3)]
+        features[0]['geometry'] = {"type": "LineString", "coordinates": [[i, i] for i in range(50)]}
+        path = self._write(u'\n'.join(json.dumps(feature) for feature in features))
+        assert list(iter_geojson_features(path, read_size=64)) == features
+
+    def test_single_feature(self):
+        path = self._write(u'' + json.dumps(_feature(1), indent=2))
+        assert list(iter_geojson_features(path, read_size=16)) == [_feature(1)]
+
+    def test_not_geojson(self):
+        path = self._write(u'{"type": "Feature Soup"}')
+        self.assertRaises(ValueError, list, iter_geojson_features(path))
+
+    def test_format_from_path(self):
+        assert format_from_path('out.ndjson') == 'geojson'
+        assert format_from_path('out.CSV') == 'csv'
+        assert format_from_path('out.parquet') == 'parquet'
+        self.assertRaises(ValueError, format_from_path, 'out.shp')
+
+    def test_geojson_writer_resume(self):
+        path = self._write(u'')
+        writer = open_writer(path, 'geojson')
+        writer.write([_feature(0), _feature(1)])
+        offset = writer.flush()
+        writer.write([_feature(2)])
+        writer.close()
+
+        # resuming drops what was written after the offset
+        writer = open_writer(path, 'geojson', offset)
+        writer.write([_feature(3)])
+        writer.close()
+        assert list(iter_geojson_features(path)) == [_feature(0), _feature(1), _feature(3)]
+
+    def test_csv_writer(self):
+        path = self._write(u'')
+        feature = _feature(1)
+        feature['properties'].update(id='a', item_type=['car'], attributes={'n': 1})
+        writer = open_writer(path, 'csv')
+        writer.write([feature])
+        writer.close()
+
+        with io.open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        assert lines[0] == 'id,item_type,ingest_source,item_date,name,text,attributes,wkt'
+        assert lines[1].startswith('a,"[""car""]",,,"feature ""1"" [with] {brackets}",,"{""n"": 1}",POINT (1')
+
+    def test_parquet_writer_requires_pyarrow(self):
+        path = self._write(u'')
+        with patch.dict('sys.modules', {'pyarrow': None, 'pyarrow.parquet': None}):
+            self.assertRaises(ImportError, open_writer, path, 'parquet')
+        self.assertRaises(ValueError, open_writer, path, 'parquet', 10)
@@ -6,11 +6,19 @@ Unit tests for the gbdxtools.Vectors class
 '''
 
 from gbdxtools import Interface
-from gbdxtools.vectors import Vectors
+from gbdxtools.vectors import Vectors, TermsAggDef, GeohashAggDef, DateHistogramAggDef, _wkt_to_geojson
+from geomet import wkt
+from gbdxtools.vector_cache import VectorCache
 from auth_mock import get_mock_gbdx_session
 import vcr
+import json
+import requests
+import os
+import tempfile
+import time
 import unittest
 import types
+from mock import Mock, patch
 
 """
 How to use the mock_gbdx_session and vcr to create unit tests:
@@ -55,6 +63,15 @@ class TestVectors(unittest.TestCase):
         assert isinstance(g, types.GeneratorType)
         assert count == 310
 
+    @vcr.use_cassette('tests/unit/cassettes/test_vectors_search.yaml', filter_headers=['authorization'], match_on=['method', 'scheme', 'host', 'port', 'path'])
+    def test_vectors_search_prefetch(self):
+        v = Vectors(self.gbdx)
+        aoi = "POLYGON((17.75390625 25.418470119273117,24.08203125 25.418470119273117,24.08203125 19.409611549990895,17.75390625 19.409611549990895,17.75390625 25.418470119273117))"
+        g = v.query_iteratively(aoi, query="item_type:WV03", prefetch=2, prefetch_bytes=1024 * 1024)
+
+        assert isinstance(g, types.GeneratorType)
+        assert len(list(g)) == 310
+
     @vcr.use_cassette('tests/unit/cassettes/test_vectors_create_single.yaml', filter_headers=['authorization'])
     def test_vectors_create_single(self):
         v = Vectors(self.gbdx)
@@ -138,10 +155,445 @@ class TestVectors(unittest.TestCase):
         )
         assert result == '/insight-vector/api/vector/vector-web-s/b1af66c3-2e41-4696-9924-6ab264336692'
 
+    def _feature(self, i):
+        return {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [1.0, 1.0]},
+            "properties": {"item_type": "type", "ingest_source": "source", "attributes": {"n": i}}
+        }
+
+    def _mock_create(self, delays=None):
+        """post() stand-in returning one id per vector; optionally slows down the first chunk"""
+        posted = []
+
+        def post(url, data):
+            vectors = json.loads(data)
+            posted.append(len(vectors))
+            if delays and len(posted) == 1:
+                time.sleep(delays)
+            r = Mock()
+            r.json.return_value = ['id-%s' % v['properties']['attributes']['n'] for v in vectors]
+            return r
+
+        return post, posted
+
+    def test_vectors_create_chunks_in_order(self):
+        v = Vectors(self.gbdx)
+        post, posted = self._mock_create(delays=0.05)
+
+        with patch.object(v, 'gbdx_connection') as conn:
+            conn.post.side_effect = post
+            ids = v.create((self._feature(i) for i in range(25)), chunk_size=10, max_workers=3)
+
+        assert sorted(posted) == [5, 10, 10]
+        assert ids == ['id-%s' % i for i in range(25)]
+
+    def test_vectors_create_retries(self):
+        v = Vectors(self.gbdx)
+        post, posted = self._mock_create()
+
+        def failing(status_code):
+            r = Mock()
+            r.raise_for_status.side_effect = requests.exceptions.HTTPError(response=Mock(status_code=status_code))
+            return r
+
+        with patch.object(v, 'gbdx_connection') as conn, patch('gbdxtools.concurrency.time.sleep'):
+            # a throttled chunk was not ingested and is posted again
+            responses = [failing(503)]
+            conn.post.side_effect = lambda url, data: responses.pop(0) if responses else post(url, data)
+            assert v.create([self._feature(i) for i in range(3)]) == ['id-0', 'id-1', 'id-2']
+            assert conn.post.call_count == 2
+
+            # after a read timeout or a 502 the chunk may have been ingested
+            for error in [requests.exceptions.ReadTimeout(),
+                          requests.exceptions.HTTPError(response=Mock(status_code=502))]:
+                conn.post.reset_mock()
+                conn.post.side_effect = error
+                self.assertRaises(type(error), v.create, [self._feature(0)])
+                assert conn.post.call_count == 1
+
+    def test_vectors_create_chunks_by_size(self):
+        v = Vectors(self.gbdx)
+        post, posted = self._mock_create()
+        size = len(json.dumps(self._feature(0)))
+
+        with patch.object(v, 'gbdx_connection') as conn:
+            conn.post.side_effect = post
+            ids = v.create([self._feature(i) for i in range(6)], max_bytes=3 * size)
+
+        assert sorted(posted) == [2, 2, 2]
+        assert len(ids) == 6
+
+    def test_vectors_create_validates_lists_first(self):
+        v = Vectors(self.gbdx)
+        vectors = [self._feature(0), {"type": "Feature", "properties": {"item_type": "type"}}]
+
+        with patch.object(v, 'gbdx_connection') as conn:
+            self.assertRaises(Exception, v.create, vectors)
+            conn.post.assert_not_called()
+
+    def test_vectors_create_from_file(self):
+        fd, path = tempfile.mkstemp(suffix='.geojson')
+        with os.fdopen(fd, 'w') as f:
+            for i in range(3):
+                feature = self._feature(i)
+                del feature['properties']['ingest_source']
+                if i == 0:
+                    del feature['properties']['item_type']
+                f.write(json.dumps(feature) + '\n')
+
+        v = Vectors(self.gbdx)
+        post, posted = self._mock_create()
+        with patch.object(v, 'gbdx_connection') as conn:
+            conn.post.side_effect = post
+            ids = v.create_from_file(path, item_type='detection', chunk_size=2)
+            sent = [f for call in conn.post.call_args_list for f in json.loads(call[1]['data'])]
+
+        assert ids == ['id-0', 'id-1', 'id-2']
+        assert [f['properties']['item_type'] for f in sent] == ['detection', 'type', 'type']
+        assert all(f['properties']['ingest_source'] == os.path.basename(path) for f in sent)
+
+    def _mock_pages(self, features):
+        """_pages() stand-in returning the features inside the queried bbox, in pages of 2"""
+        def pages(params):
+            inside = [f for f in features
+                      if params['left'] <= f['geometry']['coordinates'][0] <= params['right'] and
+                      params['lower'] <= f['geometry']['coordinates'][1] <= params['upper']]
+            for i in range(0, len(inside), 2):
+                yield {'data': inside[i:i + 2], 'next_paging_id': None}, 0
+        return pages
+
+    def _point(self, id, x, y):
+        return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [x, y]}, "properties": {"id": id}}
+
+    def test_vectors_query_partitioned(self):
+        v = Vectors(self.gbdx)
+        # an L shaped area: the top right quadrant of its bounds is outside of it
+        aoi = "POLYGON((0 0, 2 0, 2 1, 1 1, 1 2, 0 2, 0 0))"
+        features = [self._point('a', 0.5, 0.5), self._point('b', 1.0, 0.5), self._point('c', 1.5, 1.5),
+                    self._point('d', 0.5, 1.5), self._point('e', 1.5, 0.5)]
+        pages = Mock(side_effect=self._mock_pages(features))
+
+        with patch.object(v, '_pages', pages):
+            results = list(v.query_partitioned(aoi, "item_type:WV03", tile_size=1.0, max_workers=2))
+            queried = sorted((c[0][0]['left'], c[0][0]['lower']) for c in pages.call_args_list)
+
+        assert queried == [(0.0, 0.0), (0.0, 1.0), (1.0, 0.0), (1.0, 1.0)]
+        # 'b' lies on the edge of two tiles but is only returned once
+        assert sorted(r['properties']['id'] for r in results) == ['a', 'b', 'c', 'd', 'e']
+
+        with patch.object(v, '_pages', Mock(side_effect=self._mock_pages(features))):
+            results = list(v.query_partitioned(aoi, "item_type:WV03", tile_size=1.0, clip=True))
+
+        assert sorted(r['properties']['id'] for r in results) == ['a', 'b', 'd', 'e']
+
+    def test_vectors_query_partitioned_skips_outside_tiles(self):
+        v = Vectors(self.gbdx)
+        aoi = "POLYGON((0 0, 3 0, 0 3, 0 0))"
+        pages = Mock(side_effect=self._mock_pages([]))
+
+        with patch.object(v, '_pages', pages):
+            assert list(v.query_partitioned(aoi, "item_type:WV03", tile_size=1.0)) == []
+
+        # of the 3x3 tiles, only the one beyond the diagonal is skipped
+        assert pages.call_count == 8
+
+    def test_vectors_aggregation_defs(self):
+        assert str(TermsAggDef('item_type')) == 'terms:item_type'
+        assert str(GeohashAggDef(4, children=[TermsAggDef('item_type')])) == 'geohash:4;terms:item_type'
+        assert str(GeohashAggDef(4, children=[TermsAggDef('item_type'), DateHistogramAggDef('d')])) == \
+            'geohash:4;(terms:item_type,date_hist:d)'
+        self.assertRaises(ValueError, DateHistogramAggDef, 'fortnight')
+
+    def test_vectors_aggregate_query(self):
+        v = Vectors(self.gbdx)
+        aggregations = [{'name': 'terms:item_type', 'terms': [{'term': 'WV03', 'count': 12}]}]
+
+        with patch.object(v, 'gbdx_connection') as conn:
+            conn.post.return_value.json.return_value = {'aggregations': aggregations}
+            result = v.aggregate_query("POLYGON((0 0, 1 0, 1 1, 0 0))", TermsAggDef('item_type'),
+                                       query="item_type:WV03", count=5)
+            args, kwargs = conn.post.call_args
+
+        assert result == aggregations
+        assert args[0] == v.aggregations_url
+        assert kwargs['params'] == {'count': 5, 'aggs': 'terms:item_type', 'query': 'item_type:WV03'}
+        assert json.loads(kwargs['data'])['type'] == 'Polygon'
+
+    def test_vectors_aggregate_locally(self):
+        def vector(item_type, x, y, item_date):
+            return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [x, y]},
+                    "properties": {"item_type": [item_type], "item_date": item_date}}
+
+        vectors = [vector('car', 10.0, 10.0, '2016-10-20T20:08:48Z'),
+                   vector('car', 10.01, 10.01, '2016-10-21T01:00:00Z'),
+                   vector('boat', -10.0, -10.0, '2016-11-02T00:00:00Z')]
+        v = Vectors(self.gbdx)
+
+        with patch.object(v, 'query_iteratively', Mock(return_value=iter(vectors))) as query:
+            result = v.aggregate_locally("POLYGON((0 0, 1 0, 1 1, 0 0))",
+                                         TermsAggDef('item_type', children=[DateHistogramAggDef('M')]))
+            assert query.call_args[0][1] == '*'
 
+        assert result == [{'name': 'terms:item_type;date_hist:M', 'terms': [
+            {'term': 'car', 'count': 2, 'aggregations': [
+                {'name': 'date_hist:M', 'terms': [{'term': '2016-10-01T00:00:00Z', 'count': 2}]}]},
+            {'term': 'boat', 'count': 1, 'aggregations': [
+                {'name': 'date_hist:M', 'terms': [{'term': '2016-11-01T00:00:00Z', 'count': 1}]}]}]}]
 
+        with patch.object(v, 'query_iteratively', Mock(return_value=iter(vectors))):
+            result = v.aggregate_locally("POLYGON((0 0, 1 0, 1 1, 0 0))", GeohashAggDef(3),
+                                         start_date='2016-10-21', end_date='2016-10-31')
+        assert result == [{'name': 'geohash:3', 'terms': [{'term': 's1z', 'count': 1}]}]
 
+    def test_vectors_export_resume(self):
+        fd, path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(fd)
+        aoi = "POLYGON((0 0, 1 0, 1 1, 0 0))"
+        features = [self._point('v%s' % i, 0.5, 0.5) for i in range(7)]
+        conn, expired = self._paging_service(features)
+        post = conn.post.side_effect
 
+        def failing_post(url, headers, data):
+            if data['pagingId'] == '0.3':
+                raise IOError('connection lost')
+            return post(url, headers, data)
+
+        v = Vectors(self.gbdx)
+        with patch.object(v, 'gbdx_connection', conn):
+            conn.post.side_effect = failing_post
+            self.assertRaises(IOError, v.export, aoi, "item_type:WV03", path, batch_size=3)
+
+            # the failure came before the second batch was written: only the first 4 vectors are saved
+            with open(path + '.state') as f:
+                state = json.load(f)
+            assert (state['count'], state['paging_id']) == (4, '0.2')
+
+            # the export continues from the third page, without running the query again
+            conn.post.side_effect = post
+            conn.post.reset_mock()
+            assert v.export(aoi, "item_type:WV03", path, batch_size=3, resume=True) == 7
+            assert conn.get.call_count == 1
+            assert [call[1]['data']['pagingId'] for call in conn.post.call_args_list] == ['0.2', '0.3', '0.4']
+
+        with open(path) as f:
+            assert [json.loads(line)['properties']['id'] for line in f] == ['v%s' % i for i in range(7)]
+        assert not os.path.exists(path + '.state')
+
+    def test_vectors_export_resume_expired(self):
+        fd, path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(fd)
+        aoi = "POLYGON((0 0, 1 0, 1 1, 0 0))"
+        features = [self._point('v%s' % i, 0.5, 0.5) for i in range(7)]
+        conn, expired = self._paging_service(features)
+
+        v = Vectors(self.gbdx)
+        with patch.object(v, 'gbdx_connection', conn):
+            v.export(aoi, "item_type:WV03", path, batch_size=3)
+            # an interrupted export of the first 4 vectors, whose paging id has expired since
+            with open(path) as f:
+                lines = f.readlines()[:4]
+            with open(path, 'w') as f:
+                f.writelines(lines)
+            with open(path + '.state', 'w') as f:
+                json.dump({'searchAreaWkt': aoi, 'query': "item_type:WV03", 'format': 'geojson', 'count': 4,
+                           'offset': os.path.getsize(path), 'paging_id': '0.2'}, f)
+            expired.add(0)
+
+            assert v.export(aoi, "item_type:WV03", path, batch_size=3, resume=True) == 7
+            assert conn.get.call_count == 2
+
+        with open(path) as f:
+            assert [json.loads(line)['properties']['id'] for line in f] == ['v%s' % i for i in range(7)]
+
+    def test_vectors_query_cache(self):
+        v = Vectors(self.gbdx)
+        v.cache = VectorCache(os.path.join(tempfile.mkdtemp(), 'vectors.db'))
+        features = [self._point('a', 0.5, 0.5), self._point('b', 1.5, 1.5)]
+        pages = Mock(side_effect=self._mock_pages(features))
+
+        with patch.object(v, '_pages', pages):
+            assert len(v.query("POLYGON((0 0, 2 0, 2 2, 0 2, 0 0))", "item_type:WV03")) == 2
+            # a smaller area inside the first one is answered locally
+            results = v.query("POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))", "item_type:WV03")
+            assert [r['properties']['id'] for r in results] == ['a']
+            assert pages.call_count == 1
+
+            v.query("POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))", "item_type:WV02")
+            assert pages.call_count == 2
+
+    def test_vectors_get_many(self):
+        v = Vectors(self.gbdx)
+
+        def get(url):
+            r = Mock(status_code=404 if url.endswith('gone') else 200)
+            r.json.return_value = {'id': url.rsplit('/', 1)[1]}
+            return r
+
+        with patch.object(v, 'gbdx_connection') as conn:
+            conn.get.side_effect = get
+            records, missing = v.get_many(['a', 'gone', 'b', 'a'], index='my-index')
+
+        assert records == {'a': {'id': 'a'}, 'b': {'id': 'b'}}
+        assert missing == ['gone']
+        assert conn.get.call_count == 3
+        assert all('/vector/my-index/' in call[0][0] for call in conn.get.call_args_list)
+
+    def test_wkt_to_geojson(self):
+        for w in ['POINT (30 10)',
+                  'LINESTRING (30 10, 10 30, 40 40)',
+                  'POLYGON ((35 10, 45 45, 15 40, 10 20, 35 10), (20 30, 35 35, 30 20, 20 30))',
+                  'MULTIPOINT ((10 40), (40 30))',
+                  'MULTIPOINT (10 40, 40 30)',
+                  'MULTILINESTRING ((10 10, 20 20), (40 40, 30 30))',
+                  'MULTIPOLYGON (((30 20, 45 40, 10 40, 30 20)), ((15 5, 40 10, 10 20, -5.5e1 10, 15 5)))',
+                  'POINT (1 2 3)',
+                  'GEOMETRYCOLLECTION (POINT (40 10))']:
+            assert _wkt_to_geojson(w) == wkt.loads(w)
+
+    def test_vectors_create_from_wkt_rows(self):
+        rows = [('POINT (%s 1)' % i, 'detection', 'model.csv', {'n': i} if i else None) for i in range(5)]
+        v = Vectors(self.gbdx)
+
+        with patch.object(v, 'gbdx_connection') as conn:
+            conn.post.side_effect = lambda url, data: Mock(json=Mock(return_value=[
+                'id-%s' % f['geometry']['coordinates'][0] for f in json.loads(data)]))
+            ids = v.create_from_wkt_rows(iter(rows), chunk_size=2)
+            sent = [f for call in conn.post.call_args_list for f in json.loads(call[1]['data'])]
+
+        assert ids == ['id-%s' % i for i in range(5)]
+        assert conn.post.call_count == 3
+        assert sent[0]['properties'] == {'item_type': 'detection', 'ingest_source': 'model.csv', 'attributes': {}}
+        assert sent[4]['geometry'] == {'type': 'Point', 'coordinates': [4, 1]}
+
+    def _paging_service(self, features, page_size=2):
+        """gbdx_connection stand-in for the paging API. Every query gets new paging ids;
+        the paging ids of the queries numbered in the returned set are expired"""
+        expired = set()
+        queries = []
+        pages = [features[i:i + page_size] for i in range(0, len(features), page_size)] + [[]]
+
+        def response(status_code, body):
+            r = Mock(status_code=status_code, content=b'')
+            r.json.return_value = body
+            if status_code >= 400:
+                r.raise_for_status.side_effect = requests.exceptions.HTTPError(response=r)
+            return r
+
+        def get(url, params):
+            queries.append(params)
+            return response(200, {'pagingId': '%s.0' % (len(queries) - 1), 'itemCount': len(features)})
+
+        def post(url, headers, data):
+            query, i = [int(n) for n in data['pagingId'].split('.')]
+            if query in expired:
+                return response(404, {})
+            return response(200, {'data': pages[i], 'item_count': len(pages[i]),
+                                  'next_paging_id': '%s.%s' % (query, i + 1) if pages[i] else None})
+
+        conn = Mock()
+        conn.get.side_effect = get
+        conn.post.side_effect = post
+        return conn, expired
+
+    def test_vectors_query_pages_resume_token(self):
+        v = Vectors(self.gbdx)
+        aoi = "POLYGON((0 0, 1 0, 1 1, 0 0))"
+        features = [self._point('v%s' % i, 0.5, 0.5) for i in range(5)]
+        conn, expired = self._paging_service(features)
+
+        with patch.object(v, 'gbdx_connection', conn):
+            pages = v.query_pages(aoi, "item_type:WV03")
+            first, token = next(pages)
+            assert token == {'paging_id': '0.1', 'delivered': 2}
+
+            rest = []
+            for vectors, token in v.query_pages(aoi, "item_type:WV03", resume_token=token):
+                rest.extend(vectors)
+
+        assert first + rest == features
+        assert token['delivered'] == 5
+        assert conn.get.call_count == 1
+
+    def test_vectors_query_resumable(self):
+        v = Vectors(self.gbdx)
+        aoi = "POLYGON((0 0, 1 0, 1 1, 0 0))"
+        path = os.path.join(tempfile.mkdtemp(), 'query.checkpoint')
+        features = [self._point('v%s' % i, 0.5, 0.5) for i in range(7)]
+        conn, expired = self._paging_service(features)
+
+        with patch.object(v, 'gbdx_connection', conn):
+            # stop in the middle of the third page
+            results = v.query_resumable(aoi, "item_type:WV03", path)
+            delivered = [next(results) for _ in range(5)]
+            results.close()
+            with open(path) as f:
+                assert json.load(f)['delivered'] == 4
+
+            # the paging ids have expired by the time the query is resumed
+            expired.add(0)
+            rest = list(v.query_resumable(aoi, "item_type:WV03", path))
+
+        assert delivered[:4] + rest == features
+        assert conn.get.call_count == 2
+        assert not os.path.exists(path)
+
+    def test_vectors_query_resumable_gives_up(self):
+        v = Vectors(self.gbdx)
+        aoi = "POLYGON((0 0, 1 0, 1 1, 0 0))"
+        path = os.path.join(tempfile.mkdtemp(), 'query.checkpoint')
+        features = [self._point('v%s' % i, 0.5, 0.5) for i in range(5)]
+        conn, expired = self._paging_service(features)
+        post = conn.post.side_effect
+
+        def failing_second_page(url, headers, data, status_code=404):
+            if data['pagingId'].endswith('.1'):
+                r = Mock(status_code=status_code)
+                r.raise_for_status.side_effect = requests.exceptions.HTTPError(response=r)
+                return r
+            return post(url, headers, data)
+
+        with patch.object(v, 'gbdx_connection', conn):
+            # one restart, which does not get past the failing page either
+            conn.post.side_effect = failing_second_page
+            self.assertRaises(requests.exceptions.HTTPError, list, v.query_resumable(aoi, "item_type:WV03", path))
+            assert conn.get.call_count == 2
+
+            # other client errors are not taken for an expired paging id
+            conn.get.reset_mock()
+            conn.post.side_effect = lambda url, headers, data: failing_second_page(url, headers, data, 400)
+            os.remove(path)
+            self.assertRaises(requests.exceptions.HTTPError, list, v.query_resumable(aoi, "item_type:WV03", path))
+            assert conn.get.call_count == 1
+
+    def test_vectors_query_resumable_tiles(self):
+        v = Vectors(self.gbdx)
+        path = os.path.join(tempfile.mkdtemp(), 'query.checkpoint')
+        features = [self._point('a', 0.5, 0.5), self._point('b', 1.0, 0.5), self._point('c', 1.5, 0.5)]
+
+        with patch.object(v, '_pages', Mock(side_effect=lambda params, paging_id: self._mock_pages(features)(params))):
+            results = list(v.query_resumable("POLYGON((0 0, 2 0, 2 1, 0 1, 0 0))", "item_type:WV03", path,
+                                             tile_size=1.0))
+
+        assert [r['properties']['id'] for r in results] == ['a', 'b', 'c']
+
+    def test_vectors_query_resumable_tiles_edge_vectors(self):
+        v = Vectors(self.gbdx)
+        aoi = "POLYGON((0 0, 2 0, 2 1, 0 1, 0 0))"
+        path = os.path.join(tempfile.mkdtemp(), 'query.checkpoint')
+        features = [self._point('a', 0.5, 0.5), self._point('b', 1.0, 0.5), self._point('c', 1.5, 0.5),
+                    self._point('d', 1.2, 0.5)]
+        pages = Mock(side_effect=lambda params, paging_id: self._mock_pages(features)(params))
 
+        with patch.object(v, '_pages', pages):
+            # stop in the second tile, after the first one was checkpointed
+            results = v.query_resumable(aoi, "item_type:WV03", path, tile_size=1.0)
+            delivered = [next(results) for _ in range(3)]
+            results.close()
+            with open(path) as f:
+                assert json.load(f)['edge_ids'] == ['b']
 
+            rest = list(v.query_resumable(aoi, "item_type:WV03", path, tile_size=1.0))
 
+        # 'b', on the edge of both tiles, is not delivered again
+        assert [r['properties']['id'] for r in delivered[:2] + rest] == ['a', 'b', 'c', 'd']
@@ -6,12 +6,14 @@ Unit test the workflow class
 """
 
 from gbdxtools import Interface
-from gbdxtools.workflow import Workflow
+from gbdxtools.workflow import Workflow, WorkflowMonitor, WorkflowTimeout
 from auth_mock import get_mock_gbdx_session
+from clock_mock import fake_clock
 import vcr
 import unittest
 import os
 import json
+from mock import patch
 
 """
 How to use the mock_gbdx_session and vcr to create unit tests:
@@ -113,4 +115,40 @@ class WorkflowTests(unittest.TestCase):
         self.assertEquals('<empty>', output)
 
 
-        
\ No newline at end of file
+        
+
+    def test_monitor_yields_state_changes(self):
+        responses = {
+            'wf-1': [{'state': 'pending', 'event': 'submitted'},
+                     {'state': 'running', 'event': 'started'},
+                     {'state': 'running', 'event': 'started'},
+                     {'state': 'complete', 'event': 'succeeded'}],
+            'wf-2': [{'state': 'complete', 'event': 'failed'}],
+        }
+        polled = []
+
+        def status(workflow_id):
+            polled.append(workflow_id)
+            return responses[workflow_id].pop(0)
+
+        wf = Workflow(self.gbdx)
+        with patch.object(wf, 'status', side_effect=status), fake_clock('gbdxtools.concurrency.time'):
+            events = list(wf.monitor(['wf-1', 'wf-2'], min_interval=1, max_requests_per_second=100))
+
+        assert [(e['workflow_id'], e['previous_event'], e['event']) for e in events] == [
+            ('wf-1', None, 'submitted'), ('wf-2', None, 'failed'),
+            ('wf-1', 'submitted', 'started'), ('wf-1', 'started', 'succeeded')]
+        assert polled.count('wf-1') == 4
+        assert polled.count('wf-2') == 1
+
+    def test_monitor_adaptive_intervals(self):
+        wf = Workflow(self.gbdx)
+        monitor = WorkflowMonitor(wf, ['wf-1'], min_interval=10, max_interval=40, state_intervals={'pending': 30})
+
+        with patch.object(wf, 'status', return_value={'state': 'pending', 'event': 'submitted'}) as status, \
+                fake_clock('gbdxtools.concurrency.time'), patch('gbdxtools.concurrency.random.uniform', return_value=1.0):
+            self.assertRaises(WorkflowTimeout, list, monitor.events(timeout=100))
+
+        # pending workflows start at 30 seconds: polls at 0, 30, 70 seconds
+        assert status.call_count == 3
+        assert not monitor.complete